@@ -1,24 +1,50 @@
-from flask import Flask, render_template, request, redirect, url_for, send_file, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, send_file, flash, session, jsonify, g, has_app_context, Response, stream_with_context
+import click
 import sqlite3
 import os
-from datetime import datetime
+import io
+import queue
+import threading
+import zipfile
+from datetime import datetime, timedelta
 from io import BytesIO
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import groupby
+from operator import itemgetter
 from urllib.parse import quote
 import csv
+import hashlib
+import json
+import multiprocessing
 import re
+import tempfile
+import time
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import fcntl
+except ImportError:  # Windows: لا يوجد قفل بين الـ processes
+    fcntl = None
 
 # ---------- Config ----------
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, "students.db")
-EXCEL_PATH = os.path.join(BASE_DIR, "students.xlsx")
+# مجلد البيانات (قاعدة البيانات وملف Excel والتقارير)؛ يمكن تغييره لتشغيل نسخة منفصلة
+DATA_DIR = os.environ.get("ATTENDANCE_DATA_DIR", BASE_DIR)
+DB_PATH = os.path.join(DATA_DIR, "students.db")
+EXCEL_PATH = os.path.join(DATA_DIR, "students.xlsx")
 QR_DIR = os.path.join(BASE_DIR, "static", "qr_codes")
-SUMMARY_DIR = os.path.join(BASE_DIR, "summary_of_the_day")
-MONTHLY_DIR = os.path.join(BASE_DIR, "monthly_reports")
+SUMMARY_DIR = os.path.join(DATA_DIR, "summary_of_the_day")
+MONTHLY_DIR = os.path.join(DATA_DIR, "monthly_reports")
+JOBS_DIR = os.path.join(DATA_DIR, "job_artifacts")
 
 # إنشاء المجلدات إذا لم تكن موجودة
 os.makedirs(QR_DIR, exist_ok=True)
 os.makedirs(SUMMARY_DIR, exist_ok=True)
 os.makedirs(MONTHLY_DIR, exist_ok=True)
+os.makedirs(JOBS_DIR, exist_ok=True)
 
 app = Flask(__name__)
 app.secret_key = "attendance-system-secret-key-2024-pythonanywhere"
@@ -39,6 +65,8 @@ def require_login():
     public_pages = ['login', 'static', 'logout', 'remote_scanner']
     if request.endpoint and not any(request.endpoint == page or request.endpoint.startswith('static') for page in public_pages):
         if 'username' not in session:
+            if request.path.startswith('/api/'):
+                return jsonify({"ok": False, "error": "login_required"}), 401
             return redirect(url_for('login'))
 
 def check_permission(required_permission):
@@ -58,16 +86,277 @@ def get_pythonanywhere_url():
 
 PC_IP = get_pythonanywhere_url()
 
-def open_db():
-    conn = sqlite3.connect(DB_PATH)
+# ---------- Database Connections ----------
+# اتصال واحد لكل طلب (محفوظ في g) يُستعار من pool صغير ويُعاد إليه في نهاية الطلب.
+# خارج الطلبات (بدء التشغيل، المهام الخلفية) يحصل كل thread على اتصال خاص به.
+DB_POOL_SIZE = 8
+DB_TIMEOUT_SECONDS = 10
+DB_STATEMENT_CACHE = 256
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",          # القراءة لا تمنع الكتابة والعكس
+    "PRAGMA synchronous=NORMAL",        # آمن مع WAL وأسرع بكثير من FULL
+    "PRAGMA mmap_size=268435456",       # 256MB
+    "PRAGMA cache_size=-16000",         # 16MB لكل اتصال
+    "PRAGMA temp_store=MEMORY",
+)
+
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+_db_local = threading.local()
+
+class _TimedCursor(sqlite3.Cursor):
+    """مؤشر يضيف زمن fetchone/fetchmany/fetchall إلى استعلامه (استدعاء واحد لكل استعلام عادةً)؛
+    SQLite ينفذ معظم الاستعلام أثناء الجلب لا عند execute. المرور على المؤشر بـ for لا يُوقَّت."""
+
+    _sql_entry = None
+
+    def _timed(self, fetch, *args):
+        started = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            record_sql_fetch(self._sql_entry, time.perf_counter() - started)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+class _RowTimedCursor(_TimedCursor):
+    """توقيت كل صف عند المرور على المؤشر؛ مكلف في التصديرات الكبيرة لذلك لا يُفعَّل إلا بـ METRICS_ROW_TIMING"""
+
+    def __next__(self):
+        return self._timed(super().__next__)
+
+class _TimedConnection(sqlite3.Connection):
+    """اتصال يسجل عدد ومدة الاستعلامات (مع جلب صفوفها) في إحصائيات الطلب الحالي (انظر Metrics)"""
+
+    def execute(self, sql, parameters=(), /):
+        cursor = self.cursor(_RowTimedCursor if METRICS_ROW_TIMING else _TimedCursor)
+        started = time.perf_counter()
+        try:
+            return cursor.execute(sql, parameters)
+        finally:
+            cursor._sql_entry = record_sql(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, parameters, /):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            record_sql(sql, time.perf_counter() - started)
+
+def _connect_db():
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_TIMEOUT_SECONDS,
+        cached_statements=DB_STATEMENT_CACHE,
+        check_same_thread=False,
+        factory=_TimedConnection if METRICS_ENABLED else sqlite3.Connection,
+    )
     conn.row_factory = sqlite3.Row
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
+def _checkout_db():
+    try:
+        return _db_pool.get_nowait()
+    except queue.Empty:
+        return _connect_db()
+
+def _release_db(conn):
+    # لا نعيد اتصالاً بمعاملة مفتوحة إلى الـ pool
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _db_pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+def open_db():
+    """الاتصال المشترك بقاعدة البيانات للطلب أو الـ thread الحالي (لا تغلقه)"""
+    if has_app_context():
+        if "db" not in g:
+            g.db = _checkout_db()
+        return g.db
+
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = _db_local.conn = _connect_db()
+    return conn
+
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop("db", None)
+    if conn is not None:
+        _release_db(conn)
+
+# ---------- Metrics ----------
+# لكل طلب: المدة الكلية وعدد الاستعلامات ومدتها، ومدرج تكراري (histogram) لكل route.
+# الأرقام خاصة بكل process وتُعرض بصيغة Prometheus على /metrics (للمدير فقط).
+# الطلبات الأبطأ من SLOW_REQUEST_MS تُطبع مع أبطأ استعلاماتها.
+METRICS_ENABLED = os.environ.get("ATTENDANCE_METRICS", "1") != "0"
+# توقيت جلب كل صف عند المرور على نتائج الاستعلام (للتشخيص فقط؛ يبطئ التصديرات الكبيرة)
+METRICS_ROW_TIMING = os.environ.get("ATTENDANCE_METRICS_ROW_TIMING", "0") == "1"
+SLOW_REQUEST_MS = int(os.environ.get("ATTENDANCE_SLOW_REQUEST_MS", "500"))
+SLOW_REQUEST_TOP_QUERIES = 3
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics_lock = threading.Lock()
+_route_metrics = {}  # endpoint -> {"buckets": [...], "count", "sum", "sql_count", "sql_seconds"}
+_request_counts = {}  # (endpoint, method, status) -> count
+
+def record_sql(sql, seconds):
+    """إضافة استعلام لإحصائيات الطلب الحالي (لا شيء خارج الطلبات)؛ يعيد سجله ليُضاف إليه زمن الجلب"""
+    if not has_app_context():
+        return None
+    stats = g.get("sql_stats")
+    if stats is None:
+        return None
+    entry = [seconds, sql]
+    stats["count"] += 1
+    stats["seconds"] += seconds
+    stats["queries"].append(entry)
+    return entry
+
+def record_sql_fetch(entry, seconds):
+    """إضافة زمن جلب الصفوف لاستعلام مسجل دون زيادة عدد الاستعلامات"""
+    if entry is None or not has_app_context():
+        return
+    stats = g.get("sql_stats")
+    if stats is not None:
+        entry[0] += seconds
+        stats["seconds"] += seconds
+
+@app.before_request
+def start_request_timer():
+    if METRICS_ENABLED:
+        g.request_started = time.perf_counter()
+        g.sql_stats = {"count": 0, "seconds": 0.0, "queries": []}
+
+@app.after_request
+def record_request_metrics(response):
+    # الردود المتدفقة تُحسب حتى بداية الإرسال فقط
+    started = g.get("request_started")
+    if started is None:
+        return response
+
+    elapsed = time.perf_counter() - started
+    stats = g.sql_stats
+    endpoint = request.endpoint or "unknown"
+
+    with _metrics_lock:
+        route = _route_metrics.get(endpoint)
+        if route is None:
+            route = _route_metrics[endpoint] = {
+                "buckets": [0] * len(LATENCY_BUCKETS), "count": 0, "sum": 0.0,
+                "sql_count": 0, "sql_seconds": 0.0,
+            }
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed <= bound:
+                route["buckets"][index] += 1
+        route["count"] += 1
+        route["sum"] += elapsed
+        route["sql_count"] += stats["count"]
+        route["sql_seconds"] += stats["seconds"]
+
+        key = (endpoint, request.method, response.status_code)
+        _request_counts[key] = _request_counts.get(key, 0) + 1
+
+    if elapsed * 1000 >= SLOW_REQUEST_MS:
+        print(
+            f"🐢 طلب بطيء: {request.method} {request.path} ({endpoint}) {elapsed * 1000:.0f}ms، "
+            f"{stats['count']} استعلام في {stats['seconds'] * 1000:.0f}ms"
+        )
+        for seconds, sql in sorted(stats["queries"], key=itemgetter(0), reverse=True)[:SLOW_REQUEST_TOP_QUERIES]:
+            print(f"   {seconds * 1000:.1f}ms: {' '.join(sql.split())[:200]}")
+
+    return response
+
+def _prometheus_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render_metrics():
+    """كل المقاييس بصيغة Prometheus النصية"""
+    with _metrics_lock:
+        routes = {endpoint: dict(route, buckets=list(route["buckets"])) for endpoint, route in _route_metrics.items()}
+        request_counts = dict(_request_counts)
+
+    lines = [
+        "# HELP attendance_requests_total Requests handled by this process.",
+        "# TYPE attendance_requests_total counter",
+    ]
+    for (endpoint, method, status), count in sorted(request_counts.items()):
+        lines.append(
+            f'attendance_requests_total{{endpoint="{_prometheus_label(endpoint)}",method="{method}",status="{status}"}} {count}'
+        )
+
+    lines += [
+        "# HELP attendance_request_duration_seconds Request latency per route.",
+        "# TYPE attendance_request_duration_seconds histogram",
+    ]
+    for endpoint, route in sorted(routes.items()):
+        label = _prometheus_label(endpoint)
+        for bound, count in zip(LATENCY_BUCKETS, route["buckets"]):
+            lines.append(f'attendance_request_duration_seconds_bucket{{endpoint="{label}",le="{bound}"}} {count}')
+        lines.append(f'attendance_request_duration_seconds_bucket{{endpoint="{label}",le="+Inf"}} {route["count"]}')
+        lines.append(f'attendance_request_duration_seconds_sum{{endpoint="{label}"}} {route["sum"]:.6f}')
+        lines.append(f'attendance_request_duration_seconds_count{{endpoint="{label}"}} {route["count"]}')
+
+    lines += [
+        "# HELP attendance_sql_queries_total SQL statements executed per route.",
+        "# TYPE attendance_sql_queries_total counter",
+    ]
+    for endpoint, route in sorted(routes.items()):
+        lines.append(f'attendance_sql_queries_total{{endpoint="{_prometheus_label(endpoint)}"}} {route["sql_count"]}')
+
+    lines += [
+        "# HELP attendance_sql_seconds_total Time spent executing SQL per route (rows read by iterating a cursor count only with ATTENDANCE_METRICS_ROW_TIMING=1).",
+        "# TYPE attendance_sql_seconds_total counter",
+    ]
+    for endpoint, route in sorted(routes.items()):
+        lines.append(f'attendance_sql_seconds_total{{endpoint="{_prometheus_label(endpoint)}"}} {route["sql_seconds"]:.6f}')
+
+    cache_stats = result_cache.stats()
+    lines += [
+        "# HELP attendance_result_cache_entries Results currently held in the page cache.",
+        "# TYPE attendance_result_cache_entries gauge",
+        f"attendance_result_cache_entries {cache_stats['entries']}",
+        "# HELP attendance_result_cache_requests_total Page cache lookups by view and result.",
+        "# TYPE attendance_result_cache_requests_total counter",
+    ]
+    for result, counts in (("hit", cache_stats["hits"]), ("miss", cache_stats["misses"])):
+        for view, count in sorted(counts.items()):
+            lines.append(f'attendance_result_cache_requests_total{{view="{view}",result="{result}"}} {count}')
+
+    return "\n".join(lines) + "\n"
+
+@app.route("/metrics")
+def metrics():
+    if not check_permission('all'):
+        return Response("forbidden\n", status=403, mimetype="text/plain")
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+# مصدر الوقت الحالي للتطبيق؛ set_clock تثبته على وقت محدد (مثلاً في benchmarks)
+_clock = datetime.now
+
+def set_clock(clock=None):
+    """استبدال مصدر الوقت بدالة ترجع datetime (None للرجوع إلى datetime.now)"""
+    global _clock
+    _clock = clock or datetime.now
+
+def current_time():
+    return _clock()
+
 def today_str():
-    return datetime.now().strftime("%Y-%m-%d")
+    return current_time().strftime("%Y-%m-%d")
 
 def current_month_str():
-    return datetime.now().strftime("%Y-%m")
+    return current_time().strftime("%Y-%m")
 
 def weekday_english_to_arabic(day_english):
     day_map = {
@@ -81,197 +370,1087 @@ def weekday_english_to_arabic(day_english):
     }
     return day_map.get(day_english.lower(), day_english)
 
-# ---------- Database Initialization ----------
-def init_tables():
-    """إنشاء جميع الجداول إذا لم تكن موجودة"""
-    conn = open_db()
+@contextmanager
+def timed_phase(name):
+    """طباعة مدة تنفيذ مرحلة من مراحل التشغيل"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        print(f"⏱️  {name}: {(time.perf_counter() - started) * 1000:.0f}ms")
+
+def acquire_process_lock(name):
+    """قفل ملف غير حاجز بين الـ processes؛ يرجع الملف المفتوح أو None إذا كان القفل مأخوذاً"""
+    lock_file = open(os.path.join(DATA_DIR, f".{name}.lock"), "w")
+    if fcntl is None:
+        return lock_file
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
 
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS students (
-        id TEXT PRIMARY KEY,
-        student_name TEXT,
-        parent_number TEXT,
-        payment_amount REAL
-    )
-    """)
+def release_process_lock(lock_file):
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+    lock_file.close()
 
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS classes (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        student_id TEXT,
-        day_of_week TEXT,
-        start_time TEXT,
-        end_time TEXT,
-        FOREIGN KEY (student_id) REFERENCES students (id)
+# ---------- Database Initialization ----------
+# ملخص الشهر لكل طالب (student_month_stats) يُحدَّث بالـ triggers مع كل تعديل على history
+MONTH_STATS_FIELDS = (
+    "total_classes", "present_count", "absent_count", "paid_sessions",
+    "homework_done", "homework_not_done", "grade_sum", "grade_count",
+)
+
+def _month_stats_values(row):
+    """مساهمة صف history في ملخص الشهر، بنفس ترتيب MONTH_STATS_FIELDS (row هو NEW أو OLD أو اسم الجدول)"""
+    grade = f"trim({row}.exam_grade)"
+    # الدرجة رقمية إذا كانت أرقاماً مع نقطة عشرية واحدة على الأكثر
+    numeric_grade = (
+        f"({grade} <> '' AND {grade} NOT GLOB '*[^0-9.]*' "
+        f"AND {grade} NOT GLOB '*.*.*' AND {grade} GLOB '*[0-9]*')"
     )
-    """)
+    return (
+        "1",
+        f"{row}.status IS 'Present'",
+        f"{row}.status IS 'Absent'",
+        f"{row}.paid IS 'Yes'",
+        f"{row}.homework_status IS 'اتعمل'",
+        f"{row}.homework_status IS 'متعملش'",
+        f"CASE WHEN {numeric_grade} THEN CAST({grade} AS REAL) ELSE 0 END",
+        f"CASE WHEN {numeric_grade} THEN 1 ELSE 0 END",
+    )
+
+def _month_stats_apply_sql(row, sign=""):
+    """إضافة (أو طرح مع sign='-') صف history من ملخص شهره"""
+    values = ", ".join(f"{sign}({value})" for value in _month_stats_values(row))
+    updates = ", ".join(f"{field} = {field} + excluded.{field}" for field in MONTH_STATS_FIELDS)
+    return f"""
+            INSERT INTO student_month_stats (student_id, month, {', '.join(MONTH_STATS_FIELDS)})
+            SELECT {row}.student_id, substr({row}.date, 1, 7), {values}
+            WHERE {row}.student_id IS NOT NULL AND {row}.date IS NOT NULL
+            ON CONFLICT (student_id, month) DO UPDATE SET {updates};"""
+
+_MONTH_STATS_REMOVE_EMPTY_SQL = """
+            DELETE FROM student_month_stats
+            WHERE student_id = OLD.student_id AND month = substr(OLD.date, 1, 7) AND total_classes <= 0;"""
+
+MONTH_STATS_REBUILD_SQL = f"""
+    INSERT INTO student_month_stats (student_id, month, {', '.join(MONTH_STATS_FIELDS)})
+    SELECT student_id, substr(date, 1, 7),
+           {', '.join(f"SUM({value})" for value in _month_stats_values("history"))}
+    FROM history
+    WHERE student_id IS NOT NULL AND date IS NOT NULL
+    GROUP BY student_id, substr(date, 1, 7)
+"""
 
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS history (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        student_id TEXT,
-        class_id INTEGER,
-        exam_grade TEXT,
-        homework_status TEXT,
-        status TEXT,
-        paid TEXT,
-        date TEXT,
-        FOREIGN KEY (student_id) REFERENCES students (id),
-        FOREIGN KEY (class_id) REFERENCES classes (id)
+# فهرس البحث (students_fts) يحفظ الاسم ورقم ولي الأمر بعد التطبيع، ونفس القواعد تُطبق على نص البحث
+# حتى يجد "احمد" اسم "أحمد" و "فاطمه" اسم "فاطمة" و "+20 100-123" الرقم "0100123..."
+ARABIC_NORMALIZATION = (
+    ("أ", "ا"), ("إ", "ا"), ("آ", "ا"), ("ٱ", "ا"),
+    ("ؤ", "و"), ("ئ", "ي"), ("ى", "ي"), ("ة", "ه"),
+    ("ـ", ""),  # التطويل
+) + tuple((chr(code), "") for code in range(0x064B, 0x0653)) + (("ٰ", ""),)  # التشكيل
+
+PHONE_SEPARATORS = (" ", "-", "+", "(", ")", ".", "/")
+
+def normalize_arabic(text):
+    text = str(text or "")
+    for source, target in ARABIC_NORMALIZATION:
+        text = text.replace(source, target)
+    return text
+
+def normalize_phone(number):
+    """رقم ولي الأمر بصيغة محلية: بدون فواصل، و 0020 أو 20 في أوله تصبح 0"""
+    number = str(number or "")
+    for separator in PHONE_SEPARATORS:
+        number = number.replace(separator, "")
+    if number.startswith("0020"):
+        return "0" + number[4:]
+    if number.startswith("20") and len(number) == 12:
+        return "0" + number[2:]
+    return number
+
+def _sql_replace_chain(expr, pairs):
+    for source, target in pairs:
+        expr = f"replace({expr}, '{source}', '{target}')"
+    return expr
+
+def _sql_normalize_name(expr):
+    """نفس normalize_arabic كتعبير SQL (للـ triggers)"""
+    return _sql_replace_chain(f"IFNULL({expr}, '')", ARABIC_NORMALIZATION)
+
+def _sql_normalize_phone(expr):
+    """نفس normalize_phone كتعبير SQL؛ expr يجب أن يكون اسم عمود لأنه يتكرر في CASE"""
+    return f"""CASE
+                WHEN {expr} LIKE '0020%' THEN '0' || substr({expr}, 5)
+                WHEN {expr} LIKE '20%' AND length({expr}) = 12 THEN '0' || substr({expr}, 3)
+                ELSE {expr} END"""
+
+def _students_fts_insert_sql(row, source=""):
+    """إدخال صف (أو صفوف) الطلاب في الفهرس بعد التطبيع، مربوطة بكود الطالب (student_id)"""
+    stripped = _sql_replace_chain(f"IFNULL({row}.parent_number, '')", [(sep, "") for sep in PHONE_SEPARATORS])
+    return f"""
+            INSERT INTO students_fts (student_id, student_name, parent_number)
+            SELECT fts_id, {_sql_normalize_name('fts_name')}, {_sql_normalize_phone('fts_phone')}
+            FROM (SELECT {row}.id AS fts_id, {row}.student_name AS fts_name, {stripped} AS fts_phone{source});"""
+
+# الفهرس مربوط بكود الطالب لا بـ rowid: جدول students مفتاحه نصي، و VACUUM قد يعيد ترقيم rowid
+_STUDENTS_FTS_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS students_fts USING fts5 (
+        student_id UNINDEXED, student_name, parent_number,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
     )
-    """)
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_students_fts_insert AFTER INSERT ON students
+    BEGIN{_students_fts_insert_sql("NEW")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_students_fts_update AFTER UPDATE OF id, student_name, parent_number ON students
+    WHEN OLD.id IS NOT NEW.id OR OLD.student_name IS NOT NEW.student_name OR OLD.parent_number IS NOT NEW.parent_number
+    BEGIN
+        DELETE FROM students_fts WHERE student_id = OLD.id;{_students_fts_insert_sql("NEW")}
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_students_fts_delete AFTER DELETE ON students
+    BEGIN
+        DELETE FROM students_fts WHERE student_id = OLD.id;
+    END
+    """,
+    _students_fts_insert_sql("students", " FROM students").strip().rstrip(";"),
+]
+
+# كل عنصر في القائمة هو ترحيل واحد، ورقم الإصدار = ترتيبه في القائمة.
+# الإصدار الحالي محفوظ في PRAGMA user_version، فلا يُنفذ أي ترحيل مرتين.
+# لا تعدّل ترحيلاً قديماً أبداً؛ أضف ترحيلاً جديداً في آخر القائمة.
+SCHEMA_MIGRATIONS = [
+    # 1: الجداول الأساسية (IF NOT EXISTS لتبنّي قواعد البيانات القديمة)
+    [
+        """
+        CREATE TABLE IF NOT EXISTS students (
+            id TEXT PRIMARY KEY,
+            student_name TEXT,
+            parent_number TEXT,
+            payment_amount REAL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS classes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            student_id TEXT,
+            day_of_week TEXT,
+            start_time TEXT,
+            end_time TEXT,
+            FOREIGN KEY (student_id) REFERENCES students (id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            student_id TEXT,
+            class_id INTEGER,
+            exam_grade TEXT,
+            homework_status TEXT,
+            status TEXT,
+            paid TEXT,
+            date TEXT,
+            FOREIGN KEY (student_id) REFERENCES students (id),
+            FOREIGN KEY (class_id) REFERENCES classes (id)
+        )
+        """,
+    ],
+    # 2: فهارس المسارات الساخنة + سجل واحد لكل (طالب، حصة، يوم)
+    [
+        # حذف السجلات المكررة قبل فرض التفرد، مع الإبقاء على أحدثها
+        """
+        DELETE FROM history WHERE id NOT IN (
+            SELECT MAX(id) FROM history
+            GROUP BY student_id, IFNULL(class_id, 0), date
+        )
+        """,
+        # IFNULL لأن SQLite يعتبر كل NULL قيمة مختلفة، وسجلات الدرجات
+        # بدون حصة (class_id = NULL) يجب أن تكون فريدة أيضاً
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_history_student_class_date
+        ON history (student_id, IFNULL(class_id, 0), date)
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_history_student_date ON history (student_id, date)",
+        "CREATE INDEX IF NOT EXISTS ix_history_date ON history (date)",
+        "CREATE INDEX IF NOT EXISTS ix_classes_student_day ON classes (student_id, day_of_week)",
+        "CREATE INDEX IF NOT EXISTS ix_classes_day ON classes (day_of_week)",
+    ],
+    # 3: عدادات تغيير تزيدها triggers، لمعرفة هل تغيرت البيانات دون إعادة قراءتها
+    # المفاتيح: 'history:<التاريخ>' لكل يوم، و 'students' لبيانات الطلاب
+    [
+        """
+        CREATE TABLE IF NOT EXISTS change_counters (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_history_insert_counter AFTER INSERT ON history
+        BEGIN
+            INSERT INTO change_counters (name, version) VALUES ('history:' || NEW.date, 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_history_update_counter AFTER UPDATE ON history
+        BEGIN
+            INSERT INTO change_counters (name, version) VALUES ('history:' || NEW.date, 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+            INSERT INTO change_counters (name, version)
+            SELECT 'history:' || OLD.date, 1 WHERE OLD.date IS NOT NEW.date
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_history_delete_counter AFTER DELETE ON history
+        BEGIN
+            INSERT INTO change_counters (name, version) VALUES ('history:' || OLD.date, 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_students_insert_counter AFTER INSERT ON students
+        BEGIN
+            INSERT INTO change_counters (name, version) VALUES ('students', 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_students_update_counter AFTER UPDATE ON students
+        BEGIN
+            INSERT INTO change_counters (name, version) VALUES ('students', 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_students_delete_counter AFTER DELETE ON students
+        BEGIN
+            INSERT INTO change_counters (name, version) VALUES ('students', 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+        END
+        """,
+    ],
+    # 4: بصمة آخر QR تم رسمه لكل طالب، لتخطي الرموز التي لم تتغير
+    [
+        """
+        CREATE TABLE IF NOT EXISTS qr_codes (
+            student_id TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL
+        )
+        """,
+    ],
+    # 5: حالة التطبيق الدائمة (بصمة ملف Excel...) وتنظيف الحصص المكررة
+    [
+        """
+        CREATE TABLE IF NOT EXISTS app_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+        """,
+        # كل إعادة استيراد قديمة كانت تضيف الحصص مرة أخرى؛ نحذف النسخ المطابقة
+        # التي لم يُسجل عليها أي حضور أو غياب
+        """
+        DELETE FROM classes
+        WHERE id NOT IN (
+            SELECT MIN(id) FROM classes
+            GROUP BY student_id, day_of_week, start_time, end_time
+        )
+        AND id NOT IN (SELECT class_id FROM history WHERE class_id IS NOT NULL)
+        """,
+    ],
+    # 6: سجل إضافات الطلاب (append-only) الذي يُدمج في ملف Excel على دفعات
+    [
+        """
+        CREATE TABLE IF NOT EXISTS excel_sync_journal (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            student_id TEXT,
+            student_name TEXT,
+            parent_number TEXT,
+            payment_amount REAL,
+            day_of_week TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ],
+    # 7: إيصالات المسح المرسلة من الماسح (مفتاح idempotency لكل مسح)
+    # حتى لا يُعاد تطبيق دفعة أُرسلت مرتين بعد انقطاع الشبكة
+    [
+        """
+        CREATE TABLE IF NOT EXISTS scan_receipts (
+            key TEXT PRIMARY KEY,
+            student_id TEXT,
+            scan_date TEXT,
+            result TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ],
+    # 8: عداد تغيير للحصص، ليعرف كل process متى يعيد بناء كاش الجدول الأسبوعي
+    [
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_classes_insert_counter AFTER INSERT ON classes
+        BEGIN
+            INSERT INTO change_counters (name, version) VALUES ('classes', 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_classes_update_counter AFTER UPDATE ON classes
+        BEGIN
+            INSERT INTO change_counters (name, version) VALUES ('classes', 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_classes_delete_counter AFTER DELETE ON classes
+        BEGIN
+            INSERT INTO change_counters (name, version) VALUES ('classes', 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+        END
+        """,
+    ],
+    # 9: ملخص الشهر لكل طالب، تقرأه لوحة الإدارة ورسائل التقرير الشهري
+    # بدلاً من المرور على سجل الحضور كاملاً
+    [
+        """
+        CREATE TABLE IF NOT EXISTS student_month_stats (
+            student_id TEXT NOT NULL,
+            month TEXT NOT NULL,
+            total_classes INTEGER NOT NULL DEFAULT 0,
+            present_count INTEGER NOT NULL DEFAULT 0,
+            absent_count INTEGER NOT NULL DEFAULT 0,
+            paid_sessions INTEGER NOT NULL DEFAULT 0,
+            homework_done INTEGER NOT NULL DEFAULT 0,
+            homework_not_done INTEGER NOT NULL DEFAULT 0,
+            grade_sum REAL NOT NULL DEFAULT 0,
+            grade_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (student_id, month)
+        )
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_history_insert_month_stats AFTER INSERT ON history
+        BEGIN{_month_stats_apply_sql("NEW")}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_history_delete_month_stats AFTER DELETE ON history
+        BEGIN{_month_stats_apply_sql("OLD", "-")}{_MONTH_STATS_REMOVE_EMPTY_SQL}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_history_update_month_stats
+        AFTER UPDATE OF student_id, date, status, paid, homework_status, exam_grade ON history
+        BEGIN{_month_stats_apply_sql("NEW")}{_month_stats_apply_sql("OLD", "-")}{_MONTH_STATS_REMOVE_EMPTY_SQL}
+        END
+        """,
+        "DELETE FROM student_month_stats",
+        MONTH_STATS_REBUILD_SQL,
+    ],
+    # 10: صندوق رسائل واتساب: رسالة واحدة لكل (طالب، تاريخ، نوع) مع حالتها
+    # (pending ثم opened عند فتح الرابط ثم sent بعد تأكيد الإرسال)
+    [
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            student_id TEXT NOT NULL,
+            date TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            message TEXT NOT NULL,
+            whatsapp_link TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT,
+            UNIQUE (student_id, date, kind)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_outbox_date_kind_status ON outbox (date, kind, status)",
+    ],
+    # 11: عدادات تغيير لملخصات كل شهر ('month:<YYYY-MM>') ولصندوق واتساب لكل يوم
+    # ('outbox:<التاريخ>')، يستخدمها كاش نتائج لوحة الإدارة والتقارير
+    [
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_month_stats_insert_counter AFTER INSERT ON student_month_stats
+        BEGIN
+            INSERT INTO change_counters (name, version) VALUES ('month:' || NEW.month, 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_month_stats_update_counter AFTER UPDATE ON student_month_stats
+        BEGIN
+            INSERT INTO change_counters (name, version) VALUES ('month:' || NEW.month, 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_month_stats_delete_counter AFTER DELETE ON student_month_stats
+        BEGIN
+            INSERT INTO change_counters (name, version) VALUES ('month:' || OLD.month, 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_outbox_insert_counter AFTER INSERT ON outbox
+        BEGIN
+            INSERT INTO change_counters (name, version) VALUES ('outbox:' || NEW.date, 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_outbox_update_counter AFTER UPDATE ON outbox
+        BEGIN
+            INSERT INTO change_counters (name, version) VALUES ('outbox:' || NEW.date, 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_outbox_delete_counter AFTER DELETE ON outbox
+        BEGIN
+            INSERT INTO change_counters (name, version) VALUES ('outbox:' || OLD.date, 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+        END
+        """,
+    ],
+    # 12: فهرس بحث نصي (FTS5) على اسم الطالب ورقم ولي الأمر بعد التطبيع، يُحدَّث بالـ triggers
+    _STUDENTS_FTS_SCHEMA,
+    # 13: مهام الخلفية (استيراد Excel، رموز QR، ملفات التقارير...) وحالتها وتقدمها والملف الناتج
+    [
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            params TEXT NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'queued',
+            progress INTEGER NOT NULL DEFAULT 0,
+            total INTEGER,
+            message TEXT,
+            result TEXT,
+            artifact TEXT,
+            next_url TEXT,
+            created_by TEXT,
+            pid INTEGER,
+            created_at TEXT,
+            started_at TEXT,
+            updated_at TEXT,
+            finished_at TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_jobs_status_kind ON jobs (status, kind)",
+    ],
+    # 14: تاريخ إضافة الطالب، حتى لا يُسجل له غياب في أيام قبل وجوده.
+    # الطلاب الحاليون يأخذون تاريخ أول سجل لهم (أو يبقى NULL إذا لم يكن لهم سجلات)
+    [
+        "ALTER TABLE students ADD COLUMN added_on TEXT",
+        "UPDATE students SET added_on = (SELECT MIN(date) FROM history WHERE history.student_id = students.id)",
+    ],
+    # 15: إعادة بناء فهرس البحث مربوطاً بكود الطالب بدلاً من rowid (الإصدار 12 القديم كان يعتمد على rowid)
+    [
+        "DROP TRIGGER IF EXISTS trg_students_fts_insert",
+        "DROP TRIGGER IF EXISTS trg_students_fts_update",
+        "DROP TRIGGER IF EXISTS trg_students_fts_delete",
+        "DROP TABLE IF EXISTS students_fts",
+        *_STUDENTS_FTS_SCHEMA,
+    ],
+]
+
+SCHEMA_VERSION = len(SCHEMA_MIGRATIONS)
+
+def migrate_db(conn):
+    """تطبيق الترحيلات الناقصة بالترتيب، كل ترحيل في معاملة مستقلة"""
+    current_version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+    for version in range(current_version + 1, SCHEMA_VERSION + 1):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for statement in SCHEMA_MIGRATIONS[version - 1]:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"✅ تم تطبيق ترحيل قاعدة البيانات رقم {version}")
 
-    conn.commit()
-    conn.close()
-    print("✅ تم إنشاء/التأكد من جميع الجداول في قاعدة البيانات")
+    return max(current_version, SCHEMA_VERSION)
 
-def init_db_from_excel():
-    """تهيئة قاعدة البيانات من ملف Excel"""
+def init_tables():
+    """تحديث هيكل قاعدة البيانات إلى آخر إصدار"""
+    conn = open_db()
+    version = migrate_db(conn)
+    print(f"✅ قاعدة البيانات محدثة (إصدار الهيكل {version})")
+
+def get_app_state(key, default=None):
+    """قراءة قيمة محفوظة في جدول app_state (كـ JSON)"""
+    row = open_db().execute("SELECT value FROM app_state WHERE key=?", (key,)).fetchone()
+    return json.loads(row["value"]) if row else default
+
+def set_app_state(key, value):
+    """حفظ قيمة في app_state داخل المعاملة الحالية (الحفظ النهائي على المستدعي)"""
+    open_db().execute("""
+        INSERT INTO app_state (key, value) VALUES (?, ?)
+        ON CONFLICT (key) DO UPDATE SET value=excluded.value
+    """, (key, json.dumps(value)))
+
+def get_change_token(*names):
+    """قيم عدادات التغيير المطلوبة؛ تتغير القيمة مع أي كتابة على البيانات المقابلة"""
+    conn = open_db()
+    placeholders = ",".join("?" * len(names))
+    cursor = conn.execute(
+        f"SELECT name, version FROM change_counters WHERE name IN ({placeholders})", names
+    )
+    versions = dict(cursor.fetchall())
+    return tuple(versions.get(name, 0) for name in names)
+
+def excel_fingerprint(path, previous=None):
+    """بصمة ملف Excel: الحجم ووقت التعديل وhash المحتوى.
+    لا نعيد حساب الـ hash إذا لم يتغير الحجم ووقت التعديل."""
+    stat = os.stat(path)
+    fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime}
+
+    if previous and previous.get("size") == stat.st_size and previous.get("mtime") == stat.st_mtime:
+        fingerprint["sha256"] = previous.get("sha256")
+        return fingerprint
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    fingerprint["sha256"] = digest.hexdigest()
+    return fingerprint
+
+def init_db_from_excel(force=False, with_qr=True, progress=None):
+    """تهيئة قاعدة البيانات من ملف Excel (يتم تخطي الملف إذا لم يتغير منذ آخر استيراد)
+    progress(تم، الإجمالي) تُستدعى أثناء إنشاء رموز QR"""
     if not os.path.exists(EXCEL_PATH):
         print(f"⚠️  تحذير: ملف {EXCEL_PATH} غير موجود")
         print("📝 الرجاء إنشاء ملف Excel بالهيكل التالي:")
         print("   الأعمدة: id, student_name, parent_number, payment_amount, day_of_week")
-        return
+        return None
+
+    conn = open_db()
 
     try:
+        previous = get_app_state("excel_fingerprint")
+        fingerprint = excel_fingerprint(EXCEL_PATH, previous)
+
+        if not force and previous and previous.get("sha256") == fingerprint["sha256"]:
+            if previous != fingerprint:
+                set_app_state("excel_fingerprint", fingerprint)
+                conn.commit()
+            print("✅ ملف Excel لم يتغير منذ آخر استيراد، تم التخطي")
+            return {"skipped": True, "students": 0, "classes": 0, "qr_generated": 0}
+
         from openpyxl import load_workbook
 
-        workbook = load_workbook(EXCEL_PATH)
-        sheet = workbook.active
+        # وضع القراءة فقط يقرأ الصفوف كـ stream بدلاً من تحميل الملف كاملاً
+        workbook = load_workbook(EXCEL_PATH, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            headers = next(rows, ())
 
-        headers = [cell.value for cell in sheet[1]]
+            students = {}
+            sheet_days = {}
+            for row in rows:
+                if not row or not row[0]:
+                    continue
 
-        conn = open_db()
+                student_data = dict(zip(headers, row))
+                student_id = str(student_data['id'])
+
+                students[student_id] = (
+                    student_id,
+                    str(student_data.get('student_name', '')),
+                    str(student_data.get('parent_number', '')),
+                    float(student_data.get('payment_amount') or 0)
+                )
+
+                day_of_week = student_data.get('day_of_week')
+                days = sheet_days.setdefault(student_id, set())
+                if day_of_week:
+                    days.add(str(day_of_week).strip().lower())
+        finally:
+            workbook.close()
+
+        # الحصص كفرق بين الملف وقاعدة البيانات: نضيف الأيام الناقصة فقط.
+        # لا نحذف أياماً غير موجودة في الملف لأنها قد تكون مضافة من صفحة إدارة الطلاب.
+        existing_days = {}
+        for row in conn.execute("SELECT student_id, day_of_week FROM classes"):
+            existing_days.setdefault(row["student_id"], set()).add(row["day_of_week"])
+
+        new_classes = [
+            (student_id, day, "09:00", "10:00")
+            for student_id, days in sheet_days.items()
+            for day in sorted(days - existing_days.get(student_id, set()))
+        ]
+
+        conn.executemany("""
+            INSERT INTO students (id, student_name, parent_number, payment_amount, added_on)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET
+                student_name=excluded.student_name,
+                parent_number=excluded.parent_number,
+                payment_amount=excluded.payment_amount
+            WHERE students.student_name IS NOT excluded.student_name
+               OR students.parent_number IS NOT excluded.parent_number
+               OR students.payment_amount IS NOT excluded.payment_amount
+        """, [(*student, today_str()) for student in students.values()])
+        conn.executemany("""
+            INSERT INTO classes (student_id, day_of_week, start_time, end_time)
+            VALUES (?, ?, ?, ?)
+        """, new_classes)
+        set_app_state("excel_fingerprint", fingerprint)
+        conn.commit()
+        invalidate_schedule_cache()
 
-        students_added = 0
-        classes_added = 0
+        print(f"✅ تم تحميل بيانات {len(students)} طالب و {len(new_classes)} حصة جديدة من ملف Excel")
 
-        for row in sheet.iter_rows(min_row=2, values_only=True):
-            if not row[0]:
-                continue
+        qr_generated = 0
+        if with_qr:
+            qr_generated = generate_qr_codes(students.keys(), progress=progress)["generated"]
+            print(f"✅ تم إنشاء {qr_generated} رمز QR")
 
-            student_data = dict(zip(headers, row))
+        return {
+            "skipped": False,
+            "students": len(students),
+            "classes": len(new_classes),
+            "qr_generated": qr_generated,
+        }
 
-            conn.execute("""
-                INSERT OR REPLACE INTO students (id, student_name, parent_number, payment_amount)
-                VALUES (?, ?, ?, ?)
-            """, (
-                str(student_data.get('id', '')),
-                str(student_data.get('student_name', '')),
-                str(student_data.get('parent_number', '')),
-                float(student_data.get('payment_amount', 0))
-            ))
-            students_added += 1
+    except Exception as e:
+        conn.rollback()
+        print(f"❌ خطأ في تحميل بيانات Excel: {e}")
+        return None
 
-            day_of_week = student_data.get('day_of_week')
+# ---------- Result cache ----------
+# نتائج الصفحات الثقيلة محفوظة في ذاكرة الـ process بمفتاح (الصفحة، الشهر/اليوم)
+# مع قيم عدادات التغيير وقت الحساب؛ أي كتابة على البيانات تغير العداد فيُعاد الحساب
+# مرة واحدة فقط. الحجم محدود ويُحذف الأقدم استخداماً (LRU).
+RESULT_CACHE_SIZE = 64
+
+class ResultCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (view, key) -> (token, value)
+        self._lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+
+    def get(self, view, key, counters, compute):
+        """القيمة المحفوظة إذا لم تتغير العدادات، وإلا compute() وحفظ نتيجتها"""
+        # نقرأ العدادات قبل الحساب: أي كتابة أثناء الحساب تجعل المرة القادمة miss
+        token = get_change_token(*counters)
+        cache_key = (view, key)
+
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and entry[0] == token:
+                self._entries.move_to_end(cache_key)
+                self.hits[view] = self.hits.get(view, 0) + 1
+                return entry[1]
+            self.misses[view] = self.misses.get(view, 0) + 1
+
+        value = compute()
+
+        with self._lock:
+            self._entries[cache_key] = (token, value)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": dict(self.hits), "misses": dict(self.misses)}
+
+result_cache = ResultCache(RESULT_CACHE_SIZE)
+
+# ---------- Excel Sync ----------
+# قاعدة البيانات هي المرجع الأساسي. الإضافات تُسجل في excel_sync_journal داخل
+# نفس معاملة الإضافة، ثم تُدمج في ملف Excel في الخلفية بحفظ واحد لكل دفعة.
+# آخر سجل تم دمجه محفوظ في app_state تحت excel_sync_last_id.
+EXCEL_HEADERS = ['id', 'student_name', 'parent_number', 'payment_amount', 'day_of_week']
+EXCEL_SYNC_DELAY_SECONDS = 5
+
+_excel_sync_lock = threading.Lock()
+_excel_sync_requested = False
+_excel_sync_running = False
+
+def journal_excel_rows(conn, rows):
+    """تسجيل صفوف Excel جديدة في السجل (بدون commit؛ جزء من معاملة المستدعي)"""
+    conn.executemany("""
+        INSERT INTO excel_sync_journal (student_id, student_name, parent_number, payment_amount, day_of_week)
+        VALUES (?, ?, ?, ?, ?)
+    """, rows)
+
+def sync_excel_journal():
+    """دمج ما لم يُدمج من السجل في ملف Excel بحفظ write-only واحد"""
+    lock_file = acquire_process_lock("excel_sync")
+    if lock_file is None:
+        return None
 
-            if day_of_week:
-                day_of_week = str(day_of_week).strip().lower()
+    try:
+        conn = open_db()
+        last_id = get_app_state("excel_sync_last_id", 0)
+        entries = conn.execute(
+            "SELECT * FROM excel_sync_journal WHERE id > ? ORDER BY id", (last_id,)
+        ).fetchall()
+        if not entries:
+            return 0
 
-                conn.execute("""
-                    INSERT INTO classes (student_id, day_of_week, start_time, end_time)
-                    VALUES (?, ?, ?, ?)
-                """, (str(student_data['id']), day_of_week, "09:00", "10:00"))
-                classes_added += 1
+        from openpyxl import Workbook, load_workbook
 
-        conn.commit()
-        conn.close()
+        # إذا عُدّل الملف يدوياً منذ آخر استيراد نستورده أولاً حتى لا تضيع التعديلات
+        if os.path.exists(EXCEL_PATH):
+            init_db_from_excel()
 
-        qr_created = 0
-        workbook = load_workbook(EXCEL_PATH)
-        sheet = workbook.active
-        for row in sheet.iter_rows(min_row=2, values_only=True):
-            if row[0]:
-                student_id = str(row[0])
-                if generate_qr(student_id):
-                    qr_created += 1
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
 
-        print(f"✅ تم تحميل بيانات {students_added} طالب و {classes_added} حصة من ملف Excel")
-        print(f"✅ تم إنشاء {qr_created} رمز QR")
+        if os.path.exists(EXCEL_PATH):
+            source = load_workbook(EXCEL_PATH, read_only=True)
+            try:
+                sheet.title = source.active.title
+                for row in source.active.iter_rows(values_only=True):
+                    sheet.append(row)
+            finally:
+                source.close()
+        else:
+            sheet.append(EXCEL_HEADERS)
+
+        for entry in entries:
+            sheet.append([
+                entry["student_id"], entry["student_name"], entry["parent_number"],
+                entry["payment_amount"], entry["day_of_week"],
+            ])
+
+        # الكتابة في ملف مؤقت ثم الاستبدال، حتى لا يرى أحد ملفاً نصف مكتوب
+        tmp_path = f"{EXCEL_PATH}.tmp"
+        workbook.save(tmp_path)
+        os.replace(tmp_path, EXCEL_PATH)
+
+        set_app_state("excel_sync_last_id", entries[-1]["id"])
+        # الملف الجديد يطابق قاعدة البيانات، فلا داعي لاستيراده مرة أخرى
+        set_app_state("excel_fingerprint", excel_fingerprint(EXCEL_PATH))
+        conn.commit()
 
-    except Exception as e:
-        print(f"❌ خطأ في تحميل بيانات Excel: {e}")
+        print(f"✅ تم دمج {len(entries)} صف في ملف Excel")
+        return len(entries)
+    finally:
+        release_process_lock(lock_file)
+
+def _excel_sync_worker():
+    global _excel_sync_requested, _excel_sync_running
+    while True:
+        # ننتظر قليلاً لتجميع الإضافات المتتالية في حفظ واحد
+        time.sleep(EXCEL_SYNC_DELAY_SECONDS)
+        with _excel_sync_lock:
+            if not _excel_sync_requested:
+                _excel_sync_running = False
+                return
+            _excel_sync_requested = False
+        try:
+            sync_excel_journal()
+        except Exception as e:
+            print(f"⚠️  تحذير: فشل دمج التعديلات في ملف Excel: {e}")
+
+def schedule_excel_sync():
+    """طلب دمج السجل في ملف Excel في الخلفية"""
+    global _excel_sync_requested, _excel_sync_running
+    with _excel_sync_lock:
+        _excel_sync_requested = True
+        if _excel_sync_running:
+            return
+        _excel_sync_running = True
+    threading.Thread(target=_excel_sync_worker, name="excel-sync", daemon=True).start()
+
+def write_roster_workbook(target):
+    """تصدير كل الطلاب وحصصهم من قاعدة البيانات إلى Excel (write-only)"""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(EXCEL_HEADERS)
+
+    cursor = open_db().execute("""
+        SELECT s.id, s.student_name, s.parent_number, s.payment_amount, c.day_of_week
+        FROM students s
+        LEFT JOIN classes c ON c.student_id = s.id
+        ORDER BY s.rowid, c.id
+    """)
+    for row in cursor:
+        sheet.append(list(row))
+
+    workbook.save(target)
 
 # ---------- Class Management ----------
+# كاش الجدول الأسبوعي على مستوى الـ process: {student_id: {day_of_week: (حصة, ...)}}
+# كل حصة tuple بترتيب _CLASS_FIELDS، والحصص مرتبة بالـ id كما في الجدول.
+# يُلغى عند أي تعديل على الحصص من هذا الـ process، ويُعاد بناؤه أيضاً إذا تغير
+# عداد 'classes' (تعديل من process آخر). العداد يُفحص مرة واحدة فقط لكل طلب.
+_CLASS_FIELDS = ("id", "student_id", "day_of_week", "start_time", "end_time")
+
+# فهرس الفترات: لكل (طالب، يوم) الحصص مرتبة بوقت البداية مع قائمة أوقات البداية
+# بالدقائق، فيتم تحديد الحصة الجارية وقت المسح بالبحث الثنائي (bisect).
+# إذا لم تكن هناك حصة جارية يُنسب المسح لأقرب حصة يقع بين (بدايتها - السماح المبكر)
+# و (نهايتها + السماح المتأخر).
+# خارج كل الفترات: في الوضع العادي تُنسب لأقرب حصة في اليوم (حتى لا نرفض مسحاً
+# لحصص أوقاتها غير مضبوطة)، وفي الوضع الصارم لا تُنسب لأي حصة.
+SESSION_EARLY_GRACE_MINUTES = int(os.environ.get("ATTENDANCE_EARLY_GRACE_MINUTES", "30"))
+SESSION_LATE_GRACE_MINUTES = int(os.environ.get("ATTENDANCE_LATE_GRACE_MINUTES", "30"))
+SESSION_STRICT_WINDOW = os.environ.get("ATTENDANCE_STRICT_SESSION_WINDOW", "0") == "1"
+
+_schedule_cache = None  # (version, schedule, sessions)
+_schedule_cache_lock = threading.Lock()
+
+def invalidate_schedule_cache():
+    """إلغاء كاش الجدول بعد أي تعديل على جدول الحصص"""
+    global _schedule_cache
+    _schedule_cache = None
+
+def _time_to_minutes(value, default):
+    try:
+        hours, minutes = str(value).split(":")[:2]
+        return int(hours) * 60 + int(minutes)
+    except (TypeError, ValueError):
+        return default
+
+def _build_schedule_cache(version):
+    schedule = {}
+    cursor = open_db().execute(f"SELECT {', '.join(_CLASS_FIELDS)} FROM classes ORDER BY id")
+    for row in cursor:
+        schedule.setdefault(row["student_id"], {}).setdefault(row["day_of_week"], []).append(tuple(row))
+
+    sessions = {}
+    for student_id, days in schedule.items():
+        for day, classes in days.items():
+            days[day] = tuple(classes)
+            intervals = sorted(
+                (_time_to_minutes(row[3], 0), _time_to_minutes(row[4], 24 * 60), row)
+                for row in classes
+            )
+            sessions[(student_id, day)] = (tuple(start for start, _, _ in intervals), tuple(intervals))
+
+    return (version, schedule, sessions)
+
+def _get_schedule_cache():
+    global _schedule_cache
+    cache = _schedule_cache
+    if cache is not None and has_app_context() and g.get("schedule_checked"):
+        return cache
+
+    version = get_change_token("classes")[0]
+    if has_app_context():
+        g.schedule_checked = True
+    if cache is not None and cache[0] == version:
+        return cache
+
+    with _schedule_cache_lock:
+        cache = _schedule_cache
+        if cache is None or cache[0] != version:
+            cache = _schedule_cache = _build_schedule_cache(version)
+    return cache
+
+def _get_schedule():
+    return _get_schedule_cache()[1]
+
+def _class_dict(class_row):
+    return dict(zip(_CLASS_FIELDS, class_row))
+
 def get_student_classes(student_id):
     """جلب جميع حصص الطالب"""
-    conn = open_db()
-    cursor = conn.execute("SELECT * FROM classes WHERE student_id=?", (student_id,))
-    classes = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return classes
-
-def get_current_class(student_id):
-    """الحصول على الحصة الحالية للطالب بناءً على اليوم فقط"""
-    conn = open_db()
-    current_day = datetime.now().strftime("%A").lower()
+    days = _get_schedule().get(student_id, {})
+    classes = sorted((row for rows in days.values() for row in rows), key=itemgetter(0))
+    return [_class_dict(row) for row in classes]
+
+def resolve_session(student_id, at, nearest=None):
+    """الحصة التي يخص المسح في الوقت at (أو None إذا لم يكن للطالب حصة في هذا اليوم)"""
+    index = _get_schedule_cache()[2].get((student_id, at.strftime("%A").lower()))
+    if not index:
+        return None
 
-    cursor = conn.execute("""
-        SELECT * FROM classes
-        WHERE student_id=? AND day_of_week=?
-    """, (student_id, current_day))
+    starts, intervals = index
+    minute = at.hour * 60 + at.minute
+
+    # حصة يقع المسح داخلها فعلاً؛ عند التداخل الأحدث بداية
+    for candidate in range(bisect_right(starts, minute) - 1, -1, -1):
+        start, end, row = intervals[candidate]
+        if minute <= end:
+            return row
+
+    def distance(interval):
+        # بعد المسح عن الحصة، وعند التساوي الحصة القادمة قبل المنتهية
+        start, end, _ = interval
+        return (start - minute if minute < start else minute - end, -start)
+
+    # لا حصة جارية: أقرب حصة يقع المسح في فترة السماح قبلها أو بعدها
+    within_grace = [
+        interval for interval in intervals
+        if interval[0] - SESSION_EARLY_GRACE_MINUTES <= minute <= interval[1] + SESSION_LATE_GRACE_MINUTES
+    ]
+    if within_grace:
+        return min(within_grace, key=distance)[2]
+
+    if nearest is None:
+        nearest = not SESSION_STRICT_WINDOW
+    if not nearest:
+        return None
+    return min(intervals, key=distance)[2]
 
-    class_row = cursor.fetchone()
+def get_current_class(student_id, at=None, nearest=None):
+    """الحصة الحالية للطالب حسب اليوم ووقت المسح (الآن افتراضياً)"""
+    class_row = resolve_session(student_id, at or current_time(), nearest)
     if class_row:
-        conn.close()
-        return dict(class_row)
+        return _class_dict(class_row)
 
-    conn.close()
     return None
 
 def is_class_today(student_id):
     """التحقق إذا كان الطالب لديه حصة اليوم"""
-    return get_current_class(student_id) is not None
+    current_day = current_time().strftime("%A").lower()
+    return bool(_get_schedule().get(student_id, {}).get(current_day))
 
 def get_today_classes(student_id):
     """جلب حصص الطالب لليوم الحالي"""
-    conn = open_db()
-    current_day = datetime.now().strftime("%A").lower()
-    cursor = conn.execute("""
-        SELECT * FROM classes
-        WHERE student_id=? AND day_of_week=?
-    """, (student_id, current_day))
-
-    classes = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return classes
+    current_day = current_time().strftime("%A").lower()
+    classes = _get_schedule().get(student_id, {}).get(current_day, ())
+    return [_class_dict(row) for row in classes]
 
 def get_weekly_classes(student_id):
     """جلب جميع حصص الطالب للأسبوع"""
-    conn = open_db()
-    cursor = conn.execute("SELECT * FROM classes WHERE student_id=? ORDER BY day_of_week", (student_id,))
-    classes = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return classes
+    return sorted(get_student_classes(student_id), key=itemgetter("day_of_week"))
 
 # ---------- QR generation ----------
-def generate_qr(student_id):
-    """إنشاء QR Code"""
-    try:
-        import qrcode
-        
-        # إنشاء QR code محلياً
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        
-        # استخدام رابط PythonAnywhere
-        link = f"https://{PC_IP}/student/{student_id}"
-        qr.add_data(link)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
+# أي تغيير في هذه الإعدادات (أو في PC_IP) يغير البصمة فيُعاد رسم كل الرموز
+QR_RENDER_SETTINGS = {
+    "version": 1,
+    "error_correction": "L",
+    "box_size": 10,
+    "border": 4,
+    "fill_color": "black",
+    "back_color": "white",
+}
+QR_POOL_MIN_BATCH = 16
+QR_POOL_MAX_WORKERS = 4
+
+def qr_link(student_id):
+    """الرابط المشفر داخل QR الطالب"""
+    return f"https://{PC_IP}/student/{student_id}"
+
+def qr_fingerprint(student_id):
+    """بصمة محتوى QR: الرابط + إعدادات الرسم"""
+    settings = ",".join(f"{key}={value}" for key, value in sorted(QR_RENDER_SETTINGS.items()))
+    return hashlib.sha256(f"{qr_link(student_id)}|{settings}".encode("utf-8")).hexdigest()
+
+def _render_qr(student_id):
+    """رسم QR واحد وحفظه (تعمل داخل process منفصل، لذلك لا تلمس قاعدة البيانات)"""
+    import qrcode
+
+    qr = qrcode.QRCode(
+        version=QR_RENDER_SETTINGS["version"],
+        error_correction=getattr(qrcode.constants, f"ERROR_CORRECT_{QR_RENDER_SETTINGS['error_correction']}"),
+        box_size=QR_RENDER_SETTINGS["box_size"],
+        border=QR_RENDER_SETTINGS["border"],
+    )
+    qr.add_data(qr_link(student_id))
+    qr.make(fit=True)
+
+    img = qr.make_image(fill_color=QR_RENDER_SETTINGS["fill_color"], back_color=QR_RENDER_SETTINGS["back_color"])
+    img.save(os.path.join(QR_DIR, f"{student_id}.png"))
+    return student_id
+
+def _render_qr_batch(student_ids, progress=None):
+    """رسم مجموعة رموز؛ بالتوازي عبر process pool للدفعات الكبيرة"""
+    rendered, failed = [], []
+    remaining = list(student_ids)
+
+    def report():
+        if progress:
+            progress(len(rendered) + len(failed), len(student_ids))
+
+    if len(remaining) >= QR_POOL_MIN_BATCH:
+        try:
+            workers = min(QR_POOL_MAX_WORKERS, os.cpu_count() or 1)
+            # spawn لا fork: الخادم متعدد الخيوط، و fork قد ينسخ قفلاً ممسوكاً (مثل قفل import) فيتجمد الـ process
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                futures = {pool.submit(_render_qr, student_id): student_id for student_id in remaining}
+                for future in as_completed(futures):
+                    student_id = futures[future]
+                    try:
+                        future.result()
+                        rendered.append(student_id)
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        print(f"❌ خطأ في إنشاء QR للطالب {student_id}: {e}")
+                        failed.append(student_id)
+                    report()
+            return rendered, failed
+        except (OSError, BrokenProcessPool) as e:
+            # بعض الاستضافات تمنع إنشاء processes؛ نكمل ما تبقى بالتتابع
+            print(f"⚠️  تعذر استخدام process pool لرموز QR، سيتم الرسم بالتتابع: {e}")
+            done = set(rendered) | set(failed)
+            remaining = [student_id for student_id in remaining if student_id not in done]
+
+    for student_id in remaining:
+        try:
+            _render_qr(student_id)
+            rendered.append(student_id)
+        except Exception as e:
+            print(f"❌ خطأ في إنشاء QR للطالب {student_id}: {e}")
+            failed.append(student_id)
+        report()
+
+    return rendered, failed
+
+def generate_qr_codes(student_ids, force=False, progress=None):
+    """إنشاء رموز QR للطلاب، مع تخطي من لم تتغير بصمته وملفه موجود
+    progress(تم، الإجمالي) تُستدعى بعد كل رمز يُرسم"""
+    conn = open_db()
+    stored = dict(conn.execute("SELECT student_id, fingerprint FROM qr_codes").fetchall())
+
+    fingerprints = {}
+    pending = []
+    skipped = 0
+    for student_id in dict.fromkeys(str(student_id) for student_id in student_ids):
+        fingerprint = qr_fingerprint(student_id)
         path = os.path.join(QR_DIR, f"{student_id}.png")
-        img.save(path)
-        
-        print(f"✅ تم إنشاء QR للطالب {student_id}")
-        return path
-    except Exception as e:
-        print(f"❌ خطأ في إنشاء QR للطالب {student_id}: {e}")
+        if not force and stored.get(student_id) == fingerprint and os.path.exists(path):
+            skipped += 1
+            continue
+        fingerprints[student_id] = fingerprint
+        pending.append(student_id)
+
+    rendered, failed = _render_qr_batch(pending, progress) if pending else ([], [])
+
+    if rendered:
+        conn.executemany("""
+            INSERT INTO qr_codes (student_id, fingerprint) VALUES (?, ?)
+            ON CONFLICT (student_id) DO UPDATE SET fingerprint=excluded.fingerprint
+        """, [(student_id, fingerprints[student_id]) for student_id in rendered])
+        conn.commit()
+
+    print(f"✅ رموز QR: تم إنشاء {len(rendered)}، تم تخطي {skipped}، فشل {len(failed)}")
+    return {"generated": len(rendered), "skipped": skipped, "failed": len(failed)}
+
+def generate_qr(student_id):
+    """إنشاء QR Code لطالب واحد (إن لزم) وإرجاع مساره"""
+    result = generate_qr_codes([student_id])
+    if result["failed"]:
         return None
+    return os.path.join(QR_DIR, f"{student_id}.png")
 
 # ---------- Routes للتحكم عن بعد ----------
 @app.route("/remote_scanner")
@@ -280,14 +1459,20 @@ def remote_scanner():
     return render_template("remote_scanner.html", ip=PC_IP)
 
 # ---------- WhatsApp Messages ----------
-def generate_whatsapp_link(student_data):
-    """إنشاء رابط واتساب ويب لرسالة الغياب"""
-    try:
-        student_name = student_data['student_name']
-        parent_number = student_data['parent_number']
-        date = today_str()
+def whatsapp_web_link(parent_number, message):
+    """رابط واتساب ويب لرسالة جاهزة (أو None إذا كان الرقم غير صالح)"""
+    phone_number = ''.join(filter(str.isdigit, str(parent_number)))
+    if not phone_number:
+        return None
 
-        message = f"""
+    if not phone_number.startswith('+'):
+        phone_number = '+2' + phone_number
+
+    return f"https://web.whatsapp.com/send?phone={phone_number}&text={quote(message)}"
+
+def absence_message(student_name, date):
+    """نص رسالة الغياب لولي الأمر"""
+    return f"""
 تنبيه غياب
 عزيزي ولي الأمر،
 الطالب/ة {student_name} لم يحضر الحصة اليوم {date}.
@@ -298,18 +1483,16 @@ def generate_whatsapp_link(student_data):
 الإدارة
         """.strip()
 
-        phone_number = ''.join(filter(str.isdigit, str(parent_number)))
+def generate_whatsapp_link(student_data, date=None):
+    """إنشاء رابط واتساب ويب لرسالة الغياب"""
+    try:
+        student_name = student_data['student_name']
+        whatsapp_link = whatsapp_web_link(
+            student_data['parent_number'], absence_message(student_name, date or today_str())
+        )
 
-        if not phone_number:
+        if not whatsapp_link:
             print(f"❌ رقم ولي الأمر غير صالح للطالب {student_name}")
-            return None
-
-        if not phone_number.startswith('+'):
-            phone_number = '+2' + phone_number
-
-        encoded_message = quote(message)
-        whatsapp_link = f"https://web.whatsapp.com/send?phone={phone_number}&text={encoded_message}"
-
         return whatsapp_link
 
     except Exception as e:
@@ -325,21 +1508,22 @@ def generate_detailed_monthly_report_message(student_id, month_str=None):
     cursor = conn.execute("SELECT * FROM students WHERE id=?", (student_id,))
     student_row = cursor.fetchone()
     if not student_row:
-        conn.close()
         return None
 
-    student_data = dict(student_row)
-
+    month_start, month_end = month_date_range(month_str)
     cursor = conn.execute(
-        "SELECT * FROM history WHERE student_id=? AND date LIKE ? ORDER BY date ASC",
-        (student_id, f"{month_str}-%")
+        "SELECT * FROM history WHERE student_id=? AND date >= ? AND date < ? ORDER BY date ASC",
+        (student_id, month_start, month_end)
     )
-    history_rows = [dict(row) for row in cursor.fetchall()]
-    conn.close()
 
-    total_classes = len(history_rows)
-    present_count = len([h for h in history_rows if h['status'] == 'Present'])
-    absent_count = len([h for h in history_rows if h['status'] == 'Absent'])
+    return format_monthly_report_message(
+        dict(student_row), get_month_stats(student_id, month_str), cursor, month_str
+    )
+
+def format_monthly_report_message(student_data, stats, history_rows, month_str):
+    """نص رسالة التقرير الشهري من ملخص الشهر وحصص الطالب مرتبة بالتاريخ"""
+    total_classes = stats['total_classes']
+    present_count = stats['present_count']
 
     if total_classes > 0:
         attendance_rate = (present_count / total_classes) * 100
@@ -347,40 +1531,21 @@ def generate_detailed_monthly_report_message(student_id, month_str=None):
         attendance_rate = 0
 
     payment_amount = student_data.get('payment_amount', 0)
-    paid_sessions = [h for h in history_rows if h['paid'] == 'Yes']
-    paid_amount = len(paid_sessions) * float(payment_amount)
+    paid_amount = stats['paid_sessions'] * float(payment_amount or 0)
 
-    exam_grades = [h['exam_grade'] for h in history_rows if h['exam_grade'] != '-']
-    if exam_grades:
-        try:
-            grades_numeric = []
-            for grade in exam_grades:
-                try:
-                    grades_numeric.append(float(grade))
-                except:
-                    continue
-
-            if grades_numeric:
-                avg_grade = sum(grades_numeric) / len(grades_numeric)
-                avg_grade = f"{avg_grade:.1f}"
-            else:
-                avg_grade = "لا توجد درجات"
-        except:
-            avg_grade = "لا توجد درجات"
+    if stats['grade_count']:
+        avg_grade = f"{stats['grade_sum'] / stats['grade_count']:.1f}"
     else:
         avg_grade = "لا توجد درجات"
 
-    homework_done = len([h for h in history_rows if h['homework_status'] == 'اتعمل'])
-    homework_not_done = len([h for h in history_rows if h['homework_status'] == 'متعملش'])
-
-    message = f"""
+    parts = [f"""
 📊 **التقرير الشهري للطالب/ة {student_data['student_name']}**
 🗓️ **الشهر:** {month_str}
 
 **📈 الإحصائيات العامة:**
 • إجمالي الحصص: {total_classes}
 • عدد الحضور: {present_count}
-• عدد الغياب: {absent_count}
+• عدد الغياب: {stats['absent_count']}
 • معدل الحضور: {attendance_rate:.1f}%
 
 **💰 الجانب المالي:**
@@ -389,24 +1554,23 @@ def generate_detailed_monthly_report_message(student_id, month_str=None):
 
 **📚 الأداء الأكاديمي:**
 • متوسط الدرجات: {avg_grade}
-• الواجبات المنجزة: {homework_done}
-• الواجبات غير المنجزة: {homework_not_done}
+• الواجبات المنجزة: {stats['homework_done']}
+• الواجبات غير المنجزة: {stats['homework_not_done']}
 
 **📅 تفاصيل الحصص:**
-"""
+"""]
 
     for session in history_rows:
         status_icon = "✅" if session['status'] == 'Present' else "❌"
         homework_icon = "✅" if session['homework_status'] == 'اتعمل' else "❌" if session['homework_status'] == 'متعملش' else "➖"
         paid_icon = "💰" if session['paid'] == 'Yes' else "❌"
 
-        message += f"\n{status_icon} {session['date']}: "
-        message += f"امتحان({session['exam_grade']}) "
-        message += f"واجب{homework_icon} "
-        message += f"دفع{paid_icon}"
+        parts.append(
+            f"\n{status_icon} {session['date']}: امتحان({session['exam_grade']}) واجب{homework_icon} دفع{paid_icon}"
+        )
 
-    message += "\n\nمع تحيات الإدارة 🏫"
-    return message
+    parts.append("\n\nمع تحيات الإدارة 🏫")
+    return "".join(parts)
 
 def generate_present_student_message(student_data):
     """إنشاء رسالة واتساب للطالب الحاضر"""
@@ -448,17 +1612,10 @@ def generate_present_student_message(student_data):
 الإدارة
         """.strip()
 
-        phone_number = ''.join(filter(str.isdigit, str(parent_number)))
+        whatsapp_link = whatsapp_web_link(parent_number, message)
 
-        if not phone_number:
+        if not whatsapp_link:
             print(f"❌ رقم ولي الأمر غير صالح للطالب {student_name}")
-            return None
-
-        if not phone_number.startswith('+'):
-            phone_number = '+2' + phone_number
-
-        encoded_message = quote(message)
-        whatsapp_link = f"https://web.whatsapp.com/send?phone={phone_number}&text={encoded_message}"
 
         return whatsapp_link
 
@@ -466,243 +1623,1003 @@ def generate_present_student_message(student_data):
         print(f"❌ خطأ في إنشاء رابط واتساب للطالب الحاضر: {e}")
         return None
 
-def check_and_generate_whatsapp_links():
-    """التحقق من الغياب وإنشاء روابط واتساب"""
-    print("🔍 جاري فحص الغياب وإنشاء روابط واتساب...")
+OUTBOX_STATUSES = ("pending", "opened", "sent")
+
+def check_and_generate_whatsapp_links(date=None):
+    """تحديث صندوق رسائل الغياب لليوم: إضافة الطلاب الغائبين الجدد فقط،
+    وحذف الرسائل غير المفتوحة لمن سجل حضوره بعد ذلك"""
+    print("🔍 جاري فحص الغياب وتحديث صندوق رسائل واتساب...")
 
     conn = open_db()
-    date = today_str()
+    date = date or today_str()
+    day_of_week = datetime.strptime(date, "%Y-%m-%d").strftime("%A").lower()
+    added = 0
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # طلاب لهم حصة في هذا اليوم ولم يُسجل لهم حضور، وليس لهم رسالة بعد
+        # (ومثل mark_absent_for_range: لا غياب قبل تاريخ إضافة الطالب)
+        cursor = conn.execute("""
+            SELECT s.id, s.student_name, s.parent_number
+            FROM students s
+            WHERE EXISTS (SELECT 1 FROM classes c WHERE c.student_id = s.id AND c.day_of_week = ?)
+            AND (s.added_on IS NULL OR s.added_on <= ?)
+            AND NOT EXISTS (
+                SELECT 1 FROM history h
+                WHERE h.student_id = s.id AND h.date = ? AND h.status = 'Present'
+            )
+            AND NOT EXISTS (
+                SELECT 1 FROM outbox o
+                WHERE o.student_id = s.id AND o.date = ? AND o.kind = 'absence'
+            )
+        """, (day_of_week, date, date, date))
+
+        new_messages = []
+        for student in cursor.fetchall():
+            message = absence_message(student['student_name'], date)
+            link = whatsapp_web_link(student['parent_number'], message)
+            if link:
+                new_messages.append((student['id'], date, message, link))
+            else:
+                print(f"❌ رقم ولي الأمر غير صالح للطالب {student['student_name']}")
+
+        conn.executemany("""
+            INSERT INTO outbox (student_id, date, kind, message, whatsapp_link)
+            VALUES (?, ?, 'absence', ?, ?)
+            ON CONFLICT (student_id, date, kind) DO NOTHING
+        """, new_messages)
+        added = len(new_messages)
+
+        removed = conn.execute("""
+            DELETE FROM outbox
+            WHERE date = ? AND kind = 'absence' AND status = 'pending'
+            AND student_id IN (SELECT student_id FROM history WHERE date = ? AND status = 'Present')
+        """, (date, date)).rowcount
 
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    print(f"✅ صندوق واتساب: {added} رسالة جديدة، {removed} رسالة محذوفة بعد تسجيل الحضور")
+    return {"added": added, "removed": removed}
+
+def get_outbox_messages(date, kind="absence"):
+    """رسائل صندوق واتساب ليوم ونوع محددين مع بيانات الطالب"""
+    cursor = open_db().execute("""
+        SELECT o.id, o.student_id, o.date, o.status, o.whatsapp_link,
+               s.student_name, s.parent_number
+        FROM outbox o
+        JOIN students s ON s.id = o.student_id
+        WHERE o.date = ? AND o.kind = ?
+        ORDER BY o.id
+    """, (date, kind))
+    return [dict(row) for row in cursor.fetchall()]
+
+def set_outbox_status(message_id, status):
+    """تحديث حالة رسالة في الصندوق؛ الحالة لا ترجع للخلف (sent تبقى sent)"""
+    conn = open_db()
     cursor = conn.execute("""
-        SELECT DISTINCT s.*
-        FROM students s
-        JOIN classes c ON s.id = c.student_id
-        LEFT JOIN history h ON s.id = h.student_id AND h.date = ?
-        WHERE (h.status IS NULL OR h.status = 'Absent')
-        AND c.day_of_week = ?
-    """, (date, datetime.now().strftime("%A").lower()))
+        UPDATE outbox SET status = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ? AND status IN ('pending', 'opened') AND status <> ?
+    """, (status, message_id, status))
+    conn.commit()
+    return cursor.rowcount > 0
 
-    absent_students = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+# ---------- Attendance ----------
+def record_checkin(conn, student_id, class_id, date):
+    """تسجيل الحضور، أو تحويل الغياب التلقائي إلى حضور، في عملية واحدة.
+    يرجع False إذا كان الطالب مسجلاً حاضراً بالفعل (بدون commit)."""
+    cursor = conn.execute("""
+        INSERT INTO history (student_id, class_id, exam_grade, homework_status, status, paid, date)
+        VALUES (?, ?, '-', '-', 'Present', 'Yes', ?)
+        ON CONFLICT (student_id, IFNULL(class_id, 0), date) DO UPDATE SET
+            status='Present', paid='Yes'
+        WHERE history.status = 'Absent'
+    """, (student_id, class_id, date))
+    return cursor.rowcount > 0
+
+def record_grades(conn, student_id, date, grade, homework, mark_paid=False):
+    """رصد الدرجة والواجب على سجل اليوم الموجود (سجل الحصة الأقرب إن وُجد، وإلا أول سجل)،
+    أو إنشاء سجل حضور للحصة الأقرب إذا لم يكن للطالب سجل في هذا اليوم، في معاملة واحدة"""
+    # الدرجات تُرصد غالباً بعد انتهاء الحصة، فنأخذ أقرب حصة لليوم
+    class_row = resolve_session(student_id, current_time(), nearest=True)
+    class_id = class_row[0] if class_row else None
+    paid = ", paid='Yes'" if mark_paid else ""
+
+    # سجل اليوم قد يخص حصة أخرى غير الأقرب، فلا يكفي upsert على الفهرس الفريد وحده؛
+    # BEGIN IMMEDIATE يمنع طلبين متزامنين من إنشاء سجلين لنفس اليوم
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        updated = conn.execute(f"""
+            UPDATE history SET exam_grade=?, homework_status=?, status='Present'{paid}
+            WHERE id = (
+                SELECT id FROM history WHERE student_id=? AND date=?
+                ORDER BY IFNULL(class_id, 0) = IFNULL(?, 0) DESC, id
+                LIMIT 1
+            )
+        """, (grade, homework, student_id, date, class_id)).rowcount
+
+        if not updated:
+            conn.execute(f"""
+                INSERT INTO history (student_id, class_id, exam_grade, homework_status, status, paid, date)
+                VALUES (?, ?, ?, ?, 'Present', 'Yes', ?)
+                ON CONFLICT (student_id, IFNULL(class_id, 0), date) DO UPDATE SET
+                    exam_grade=excluded.exam_grade,
+                    homework_status=excluded.homework_status,
+                    status='Present'{paid}
+            """, (student_id, class_id, grade, homework, date))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
-    if not absent_students:
-        print("✅ لا يوجد طلاب غائبين اليوم")
-        return []
+BULK_CHECKIN_MAX_SCANS = 500
+# الماسح يعيد إرسال الدفعة حتى يصله الرد، فالإيصال يلزم فقط خلال هذه المدة؛ الأقدم يُحذف
+SCAN_RECEIPT_RETENTION_DAYS = 31
 
-    print(f"📋 عدد الطلاب الغائبين: {len(absent_students)}")
+def parse_scan_time(value):
+    """تحويل وقت المسح القادم من الهاتف إلى datetime محلي (أو None إذا كان غير صالح)"""
+    try:
+        scanned_at = datetime.fromisoformat(str(value))
+    except (TypeError, ValueError):
+        return None
+    if scanned_at.tzinfo is not None:
+        scanned_at = scanned_at.astimezone().replace(tzinfo=None)
+    return scanned_at
 
-    whatsapp_links = []
-    for student in absent_students:
-        link = generate_whatsapp_link(student)
-        if link:
-            whatsapp_links.append({
-                'student_name': student['student_name'],
-                'parent_number': student['parent_number'],
-                'whatsapp_link': link
-            })
+def ingest_scans(scans):
+    """تطبيق دفعة مسح (قد تكون متأخرة) في معاملة واحدة، بتاريخ المسح الأصلي.
+    كل مسح: {"key", "student_id", "scanned_at"}. يرجع نتيجة لكل مسح بنفس الترتيب."""
+    conn = open_db()
+    results = [None] * len(scans)
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        keys = [str(scan.get("key") or "") for scan in scans]
+        student_ids = list({str(scan.get("student_id") or "").strip() for scan in scans})
+
+        # مسح أُرسل من قبل: نعيد نفس النتيجة المحفوظة دون تطبيقه مرة أخرى
+        stored = dict(conn.execute(
+            "SELECT key, result FROM scan_receipts WHERE key IN (SELECT value FROM json_each(?))",
+            (json.dumps(keys),)
+        ).fetchall())
+
+        names = dict(conn.execute(
+            "SELECT id, student_name FROM students WHERE id IN (SELECT value FROM json_each(?))",
+            (json.dumps(student_ids),)
+        ).fetchall())
+
+        pending = []
+        for index, scan in enumerate(scans):
+            key = keys[index]
+            student_id = str(scan.get("student_id") or "").strip()
+            result = {"key": key, "student_id": student_id}
+
+            if key in stored:
+                results[index] = dict(json.loads(stored[key]), replayed=True)
+                continue
+
+            scanned_at = parse_scan_time(scan.get("scanned_at"))
+            if not key:
+                result.update(ok=False, error="missing_key")
+            elif scanned_at is None:
+                result.update(ok=False, error="invalid_time")
+            elif student_id not in names:
+                result.update(ok=False, error="not_found")
+            else:
+                date = scanned_at.strftime("%Y-%m-%d")
+                class_row = resolve_session(student_id, scanned_at)
+                result.update(student_name=names[student_id], date=date)
+                if class_row is None:
+                    result.update(ok=False, error="no_class_today")
+                else:
+                    class_id = class_row[0]
+                    result.update(ok=True, status="Present", class_id=class_id)
+                    pending.append((index, student_id, class_id, date))
+
+            results[index] = result
+
+        # هل كان الطالب حاضراً بالفعل قبل هذه الدفعة؟ (أو تكرر في نفس الدفعة)
+        present = {
+            (row["student_id"], row["class_id"], row["date"])
+            for row in conn.execute("""
+                SELECT student_id, class_id, date FROM history
+                WHERE status = 'Present'
+                AND (student_id, date) IN (
+                    SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]')
+                    FROM json_each(?)
+                )
+            """, (json.dumps([[student_id, date] for _, student_id, _, date in pending]),))
+        }
+        for index, student_id, class_id, date in pending:
+            results[index]["already_checked_in"] = (student_id, class_id, date) in present
+            present.add((student_id, class_id, date))
+
+        conn.executemany("""
+            INSERT INTO history (student_id, class_id, exam_grade, homework_status, status, paid, date)
+            VALUES (?, ?, '-', '-', 'Present', 'Yes', ?)
+            ON CONFLICT (student_id, IFNULL(class_id, 0), date) DO UPDATE SET
+                status='Present', paid='Yes'
+            WHERE history.status = 'Absent'
+        """, [(student_id, class_id, date) for _, student_id, class_id, date in pending])
+
+        conn.executemany("""
+            INSERT INTO scan_receipts (key, student_id, scan_date, result) VALUES (?, ?, ?, ?)
+            ON CONFLICT (key) DO NOTHING
+        """, [
+            (result["key"], result["student_id"], result.get("date"), json.dumps(result, ensure_ascii=False))
+            for result in results
+            if result["key"] and not result.get("replayed")
+        ])
 
-    print(f"✅ تم إنشاء {len(whatsapp_links)} رابط واتساب")
-    return whatsapp_links
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    return results
+
+def prune_scan_receipts():
+    """حذف إيصالات المسح الأقدم من SCAN_RECEIPT_RETENTION_DAYS (created_at بتوقيت UTC من SQLite)"""
+    conn = open_db()
+    deleted = conn.execute(
+        "DELETE FROM scan_receipts WHERE created_at < datetime('now', ?)",
+        (f"-{SCAN_RECEIPT_RETENTION_DAYS} days",)
+    ).rowcount
+    conn.commit()
+    return deleted
 
 # ---------- Auto-mark absent ----------
-def mark_absent_for_today():
-    """وضع علامة غياب للطلاب الذين لديهم حصة اليوم ولم يسجلوا حضور"""
+# الغياب يُسجل بعد انتهاء كل حصة (end_time) عبر scheduler داخل التطبيق.
+# آخر يوم تمت معالجته بالكامل محفوظ في app_state تحت absence_watermark،
+# فإذا توقف التطبيق أياماً يتم تعويضها في أول تشغيل.
+ABSENCE_BACKFILL_MAX_DAYS = 31
+ABSENCE_SCHEDULER_MAX_SLEEP_SECONDS = 300
+ABSENCE_SCHEDULER_ENABLED = os.environ.get("ATTENDANCE_ABSENCE_SCHEDULER", "1") != "0"
+
+# اسم اليوم بالإنجليزية (كما في classes.day_of_week) لتاريخ days.d
+_SQL_WEEKDAY = """CASE strftime('%w', days.d)
+    WHEN '0' THEN 'sunday' WHEN '1' THEN 'monday' WHEN '2' THEN 'tuesday'
+    WHEN '3' THEN 'wednesday' WHEN '4' THEN 'thursday' WHEN '5' THEN 'friday'
+    ELSE 'saturday' END"""
+
+def mark_absent_for_range(start_date, end_date, cutoff_time=None):
+    """غياب لكل حصة في النطاق لم يُسجل للطالب فيها شيء (منذ تاريخ إضافته).
+    سجل قديم بدون حصة (class_id فارغ) يغطي كل حصص يومه.
+    cutoff_time (HH:MM): في اليوم الأخير نكتفي بالحصص التي انتهت قبله."""
     conn = open_db()
-    date = today_str()
-    current_day = datetime.now().strftime("%A").lower()
 
-    cursor = conn.execute("""
-        SELECT s.id as student_id, c.id as class_id
-        FROM students s
-        JOIN classes c ON s.id = c.student_id
-        WHERE c.day_of_week = ?
+    # إدراج واحد لكل الأيام والطلاب؛ ON CONFLICT يحمي من التكرار بدلاً من فحص كل صف
+    cursor = conn.execute(f"""
+        INSERT INTO history (student_id, class_id, exam_grade, homework_status, status, paid, date)
+        WITH RECURSIVE days(d) AS (
+            SELECT date(?)
+            UNION ALL
+            SELECT date(d, '+1 day') FROM days WHERE d < date(?)
+        )
+        SELECT s.id, c.id, '-', '-', 'Absent', 'No', days.d
+        FROM days
+        JOIN classes c ON c.day_of_week = {_SQL_WEEKDAY}
+        JOIN students s ON s.id = c.student_id
+        WHERE (? IS NULL OR days.d < date(?) OR c.end_time <= ?)
+        AND (s.added_on IS NULL OR days.d >= s.added_on)
         AND NOT EXISTS (
-            SELECT 1 FROM history h 
-            WHERE h.student_id = s.id AND h.date = ?
+            SELECT 1 FROM history h
+            WHERE h.student_id = s.id AND h.date = days.d
+            AND IFNULL(h.class_id, c.id) = c.id
         )
-    """, (current_day, date))
-
-    students_to_mark_absent = [dict(row) for row in cursor.fetchall()]
-    
-    marked_count = 0
-    for row in students_to_mark_absent:
-        check_cursor = conn.execute("""
-            SELECT 1 FROM history 
-            WHERE student_id=? AND class_id=? AND date=?
-        """, (row['student_id'], row['class_id'], date))
-        
-        if not check_cursor.fetchone():
-            conn.execute("""
-                INSERT INTO history (student_id, class_id, exam_grade, homework_status, status, paid, date)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (row['student_id'], row['class_id'], "-", "-", "Absent", "No", date))
-            marked_count += 1
+        ON CONFLICT (student_id, IFNULL(class_id, 0), date) DO NOTHING
+    """, (start_date, end_date, cutoff_time, end_date, cutoff_time))
+    marked_count = cursor.rowcount
 
     conn.commit()
-    conn.close()
-    
+    return marked_count
+
+def mark_absent_for_today():
+    """وضع علامة غياب للطلاب الذين لديهم حصة اليوم ولم يسجلوا حضور"""
+    date = today_str()
+    marked_count = mark_absent_for_range(date, date)
+
     if marked_count > 0:
         print(f"✅ تم تعيين {marked_count} طالب كغائبين لليوم")
     else:
         print("✅ لا يوجد طلاب يحتاجون وضع غياب")
 
-# ---------- Save daily summary ----------
-def save_daily_summary():
-    """حفظ التقرير اليومي كملف CSV"""
-    conn = open_db()
-    date = today_str()
+def mark_missed_absences(now=None):
+    """تعويض الغياب منذ آخر تشغيل حتى الآن (حصص اليوم التي انتهت فقط)"""
+    now = now or current_time()
+    today = now.date()
+    yesterday = today - timedelta(days=1)
 
-    cursor = conn.execute("SELECT * FROM history WHERE date=?", (date,))
-    history_today = [dict(row) for row in cursor.fetchall()]
-
-    cursor = conn.execute("SELECT * FROM students")
-    students = [dict(row) for row in cursor.fetchall()]
-
-    conn.close()
-
-    merged = []
-    for st in students:
-        rec = next((h for h in history_today if h["student_id"] == st["id"]), None)
-        merged.append({
-            "id": st["id"],
-            "student_name": st.get("student_name"),
-            "parent_number": st.get("parent_number"),
-            "exam_grade": rec["exam_grade"] if rec else "-",
-            "homework_status": rec["homework_status"] if rec else "-",
-            "status": rec["status"] if rec else "Absent",
-            "paid": rec["paid"] if rec else "No",
-            "payment_amount": st.get("payment_amount", 0)
-        })
+    watermark = get_app_state("absence_watermark")
+    if watermark:
+        start = datetime.strptime(watermark, "%Y-%m-%d").date() + timedelta(days=1)
+        start = max(start, today - timedelta(days=ABSENCE_BACKFILL_MAX_DAYS))
+    else:
+        start = today
+
+    marked_count = mark_absent_for_range(start.isoformat(), today.isoformat(), now.strftime("%H:%M"))
+
+    if watermark != yesterday.isoformat():
+        set_app_state("absence_watermark", yesterday.isoformat())
+        open_db().commit()
 
+    if marked_count > 0:
+        print(f"✅ تم تعيين {marked_count} غياب من {start.isoformat()} حتى الآن")
+    return marked_count
+
+def _seconds_until_next_absence_run(now):
+    """المدة حتى نهاية أقرب حصة قادمة اليوم، بحد أقصى ABSENCE_SCHEDULER_MAX_SLEEP_SECONDS"""
+    row = open_db().execute("""
+        SELECT MIN(end_time) AS end_time FROM classes
+        WHERE day_of_week = ? AND end_time > ?
+    """, (now.strftime("%A").lower(), now.strftime("%H:%M"))).fetchone()
+
+    seconds = ABSENCE_SCHEDULER_MAX_SLEEP_SECONDS
+    if row and row["end_time"]:
+        try:
+            end_time = datetime.strptime(row["end_time"], "%H:%M").time()
+            due = datetime.combine(now.date(), end_time)
+            seconds = min(seconds, max(1, (due - now).total_seconds()))
+        except ValueError:
+            pass
+    return seconds
+
+def _absence_scheduler_loop():
+    # process واحد فقط يمسك القفل ويصبح المسؤول عن الغياب؛ الباقي ينتظر
+    # حتى يتوقف (مثلاً عند إعادة تشغيل الـ worker) ثم يأخذ مكانه
+    lock_file = acquire_process_lock("absence_scheduler")
+    while lock_file is None:
+        time.sleep(ABSENCE_SCHEDULER_MAX_SLEEP_SECONDS)
+        lock_file = acquire_process_lock("absence_scheduler")
+
+    print("⏰ تم تشغيل جدولة الغياب في هذا الـ process")
+    while True:
+        try:
+            mark_missed_absences()
+            prune_scan_receipts()
+            delay = _seconds_until_next_absence_run(current_time())
+        except Exception as e:
+            print(f"❌ خطأ في جدولة الغياب: {e}")
+            delay = ABSENCE_SCHEDULER_MAX_SLEEP_SECONDS
+        time.sleep(delay)
+
+def start_absence_scheduler():
+    threading.Thread(target=_absence_scheduler_loop, name="absence-scheduler", daemon=True).start()
+
+# ---------- Save daily summary ----------
+DAILY_SUMMARY_FIELDS = ['id', 'student_name', 'parent_number', 'exam_grade', 'homework_status', 'status', 'paid', 'payment_amount']
+
+# آخر نسخة من البيانات كُتب منها ملف الملخص لكل يوم: {date: token}
+_daily_summary_tokens = {}
+
+# عند وجود أكثر من حصة في اليوم نأخذ أول سجل، كما كان العرض يفعل دائماً
+_DAILY_RECORDS_SQL = """
+    SELECT s.id, s.student_name, s.parent_number, s.payment_amount,
+           IFNULL(h.exam_grade, '-') AS exam_grade,
+           IFNULL(h.homework_status, '-') AS homework_status,
+           IFNULL(h.status, 'Absent') AS status,
+           IFNULL(h.paid, 'No') AS paid
+    FROM students s
+    LEFT JOIN history h ON h.id = (
+        SELECT MIN(id) FROM history
+        WHERE student_id = s.id AND date = ?
+    )
+"""
+
+def get_daily_records(date):
+    """سجل اليوم لكل طالب (أو القيم الافتراضية للغائب) في استعلام واحد"""
+    cursor = open_db().execute(_DAILY_RECORDS_SQL + " ORDER BY s.rowid", (date,))
+    return [dict(row) for row in cursor]
+
+def get_daily_records_page(date, after=None, limit=None, search=None):
+    """صفحة من سجلات اليوم مرتبة بكود الطالب بعد after؛ ترجع (السجلات، كود آخر سجل أو None)"""
+    limit = limit or STUDENTS_PAGE_SIZE
+    where, params = _students_page_filter("s", after, search)
+    cursor = open_db().execute(
+        f"{_DAILY_RECORDS_SQL} {where} ORDER BY s.id LIMIT ?", [date, *params, limit + 1]
+    )
+    return _keyset_page([dict(row) for row in cursor], limit)
+
+def get_daily_summary(date):
+    """أرقام التقرير اليومي لكل الطلاب: العدد والحضور والغياب والمبلغ المحصل"""
+    row = open_db().execute(f"""
+        SELECT COUNT(*) AS total_students,
+               IFNULL(SUM(status = 'Present'), 0) AS present_count,
+               IFNULL(SUM(status = 'Absent'), 0) AS absent_count,
+               IFNULL(SUM(CASE WHEN paid = 'Yes' THEN IFNULL(payment_amount, 0) ELSE 0 END), 0) AS total_paid
+        FROM ({_DAILY_RECORDS_SQL})
+    """, (date,)).fetchone()
+    return dict(row)
+
+def save_daily_summary(date=None):
+    """حفظ التقرير اليومي كملف CSV، فقط إذا تغيرت بيانات اليوم منذ آخر حفظ"""
+    date = date or today_str()
     filename = f"{date}.csv"
     filepath = os.path.join(SUMMARY_DIR, filename)
 
+    # نقرأ العداد قبل البيانات: أي كتابة بينهما تجعل الملف قديماً فيُعاد إنشاؤه لاحقاً
+    token = get_change_token(f"history:{date}", "students")
+    if _daily_summary_tokens.get(date) == token and os.path.exists(filepath):
+        return filepath
+
+    merged = get_daily_records(date)
+
     with open(filepath, 'w', newline='', encoding='utf-8') as csvfile:
-        fieldnames = ['id', 'student_name', 'parent_number', 'exam_grade', 'homework_status', 'status', 'paid', 'payment_amount']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer = csv.DictWriter(csvfile, fieldnames=DAILY_SUMMARY_FIELDS)
         writer.writeheader()
         writer.writerows(merged)
 
+    _daily_summary_tokens[date] = token
     return filepath
 
 # ---------- Monthly report generator ----------
+MONTHLY_REPORT_FIELDS = ['date', 'status', 'homework_status', 'exam_grade', 'paid']
+
+def month_date_range(month_str):
+    """حدود الشهر كنطاق تواريخ [البداية، بداية الشهر التالي) ليستفيد من فهرس التاريخ.
+    ValueError إذا لم يكن الشهر بصيغة YYYY-MM صحيحة"""
+    start = datetime.strptime(month_str, "%Y-%m")
+    year, month = start.year, start.month
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return f"{year:04d}-{month:02d}-01", f"{next_year:04d}-{next_month:02d}-01"
+
+def rebuild_month_stats():
+    """إعادة بناء ملخصات الشهور من سجل الحضور (للإصلاح فقط؛ الـ triggers تحدّثها تلقائياً)"""
+    conn = open_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM student_month_stats")
+        conn.execute(MONTH_STATS_REBUILD_SQL)
+        row_count = conn.execute("SELECT COUNT(*) FROM student_month_stats").fetchone()[0]
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return row_count
+
+def get_month_stats(student_id, month_str):
+    """ملخص شهر واحد لطالب (أصفار إذا لم يكن له سجل في هذا الشهر)"""
+    row = open_db().execute(
+        f"SELECT {', '.join(MONTH_STATS_FIELDS)} FROM student_month_stats WHERE student_id=? AND month=?",
+        (student_id, month_str)
+    ).fetchone()
+    return dict(row) if row else dict.fromkeys(MONTH_STATS_FIELDS, 0)
+
+def monthly_report_filename(student_id, student_name, month_str):
+    """اسم ملف التقرير الشهري المبني على اسم الطالب"""
+    student_name_safe = re.sub(r'[^\w\s\u0600-\u06FF]', '', student_name or "unknown")
+    student_name_safe = re.sub(r'\s+', '_', student_name_safe.strip())
+
+    if not student_name_safe:
+        student_name_safe = f"student_{student_id}"
+
+    return f"{student_name_safe}_{month_str}.csv"
+
+def write_monthly_report_csv(csvfile, student_id, student_name, month_str, history_rows):
+    """كتابة محتوى التقرير الشهري لطالب واحد في ملف نصي مفتوح"""
+    csvfile.write(f"Student ID,{student_id}\n")
+    csvfile.write(f"Student Name,{student_name or ''}\n")
+    csvfile.write(f"Month,{month_str}\n\n")
+
+    writer = csv.DictWriter(csvfile, fieldnames=MONTHLY_REPORT_FIELDS, extrasaction='ignore')
+    writer.writeheader()
+
+    if not history_rows:
+        writer.writerow({
+            'date': 'لا توجد بيانات', 'status': '-',
+            'homework_status': '-', 'exam_grade': '-', 'paid': '-'
+        })
+    else:
+        for session in history_rows:
+            writer.writerow({field: session[field] for field in MONTHLY_REPORT_FIELDS})
+
 def generate_monthly_report_file(student_id, month_str=None):
     """إنشاء تقرير شهري كملف CSV"""
     if month_str is None:
         month_str = current_month_str()
+    month_start, month_end = month_date_range(month_str)
 
     conn = open_db()
 
     cursor = conn.execute("SELECT * FROM students WHERE id=?", (student_id,))
     student_row = cursor.fetchone()
     if not student_row:
-        conn.close()
         return None
 
     student = dict(student_row)
-    
-    student_name = student.get("student_name", "unknown")
-    student_name_safe = re.sub(r'[^\w\s\u0600-\u06FF]', '', student_name)
-    student_name_safe = re.sub(r'\s+', '_', student_name_safe.strip())
-    
-    if not student_name_safe:
-        student_name_safe = f"student_{student_id}"
-    
-    filename = f"{student_name_safe}_{month_str}.csv"
+    filename = monthly_report_filename(student_id, student.get("student_name"), month_str)
     filepath = os.path.join(MONTHLY_DIR, filename)
 
     try:
+        cursor = conn.execute(
+            "SELECT * FROM history WHERE student_id=? AND date >= ? AND date < ? ORDER BY date ASC",
+            (student_id, month_start, month_end)
+        )
+        history_rows = cursor.fetchall()
+
         with open(filepath, 'w', newline='', encoding='utf-8') as csvfile:
-            csvfile.write(f"Student ID,{student_id}\n")
-            csvfile.write(f"Student Name,{student.get('student_name','')}\n")
-            csvfile.write(f"Month,{month_str}\n\n")
-
-            fieldnames = ['date', 'status', 'homework_status', 'exam_grade', 'paid']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-
-            cursor = conn.execute("SELECT * FROM history WHERE student_id=? AND date LIKE ? ORDER BY date ASC", (student_id, f"{month_str}-%"))
-            history_rows = [dict(row) for row in cursor.fetchall()]
-            
-            if not history_rows:
-                writer.writerow({
-                    'date': 'لا توجد بيانات', 'status': '-',
-                    'homework_status': '-', 'exam_grade': '-', 'paid': '-'
-                })
-            else:
-                for session in history_rows:
-                    writer.writerow({
-                        'date': session['date'],
-                        'status': session['status'],
-                        'homework_status': session['homework_status'],
-                        'exam_grade': session['exam_grade'],
-                        'paid': session['paid']
-                    })
+            write_monthly_report_csv(csvfile, student_id, student.get("student_name"), month_str, history_rows)
 
-        conn.close()
         return filepath
-        
+
     except Exception as e:
         print(f"❌ خطأ في إنشاء التقرير الشهري: {e}")
-        conn.close()
         return None
 
-def calculate_monthly_stats():
-    """حساب إحصائيات الشهر للطلاب"""
-    month_str = current_month_str()
-    conn = open_db()
-
-    cursor = conn.execute("SELECT * FROM students")
-    students = [dict(row) for row in cursor.fetchall()]
+class _ZipStreamBuffer(io.RawIOBase):
+    """ملف وهمي غير قابل للـ seek يجمع ما يكتبه ZipFile حتى نرسله كـ chunk"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+# سجلات الشهر لكل الطلاب مرتبة بالطالب (الطالب بلا سجلات يظهر بصف واحد تاريخه NULL)
+MONTH_HISTORY_BY_STUDENT_SQL = """
+    SELECT s.id AS student_id, s.student_name,
+           h.date, h.status, h.homework_status, h.exam_grade, h.paid
+    FROM students s
+    LEFT JOIN history h
+        ON h.student_id = s.id AND h.date >= ? AND h.date < ?
+    ORDER BY s.rowid, h.date, h.id
+"""
 
-    monthly_stats = []
+def iter_monthly_reports_zip(month_str):
+    """ملف ZIP لتقارير كل الطلاب يُنتج على دفعات، من استعلام واحد مرتب بالطالب"""
+    month_start, month_end = month_date_range(month_str)
+    conn = open_db()
+    cursor = conn.execute(MONTH_HISTORY_BY_STUDENT_SQL, (month_start, month_end))
+
+    buffer = _ZipStreamBuffer()
+    used_filenames = set()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+        for student_id, rows in groupby(cursor, key=itemgetter("student_id")):
+            rows = list(rows)
+            student_name = rows[0]["student_name"]
+            # الطالب بلا سجلات يظهر في LEFT JOIN بصف واحد تاريخه NULL
+            history_rows = [row for row in rows if row["date"] is not None]
+
+            filename = monthly_report_filename(student_id, student_name, month_str)
+            if filename in used_filenames:
+                # طالبان بنفس الاسم: نميز الملف برقم الطالب حتى لا يتكرر داخل الـ ZIP
+                filename = f"{filename[:-len('.csv')]}_{student_id}.csv"
+            used_filenames.add(filename)
+            with zip_file.open(filename, 'w') as entry:
+                with io.TextIOWrapper(entry, encoding='utf-8', newline='') as csvfile:
+                    write_monthly_report_csv(csvfile, student_id, student_name, month_str, history_rows)
+
+            yield buffer.drain()
+
+    yield buffer.drain()
+
+def monthly_reports_zip_response(month_str):
+    """إرسال ملف ZIP للتقارير الشهرية كـ response متدفق دون ملفات على القرص"""
+    return Response(
+        stream_with_context(iter_monthly_reports_zip(month_str)),
+        mimetype="application/zip",
+        headers={"Content-Disposition": f"attachment; filename=monthly_reports_{month_str}.zip"},
+    )
 
-    for student in students:
-        student_id = student["id"]
-        student_name = student["student_name"]
-        parent_number = student["parent_number"]
-        payment_amount = student.get("payment_amount", 0)
+MONTHLY_MESSAGES_PAGE_SIZE = 50
+MONTHLY_MESSAGE_FIELDS = ["student_id", "student_name", "parent_number", "whatsapp_link", "message"]
+
+def iter_monthly_report_messages(month_str, limit=None, offset=0):
+    """رسائل التقرير الشهري لكل الطلاب (أو صفحة منهم) من استعلام واحد مرتب بالطالب"""
+    month_start, month_end = month_date_range(month_str)
+    stats_columns = ", ".join(f"IFNULL(m.{field}, 0) AS {field}" for field in MONTH_STATS_FIELDS)
+    cursor = open_db().execute(f"""
+        SELECT s.id AS student_id, s.student_name, s.parent_number, s.payment_amount,
+               {stats_columns},
+               h.date, h.status, h.homework_status, h.exam_grade, h.paid
+        FROM (SELECT rowid, * FROM students ORDER BY rowid LIMIT ? OFFSET ?) s
+        LEFT JOIN student_month_stats m ON m.student_id = s.id AND m.month = ?
+        LEFT JOIN history h
+            ON h.student_id = s.id AND h.date >= ? AND h.date < ?
+        ORDER BY s.rowid, h.date, h.id
+    """, (-1 if limit is None else limit, offset, month_str, month_start, month_end))
+
+    for student_id, rows in groupby(cursor, key=itemgetter("student_id")):
+        rows = list(rows)
+        student_data = dict(rows[0])
+        # الطالب بلا سجلات يظهر في LEFT JOIN بصف واحد تاريخه NULL
+        history_rows = [row for row in rows if row["date"] is not None]
+
+        message = format_monthly_report_message(student_data, student_data, history_rows, month_str)
+        yield {
+            "student_id": student_id,
+            "student_name": student_data["student_name"],
+            "parent_number": student_data["parent_number"],
+            "whatsapp_link": whatsapp_web_link(student_data["parent_number"], message),
+            "message": message,
+        }
+
+def write_monthly_messages_csv(csvfile, month_str):
+    """كتابة رسائل التقرير الشهري لكل الطلاب في ملف CSV مفتوح"""
+    writer = csv.DictWriter(csvfile, fieldnames=MONTHLY_MESSAGE_FIELDS)
+    writer.writeheader()
+    count = 0
+    for item in iter_monthly_report_messages(month_str):
+        writer.writerow(item)
+        count += 1
+    return count
+
+def iter_monthly_messages_csv(month_str):
+    """ملف CSV للرسائل الشهرية يُنتج صفاً بصف دون تجميعه في الذاكرة"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=MONTHLY_MESSAGE_FIELDS)
+    buffer.write("\ufeff")
+    writer.writeheader()
+    for item in iter_monthly_report_messages(month_str):
+        writer.writerow(item)
+        if buffer.tell() >= 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def calculate_monthly_stats(month_str=None):
+    """إحصائيات الشهر لكل الطلاب من جدول الملخصات الشهرية"""
+    if month_str is None:
+        month_str = current_month_str()
 
-        cursor = conn.execute(
-            "SELECT * FROM history WHERE student_id=? AND date LIKE ? ORDER BY date ASC",
-            (student_id, f"{month_str}-%")
-        )
-        history_rows = [dict(row) for row in cursor.fetchall()]
+    conn = open_db()
+    cursor = conn.execute("""
+        SELECT s.id, s.student_name, s.parent_number, s.payment_amount,
+               IFNULL(m.total_classes, 0) AS total_classes,
+               IFNULL(m.present_count, 0) AS present_count,
+               IFNULL(m.absent_count, 0) AS absent_count,
+               IFNULL(m.paid_sessions, 0) AS paid_sessions,
+               cd.class_days
+        FROM students s
+        LEFT JOIN student_month_stats m
+            ON m.student_id = s.id AND m.month = ?
+        LEFT JOIN (
+            SELECT student_id, group_concat(day_of_week) AS class_days
+            FROM (SELECT DISTINCT student_id, day_of_week FROM classes)
+            GROUP BY student_id
+        ) cd ON cd.student_id = s.id
+        ORDER BY s.rowid
+    """, (month_str,))
 
-        total_classes = len(history_rows)
-        present_count = len([h for h in history_rows if h['status'] == 'Present'])
-        absent_count = len([h for h in history_rows if h['status'] == 'Absent'])
+    monthly_stats = []
+    for row in cursor:
+        total_classes = row["total_classes"]
+        present_count = row["present_count"]
+        payment_amount = row["payment_amount"] or 0
 
         if total_classes > 0:
             attendance_rate = (present_count / total_classes) * 100
         else:
             attendance_rate = 0
 
-        paid_amount = 0
-        paid_sessions = [h for h in history_rows if h['paid'] == 'Yes']
-        if paid_sessions:
-            paid_amount = len(paid_sessions) * float(payment_amount)
+        if row["class_days"]:
+            class_days_str = ", ".join(weekday_english_to_arabic(day) for day in row["class_days"].split(","))
+        else:
+            class_days_str = "لا توجد حصص"
+
+        monthly_stats.append({
+            "id": row["id"],
+            "student_name": row["student_name"],
+            "parent_number": row["parent_number"],
+            "class_days": class_days_str,
+            "total_classes": total_classes,
+            "present_count": present_count,
+            "absent_count": row["absent_count"],
+            "attendance_rate": attendance_rate,
+            "paid_amount": row["paid_sessions"] * float(payment_amount),
+            "payment_amount": payment_amount
+        })
+
+    return monthly_stats
+
+# ---------- XLSX exports ----------
+# ملفات Excel تُكتب بوضع write-only: كل صف يُضاف من الـ cursor مباشرة ويُكتب في ملف مؤقت
+# على القرص، فالذاكرة ثابتة مهما كان عدد الطلاب. openpyxl يُخرج ملف xlsx كاملاً عند
+# الحفظ فقط، لذلك يُحفظ في ملف مؤقت ثم يُرسل للمتصفح على دفعات.
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+XLSX_SHEET_TITLE_MAX = 31
+_XLSX_INVALID_TITLE_CHARS = re.compile(r"[\[\]:*?/\\]")
+MONTH_WORKBOOK_SUMMARY_FIELDS = ["student_id", "student_name", "sheet", "sessions", "present", "absent"]
+
+def xlsx_sheet_title(title, used_titles):
+    """اسم ورقة صالح في Excel (31 حرفاً على الأكثر وبدون الرموز الممنوعة) وغير مكرر في الملف"""
+    base = _XLSX_INVALID_TITLE_CHARS.sub("", str(title or "")).strip().strip("'")[:XLSX_SHEET_TITLE_MAX] or "Sheet"
+    candidate, counter = base, 1
+    while candidate.lower() in used_titles:
+        counter += 1
+        suffix = f" ({counter})"
+        candidate = base[:XLSX_SHEET_TITLE_MAX - len(suffix)] + suffix
+    used_titles.add(candidate.lower())
+    return candidate
+
+def _create_xlsx_sheet(workbook, title):
+    sheet = workbook.create_sheet(title=title)
+    sheet.sheet_view.rightToLeft = True
+    return sheet
+
+def write_daily_summary_xlsx(target, date):
+    """التقرير اليومي كملف Excel بنفس أعمدة ملف CSV"""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = _create_xlsx_sheet(workbook, date)
+    sheet.append(DAILY_SUMMARY_FIELDS)
+    for row in open_db().execute(_DAILY_RECORDS_SQL + " ORDER BY s.rowid", (date,)):
+        sheet.append([row[field] for field in DAILY_SUMMARY_FIELDS])
+    workbook.save(target)
+
+def _append_monthly_report_rows(sheet, student_id, student_name, month_str, history_rows):
+    """نفس محتوى write_monthly_report_csv في ورقة Excel؛ ترجع عدد الحصص"""
+    sheet.append(["Student ID", student_id])
+    sheet.append(["Student Name", student_name or ""])
+    sheet.append(["Month", month_str])
+    sheet.append([])
+    sheet.append(MONTHLY_REPORT_FIELDS)
+
+    count = 0
+    for row in history_rows:
+        sheet.append([row[field] for field in MONTHLY_REPORT_FIELDS])
+        count += 1
+    if not count:
+        sheet.append(["لا توجد بيانات", "-", "-", "-", "-"])
+    return count
+
+def write_monthly_report_xlsx(target, student_id, month_str):
+    """التقرير الشهري لطالب واحد كملف Excel؛ ترجع False إذا لم يوجد الطالب"""
+    from openpyxl import Workbook
+
+    conn = open_db()
+    student = conn.execute("SELECT student_name FROM students WHERE id=?", (student_id,)).fetchone()
+    if not student:
+        return False
+
+    month_start, month_end = month_date_range(month_str)
+    history_rows = conn.execute(
+        "SELECT * FROM history WHERE student_id=? AND date >= ? AND date < ? ORDER BY date ASC",
+        (student_id, month_start, month_end)
+    )
+
+    workbook = Workbook(write_only=True)
+    sheet = _create_xlsx_sheet(workbook, month_str)
+    _append_monthly_report_rows(sheet, student_id, student["student_name"], month_str, history_rows)
+    workbook.save(target)
+    return True
 
-        cursor = conn.execute("SELECT DISTINCT day_of_week FROM classes WHERE student_id=?", (student_id,))
-        class_days_rows = [dict(row) for row in cursor.fetchall()]
-        class_days = [weekday_english_to_arabic(row['day_of_week']) for row in class_days_rows]
-        class_days_str = ", ".join(class_days) if class_days else "لا توجد حصص"
+def write_month_workbook_xlsx(target, month_str, progress=None):
+    """ملف Excel للشهر كله: ورقة ملخص ثم ورقة لكل طالب، من استعلام واحد مرتب بالطالب"""
+    from openpyxl import Workbook
 
-        monthly_stats.append({
-            "id": student_id,
-            "student_name": student_name,
-            "parent_number": parent_number,
-            "class_days": class_days_str,
-            "total_classes": total_classes,
-            "present_count": present_count,
-            "absent_count": absent_count,
-            "attendance_rate": attendance_rate,
-            "paid_amount": paid_amount,
-            "payment_amount": payment_amount
-        })
+    workbook = Workbook(write_only=True)
+    summary = _create_xlsx_sheet(workbook, "ملخص")
+    summary.append(MONTH_WORKBOOK_SUMMARY_FIELDS)
+    used_titles = {"ملخص"}
 
-    conn.close()
-    return monthly_stats
+    conn = open_db()
+    total = conn.execute("SELECT COUNT(*) FROM students").fetchone()[0]
+    month_start, month_end = month_date_range(month_str)
+    cursor = conn.execute(MONTH_HISTORY_BY_STUDENT_SQL, (month_start, month_end))
+
+    done = 0
+    for student_id, rows in groupby(cursor, key=itemgetter("student_id")):
+        rows = list(rows)
+        student_name = rows[0]["student_name"]
+        history_rows = [row for row in rows if row["date"] is not None]
+
+        title = xlsx_sheet_title(f"{student_id} {student_name or ''}", used_titles)
+        sheet = _create_xlsx_sheet(workbook, title)
+        _append_monthly_report_rows(sheet, student_id, student_name, month_str, history_rows)
+        # إغلاق الورقة بعد اكتمالها يحرر ملفها المؤقت بدلاً من بقاء ملف مفتوح لكل طالب
+        sheet.close()
+
+        summary.append([
+            student_id, student_name, title, len(history_rows),
+            sum(row["status"] == "Present" for row in history_rows),
+            sum(row["status"] == "Absent" for row in history_rows),
+        ])
+        done += 1
+        if progress:
+            progress(done, total)
+
+    workbook.save(target)
+    return done
+
+def xlsx_response(write, download_name):
+    """كتابة ملف Excel (write تستقبل الملف) في ملف مؤقت وإرساله للمتصفح على دفعات"""
+    target = tempfile.TemporaryFile()
+    try:
+        write(target)
+    except Exception:
+        target.close()
+        raise
+    target.seek(0)
+    return send_file(target, mimetype=XLSX_MIMETYPE, download_name=download_name, as_attachment=True)
+
+# ---------- Student listings ----------
+# القوائم تُعرض على صفحات بترتيب كود الطالب: كل صفحة تبدأ بعد آخر كود في السابقة
+# (keyset pagination)، فتكلفة كل صفحة ثابتة مهما كان عدد الطلاب.
+STUDENTS_PAGE_SIZE = 50
+STUDENTS_PAGE_MAX = 200
+
+def _like_pattern(text, prefix_only=False):
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"{escaped}%" if prefix_only else f"%{escaped}%"
+
+def _students_page_filter(alias, after=None, search=None):
+    """شرط WHERE لصفحة من الطلاب: بعد الكود after، ومطابقة البحث في الكود أو الاسم أو الرقم"""
+    conditions, params = [], []
+    if after:
+        conditions.append(f"{alias}.id > ?")
+        params.append(after)
+    if search:
+        # الاسم يُبحث عنه في فهرس students_fts (بعد تطبيع الحروف العربية)
+        search_conditions = [f"{alias}.id LIKE ? ESCAPE '\\'", f"{alias}.parent_number LIKE ? ESCAPE '\\'"]
+        params += [_like_pattern(search, prefix_only=True), _like_pattern(search)]
+        name_query = student_fts_query(search, "student_name")
+        if name_query:
+            search_conditions.append(f"{alias}.id IN (SELECT student_id FROM students_fts WHERE students_fts MATCH ?)")
+            params.append(name_query)
+        conditions.append(f"({' OR '.join(search_conditions)})")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return where, params
+
+def _keyset_page(rows, limit):
+    # نطلب صفاً زائداً لنعرف إن كانت هناك صفحة تالية
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, rows[-1]["id"]
+    return rows, None
+
+def list_students_page(after=None, limit=STUDENTS_PAGE_SIZE, search=None):
+    """صفحة من الطلاب مرتبة بالكود بعد after؛ ترجع (الطلاب، كود آخر طالب أو None)"""
+    where, params = _students_page_filter("s", after, search)
+    cursor = open_db().execute(f"SELECT s.* FROM students s {where} ORDER BY s.id LIMIT ?", [*params, limit + 1])
+    return _keyset_page([dict(row) for row in cursor], limit)
+
+def _page_args():
+    """معاملات الصفحة من الطلب: after و limit و q"""
+    limit = min(max(request.args.get("limit", STUDENTS_PAGE_SIZE, type=int), 1), STUDENTS_PAGE_MAX)
+    after = request.args.get("after", "").strip() or None
+    search = request.args.get("q", "").strip() or None
+    return after, limit, search
+
+STUDENT_ROWS_TEMPLATES = {
+    "manage": "_manage_student_rows.html",
+    "grades": "_bulk_grades_rows.html",
+}
+
+@app.route("/api/students")
+def api_students():
+    """قائمة الطلاب على صفحات (JSON)، مع صفوف HTML جاهزة إذا طُلب view"""
+    view = request.args.get("view")
+    if view == "manage" and not check_permission('all'):
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    if view and view not in STUDENT_ROWS_TEMPLATES:
+        return jsonify({"ok": False, "error": "invalid_view"}), 400
+
+    after, limit, search = _page_args()
+    students, next_after = list_students_page(after, limit, search)
+
+    payload = {
+        "ok": True,
+        "students": [dict(student, classes=get_student_classes(student["id"])) for student in students],
+        "next_after": next_after,
+    }
+    if view:
+        payload["html"] = render_template(
+            STUDENT_ROWS_TEMPLATES[view], students=students, get_student_classes=get_student_classes
+        )
+    return jsonify(payload)
+
+@app.route("/api/daily_report")
+def api_daily_report():
+    """سجلات اليوم على صفحات (JSON)، مع صفوف HTML جاهزة إذا طُلب view=daily"""
+    if not check_permission('daily_report'):
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+
+    date = request.args.get("date") or today_str()
+    after, limit, search = _page_args()
+    records, next_after = get_daily_records_page(date, after, limit, search)
+
+    payload = {"ok": True, "date": date, "records": records, "next_after": next_after}
+    if request.args.get("view") == "daily":
+        payload["html"] = render_template("_daily_report_rows.html", students=records)
+    return jsonify(payload)
+
+# ---------- Student search ----------
+# البحث السريع (typeahead) يستخدم فهرس students_fts: الأسماء بعد تطبيع الحروف العربية،
+# وأرقام أولياء الأمور بصيغة محلية، فيكفي جزء من أول كل كلمة أو أول الرقم.
+STUDENT_SEARCH_LIMIT = 10
+STUDENT_SEARCH_MAX = 50
+
+def _fts_phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+def student_fts_query(text, column=None):
+    """نص البحث كاستعلام FTS5: كل كلمة (بعد التطبيع) بادئة مطلوبة؛ فارغ إذا لم يبق شيء للبحث"""
+    tokens = re.findall(r"\w+", normalize_arabic(text))
+    query = " ".join(f"{_fts_phrase(token)}*" for token in tokens)
+    if query and column:
+        query = f"{column} : ({query})"
+    return query
+
+def _glob_prefix(text):
+    # GLOB حساس لحالة الأحرف فيستخدم فهرس المفتاح الأساسي (عكس LIKE)
+    return re.sub(r"([*?\[])", r"[\1]", text) + "*"
+
+def search_students(text, limit=STUDENT_SEARCH_LIMIT):
+    """طلاب يطابقون بداية الكود، أو بداية كلمات الاسم، أو بداية رقم ولي الأمر إذا كان البحث رقماً"""
+    text = (text or "").strip()
+    if not text:
+        return []
+    phone = normalize_phone(text)
+    if phone.startswith("20") and text.startswith("+"):
+        # رقم دولي لم يكتمل بعد (normalize_phone تحوّل الرقم الكامل فقط)
+        phone = "0" + phone[2:]
+    if phone.isdigit():
+        match = student_fts_query(phone, "parent_number")
+    else:
+        match = student_fts_query(text, "student_name")
+
+    # الكود المطابق تماماً أولاً، ثم بداية الكود، ثم ترتيب FTS (bm25)
+    rows = open_db().execute(f"""
+        SELECT id, student_name, parent_number FROM (
+            SELECT s.id, s.student_name, s.parent_number, (s.id <> :text) AS grp, 0 AS score
+            FROM students s WHERE s.id GLOB :prefix
+            {"UNION ALL SELECT s.id, s.student_name, s.parent_number, 2, f.rank "
+             "FROM students_fts f JOIN students s ON s.id = f.student_id WHERE students_fts MATCH :match"
+             if match else ""}
+        )
+        GROUP BY id
+        ORDER BY MIN(grp), MIN(score), id
+        LIMIT :limit
+    """, {"text": text, "prefix": _glob_prefix(text), "match": match, "limit": limit}).fetchall()
+    return [dict(row) for row in rows]
+
+def find_students_by_phone(parent_number):
+    """كل الطلاب المسجلين على نفس رقم ولي الأمر (الإخوة) في استعلام واحد على الفهرس"""
+    phone = normalize_phone(parent_number)
+    if not phone:
+        return []
+    rows = open_db().execute("""
+        SELECT s.id, s.student_name, s.parent_number
+        FROM students_fts f JOIN students s ON s.id = f.student_id
+        WHERE students_fts MATCH ?
+        ORDER BY s.id
+    """, (f"parent_number : {_fts_phrase(phone)}",)).fetchall()
+    return [dict(row) for row in rows]
+
+def find_siblings(student_id):
+    row = open_db().execute("SELECT parent_number FROM students WHERE id=?", (student_id,)).fetchone()
+    return find_students_by_phone(row["parent_number"]) if row else []
+
+@app.route("/api/students/search")
+def api_students_search():
+    """بحث سريع أثناء الكتابة: ?q=نص البحث&limit=عدد النتائج"""
+    limit = min(max(request.args.get("limit", STUDENT_SEARCH_LIMIT, type=int), 1), STUDENT_SEARCH_MAX)
+    query = request.args.get("q", "")
+    return jsonify({"ok": True, "query": query, "students": search_students(query, limit)})
+
+@app.route("/api/students/siblings")
+def api_students_siblings():
+    """الإخوة: ?phone=رقم ولي الأمر أو ?student_id=كود أحد الإخوة"""
+    if request.args.get("student_id"):
+        students = find_siblings(request.args["student_id"].strip())
+    else:
+        students = find_students_by_phone(request.args.get("phone", ""))
+    return jsonify({"ok": True, "students": students})
 
 # ---------- Student Management ----------
 @app.route("/add_student", methods=["GET", "POST"])
@@ -733,56 +2650,34 @@ def add_student():
             existing = cursor.fetchone()
             if existing:
                 flash("رقم الطالب موجود مسبقاً", "error")
-                conn.close()
                 return render_template("add_student.html")
 
             conn.execute("""
-                INSERT INTO students (id, student_name, parent_number, payment_amount)
-                VALUES (?, ?, ?, ?)
-            """, (student_id, student_name, parent_number, payment_amount))
+                INSERT INTO students (id, student_name, parent_number, payment_amount, added_on)
+                VALUES (?, ?, ?, ?, ?)
+            """, (student_id, student_name, parent_number, payment_amount, today_str()))
 
-            days_of_week = request.form.getlist("day_of_week[]")
+            days_of_week = [day.strip().lower() for day in request.form.getlist("day_of_week[]") if day.strip()]
 
-            classes_added = 0
-            for day in days_of_week:
-                day = day.strip().lower()
-                if day:
-                    conn.execute("""
-                        INSERT INTO classes (student_id, day_of_week, start_time, end_time)
-                        VALUES (?, ?, ?, ?)
-                    """, (student_id, day, "09:00", "10:00"))
-                    classes_added += 1
+            conn.executemany("""
+                INSERT INTO classes (student_id, day_of_week, start_time, end_time)
+                VALUES (?, ?, ?, ?)
+            """, [(student_id, day, "09:00", "10:00") for day in days_of_week])
+
+            journal_excel_rows(conn, [
+                (student_id, student_name, parent_number, payment_amount, day)
+                for day in (days_of_week or [None])
+            ])
 
             conn.commit()
-            conn.close()
+            invalidate_schedule_cache()
 
-            qr_result = generate_qr(student_id)
+            qr_result = generate_qr_codes([student_id])
 
-            if qr_result:
-                print(f"✅ تم إنشاء QR للطالب {student_id}")
-            else:
+            if qr_result["failed"]:
                 print(f"⚠️  فشل إنشاء QR للطالب {student_id}")
 
-            try:
-                from openpyxl import load_workbook, Workbook
-                
-                if os.path.exists(EXCEL_PATH):
-                    workbook = load_workbook(EXCEL_PATH)
-                    sheet = workbook.active
-                else:
-                    workbook = Workbook()
-                    sheet = workbook.active
-                    sheet.append(['id', 'student_name', 'parent_number', 'payment_amount', 'day_of_week'])
-                
-                for day in days_of_week:
-                    day = day.strip().lower()
-                    if day:
-                        sheet.append([student_id, student_name, parent_number, payment_amount, day])
-                
-                workbook.save(EXCEL_PATH)
-                print(f"✅ تم إضافة الطالب {student_name} إلى ملف Excel")
-            except Exception as e:
-                print(f"⚠️  تحذير: لم يتم إضافة الطالب إلى ملف Excel: {e}")
+            schedule_excel_sync()
 
             flash(f"تم إضافة الطالب {student_name} بنجاح وإنشاء QR code", "success")
             return redirect(url_for("manage_students"))
@@ -799,11 +2694,12 @@ def manage_students():
         flash("غير مصرح لك بهذا الإجراء", "error")
         return redirect(url_for('index'))
 
-    conn = open_db()
-    cursor = conn.execute("SELECT * FROM students ORDER BY id")
-    students = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return render_template("manage_students.html", students=students, get_student_classes=get_student_classes)
+    search = request.args.get("q", "").strip() or None
+    students, next_after = list_students_page(search=search)
+    return render_template(
+        "manage_students.html", students=students, next_after=next_after, search=search or "",
+        get_student_classes=get_student_classes
+    )
 
 @app.route("/delete_student/<student_id>")
 def delete_student(student_id):
@@ -816,8 +2712,10 @@ def delete_student(student_id):
         conn.execute("DELETE FROM history WHERE student_id=?", (student_id,))
         conn.execute("DELETE FROM classes WHERE student_id=?", (student_id,))
         conn.execute("DELETE FROM students WHERE id=?", (student_id,))
+        conn.execute("DELETE FROM qr_codes WHERE student_id=?", (student_id,))
+        conn.execute("DELETE FROM outbox WHERE student_id=?", (student_id,))
         conn.commit()
-        conn.close()
+        invalidate_schedule_cache()
 
         qr_path = os.path.join(QR_DIR, f"{student_id}.png")
         if os.path.exists(qr_path):
@@ -851,7 +2749,7 @@ def add_class(student_id):
             VALUES (?, ?, ?, ?)
         """, (student_id, day_of_week, start_time, end_time))
         conn.commit()
-        conn.close()
+        invalidate_schedule_cache()
 
         flash("تم إضافة الحصة بنجاح", "success")
     except Exception as e:
@@ -869,7 +2767,7 @@ def delete_class(class_id):
         conn = open_db()
         conn.execute("DELETE FROM classes WHERE id=?", (class_id,))
         conn.commit()
-        conn.close()
+        invalidate_schedule_cache()
 
         flash("تم حذف الحصة بنجاح", "success")
     except Exception as e:
@@ -900,42 +2798,515 @@ def bulk_grades():
         student_row = cursor.fetchone()
         if not student_row:
             flash("رقم الطالب غير موجود", "error")
-            conn.close()
             return redirect(url_for("bulk_grades"))
 
-        cursor = conn.execute("SELECT * FROM history WHERE student_id=? AND date=?", (student_id, date))
-        existing_record = cursor.fetchone()
+        record_grades(conn, student_id, date, grade or "-", hw_status or "-")
 
-        if existing_record:
-            conn.execute("""
-                UPDATE history SET exam_grade=?, homework_status=?, status='Present'
-                WHERE student_id=? AND date=?
-            """, (grade or "-", hw_status or "-", student_id, date))
+        student_name = student_row['student_name']
+        flash(f"تم تحديث بيانات الطالب {student_name} بنجاح", "success")
+        return redirect(url_for("bulk_grades"))
+
+    search = request.args.get("q", "").strip() or None
+    students, next_after = list_students_page(search=search)
+
+    return render_template(
+        "bulk_grades.html", students=students, next_after=next_after, search=search or "",
+        get_student_classes=get_student_classes
+    )
+
+# رفع الدرجات من ملف CSV أو XLSX: صف عناوين ثم صف لكل طالب
+BULK_GRADES_MAX_ROWS = 2000
+GRADE_SHEET_COLUMNS = {
+    "student_id": ("student_id", "id", "رقم الطالب"),
+    "grade": ("grade", "exam_grade", "الدرجة"),
+    "homework": ("homework", "hw_status", "homework_status", "الواجب"),
+}
+HOMEWORK_VALUES = {"اتعمل": "اتعمل", "متعملش": "متعملش", "-": "-", "yes": "اتعمل", "no": "متعملش"}
+
+def _cell_text(value):
+    """قيمة خلية كنص (12.0 من Excel تصبح 12)"""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+def iter_grade_sheet(file_storage):
+    """قراءة ملف الدرجات كـ stream؛ يرجع (رقم الصف، قاموس الأعمدة) لكل صف"""
+    filename = (file_storage.filename or "").lower()
+
+    if filename.endswith(".xlsx"):
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(file_storage.stream, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            yield from _iter_grade_rows(rows)
+        finally:
+            workbook.close()
+    elif filename.endswith(".csv"):
+        text_stream = io.TextIOWrapper(file_storage.stream, encoding="utf-8-sig", newline="")
+        try:
+            yield from _iter_grade_rows(csv.reader(text_stream))
+        finally:
+            text_stream.detach()
+    else:
+        raise ValueError("صيغة الملف غير مدعومة، استخدم CSV أو XLSX")
+
+def _iter_grade_rows(rows):
+    headers = [_cell_text(header).lower() for header in next(rows, ())]
+    positions = {}
+    for column, aliases in GRADE_SHEET_COLUMNS.items():
+        for position, header in enumerate(headers):
+            if header in aliases:
+                positions[column] = position
+                break
+
+    if "student_id" not in positions:
+        raise ValueError("الملف لا يحتوي على عمود student_id")
+
+    for row_number, row in enumerate(rows, start=2):
+        values = {
+            column: _cell_text(row[position]) if position < len(row) else ""
+            for column, position in positions.items()
+        }
+        if any(values.values()):
+            yield row_number, values
+
+def plan_grade_sheet(file_storage, date):
+    """قراءة ملف الدرجات والتحقق منه دون كتابة؛ يرجع (تقرير لكل صف، التعديلات المطلوبة)"""
+    conn = open_db()
+    report = []
+    changes = []
+
+    names = dict(conn.execute("SELECT id, student_name FROM students").fetchall())
+    existing = {
+        row["student_id"]: row
+        for row in conn.execute("""
+            SELECT student_id, class_id, exam_grade, homework_status
+            FROM history
+            WHERE id IN (SELECT MIN(id) FROM history WHERE date=? GROUP BY student_id)
+        """, (date,))
+    }
+    scan_time = datetime.combine(datetime.strptime(date, "%Y-%m-%d").date(), current_time().time())
+    seen = {}
+
+    for row_number, values in iter_grade_sheet(file_storage):
+        student_id = values["student_id"]
+        entry = {"row": row_number, "student_id": student_id, "student_name": names.get(student_id, "")}
+        report.append(entry)
+
+        if len(report) > BULK_GRADES_MAX_ROWS:
+            entry.update(result="failed", message=f"تجاوز الحد الأقصى ({BULK_GRADES_MAX_ROWS} صف)، تم إيقاف القراءة")
+            break
+        if not student_id:
+            entry.update(result="failed", message="رقم الطالب فارغ")
+            continue
+        if student_id not in names:
+            entry.update(result="failed", message="رقم الطالب غير موجود")
+            continue
+        if student_id in seen:
+            entry.update(result="skipped", message=f"مكرر (تم استخدام الصف {seen[student_id]})")
+            continue
+        seen[student_id] = row_number
+
+        homework = values.get("homework", "")
+        # صف بلا درجة ولا واجب لا يسجل حضوراً ولا دفعاً
+        if not values.get("grade") and not homework:
+            entry.update(result="skipped", message="لا توجد درجة أو واجب")
+            continue
+        if homework and homework.lower() not in HOMEWORK_VALUES:
+            entry.update(result="failed", message=f"حالة واجب غير معروفة: {homework}")
+            continue
+
+        # الخلية الفارغة تعني إبقاء القيمة الحالية كما هي
+        current = existing.get(student_id)
+        old_grade = current["exam_grade"] if current else None
+        old_homework = current["homework_status"] if current else None
+        grade = values.get("grade") or old_grade or "-"
+        homework = HOMEWORK_VALUES[homework.lower()] if homework else (old_homework or "-")
+        entry.update(grade=grade, homework=homework)
+
+        if current and (grade, homework) == (old_grade, old_homework):
+            entry.update(result="skipped", message="لا يوجد تغيير")
+            continue
+
+        if current:
+            class_id = current["class_id"]
         else:
-            today_classes = get_today_classes(student_id)
-            if today_classes:
-                class_id = today_classes[0]["id"]
-            else:
-                class_id = None
+            class_row = resolve_session(student_id, scan_time, nearest=True)
+            class_id = class_row[0] if class_row else None
 
-            conn.execute("""
-                INSERT INTO history (student_id, class_id, exam_grade, homework_status, status, paid, date)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (student_id, class_id, grade or "-", hw_status or "-", "Present", "Yes", date))
+        changes.append((student_id, class_id, grade, homework, date))
+        entry.update(result="updated" if current else "created")
 
+    return report, changes
+
+def apply_grade_sheet(file_storage, date):
+    """تطبيق ملف الدرجات على تاريخ واحد في معاملة واحدة؛ يرجع تقريراً لكل صف"""
+    # القراءة والتحقق أولاً، ثم معاملة الكتابة للتطبيق فقط
+    report, changes = plan_grade_sheet(file_storage, date)
+
+    conn = open_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany("""
+            INSERT INTO history (student_id, class_id, exam_grade, homework_status, status, paid, date)
+            VALUES (?, ?, ?, ?, 'Present', 'Yes', ?)
+            ON CONFLICT (student_id, IFNULL(class_id, 0), date) DO UPDATE SET
+                exam_grade=excluded.exam_grade,
+                homework_status=excluded.homework_status,
+                status='Present'
+        """, changes)
         conn.commit()
-        conn.close()
+    except Exception:
+        conn.rollback()
+        raise
 
-        student_name = student_row['student_name']
-        flash(f"تم تحديث بيانات الطالب {student_name} بنجاح", "success")
+    return report
+
+@app.route("/bulk_grades/upload", methods=["POST"])
+def bulk_grades_upload():
+    if not check_permission('bulk_grades'):
+        flash("غير مصرح لك بهذا الإجراء", "error")
+        return redirect(url_for('index'))
+
+    file_storage = request.files.get("grades_file")
+    date = request.form.get("date", "").strip() or today_str()
+
+    if not file_storage or not file_storage.filename:
+        flash("يرجى اختيار ملف الدرجات", "error")
+        return redirect(url_for("bulk_grades"))
+
+    try:
+        datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        flash("تاريخ غير صالح", "error")
+        return redirect(url_for("bulk_grades"))
+
+    try:
+        report = apply_grade_sheet(file_storage, date)
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        flash(f"تعذر قراءة الملف: {e}", "error")
         return redirect(url_for("bulk_grades"))
+    except Exception as e:
+        print(f"❌ خطأ في رفع الدرجات: {e}")
+        flash("تعذر قراءة الملف، تأكد من أنه ملف CSV أو XLSX صحيح", "error")
+        return redirect(url_for("bulk_grades"))
+
+    summary = {result: 0 for result in ("created", "updated", "skipped", "failed")}
+    for entry in report:
+        summary[entry["result"]] += 1
+
+    flash(
+        f"تم رفع الدرجات ليوم {date}: {summary['created'] + summary['updated']} تعديل، "
+        f"{summary['skipped']} تم تخطيه، {summary['failed']} خطأ",
+        "success" if not summary["failed"] else "warning"
+    )
+
+    students, next_after = list_students_page()
+
+    return render_template(
+        "bulk_grades.html",
+        students=students,
+        next_after=next_after,
+        search="",
+        get_student_classes=get_student_classes,
+        upload_report=report,
+        upload_date=date,
+    )
+
+# ---------- Background jobs ----------
+# العمليات الثقيلة (استيراد Excel، رموز QR، ملف التقارير، رسائل واتساب) لا تعمل داخل الطلب:
+# الطلب يسجل مهمة في جدول jobs ويرجع فوراً، والمهمة تعمل في thread pool محدود،
+# وصفحة المهمة تتابع التقدم من /api/jobs/<id> ثم تعرض النتيجة أو رابط تحميل الملف الناتج.
+JOB_WORKERS = int(os.environ.get("ATTENDANCE_JOB_WORKERS", "2"))
+JOB_QUEUE_LIMIT = 20
+JOB_RETENTION_SECONDS = 24 * 3600
+JOB_PROGRESS_INTERVAL_SECONDS = 0.5
+JOB_ACTIVE_STATUSES = ("queued", "running")
+
+# نوع المهمة -> (الدالة، العنوان المعروض)
+JOB_KINDS = {}
+
+_job_executor = None
+_job_executor_lock = threading.Lock()
+
+def job_kind(name, title):
+    """تسجيل دالة كنوع مهمة؛ تستقبل (job, **params) وترجع dict النتيجة (message اختياري)"""
+    def register(func):
+        JOB_KINDS[name] = (func, title)
+        return func
+    return register
+
+def _job_timestamp():
+    return current_time().strftime("%Y-%m-%d %H:%M:%S")
+
+class JobContext:
+    """ما تستخدمه دالة المهمة أثناء التشغيل: تسجيل التقدم ومسار الملف الناتج.
+    صف المهمة يُكتب باتصال خاص بها، لأن دالة المهمة قد تقرأ من open_db() بـ cursor مفتوح
+    (snapshot قديم لا يمكن تحويله لكتابة إذا كتب اتصال آخر في الأثناء)"""
+
+    def __init__(self, job_id):
+        self.id = job_id
+        self.artifact = None
+        self.artifact_path = None
+        self.total = None
+        self._last_progress = 0.0
+        self._conn = None
+
+    def update(self, **fields):
+        """تحديث أعمدة صف المهمة (updated_at دائماً) في معاملة قصيرة"""
+        if self._conn is None:
+            self._conn = _connect_db()
+        fields["updated_at"] = _job_timestamp()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        self._conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", [*fields.values(), self.id])
+        self._conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def progress(self, done, total=None):
+        if total is not None:
+            self.total = total
+        # نكتب التقدم مرة كل نصف ثانية على الأكثر
+        now = time.monotonic()
+        if now - self._last_progress < JOB_PROGRESS_INTERVAL_SECONDS and done != total:
+            return
+        self._last_progress = now
+        if total is None:
+            self.update(progress=done)
+        else:
+            self.update(progress=done, total=total)
+
+    def open_artifact(self, filename):
+        """فتح الملف الناتج للكتابة؛ filename هو الاسم الذي يظهر للمستخدم عند التحميل"""
+        self.artifact = filename
+        self.artifact_path = os.path.join(JOBS_DIR, f"{self.id}{os.path.splitext(filename)[1]}")
+        return open(self.artifact_path, "wb")
+
+def _get_job_executor():
+    global _job_executor
+    with _job_executor_lock:
+        if _job_executor is None:
+            _job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+        return _job_executor
+
+def _job_artifact_path(job):
+    return os.path.join(JOBS_DIR, f"{job['id']}{os.path.splitext(job['artifact'])[1]}")
+
+def _process_alive(pid):
+    if not pid or pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+def prune_jobs():
+    """حذف المهام المنتهية القديمة وملفاتها"""
+    conn = open_db()
+    cutoff = (current_time() - timedelta(seconds=JOB_RETENTION_SECONDS)).strftime("%Y-%m-%d %H:%M:%S")
+    old_jobs = conn.execute(
+        "SELECT id, artifact FROM jobs WHERE status NOT IN ('queued', 'running') AND finished_at < ?", (cutoff,)
+    ).fetchall()
+    for job in old_jobs:
+        if job["artifact"] and os.path.exists(_job_artifact_path(job)):
+            os.remove(_job_artifact_path(job))
+    conn.executemany("DELETE FROM jobs WHERE id = ?", [(job["id"],) for job in old_jobs])
+    conn.commit()
+
+def submit_job(kind, params=None, next_url=None, created_by=None):
+    """تسجيل مهمة وإرسالها للتنفيذ؛ ترجع المهمة الجارية بنفس المعاملات إن وُجدت، و None إذا امتلأ الطابور"""
+    params_json = json.dumps(params or {}, ensure_ascii=False, sort_keys=True)
+    prune_jobs()
+    conn = open_db()
+
+    # ضغطة مكررة على نفس الزر لا تبدأ مهمة ثانية
+    running = conn.execute(
+        "SELECT id FROM jobs WHERE kind = ? AND params = ? AND status IN ('queued', 'running') ORDER BY id DESC LIMIT 1",
+        (kind, params_json),
+    ).fetchone()
+    if running:
+        job = get_job(running["id"])
+        if job["status"] in JOB_ACTIVE_STATUSES:
+            return job
+
+    queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+    if queued >= JOB_QUEUE_LIMIT:
+        return None
+
+    now = _job_timestamp()
+    cursor = conn.execute("""
+        INSERT INTO jobs (kind, params, next_url, created_by, pid, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (kind, params_json, next_url, created_by, os.getpid(), now, now))
+    job_id = cursor.lastrowid
+    conn.commit()
+
+    _get_job_executor().submit(run_job, job_id)
+    print(f"🧵 تمت جدولة المهمة {job_id} ({kind})")
+    return get_job(job_id)
+
+def run_job(job_id):
+    """تنفيذ مهمة مسجلة (في thread من الـ pool) وحفظ نتيجتها أو خطأها"""
+    with app.app_context():
+        conn = open_db()
+        job = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if job is None or job["status"] != "queued":
+            return
 
+        func, title = JOB_KINDS[job["kind"]]
+        context = JobContext(job_id)
+        started = time.perf_counter()
+        try:
+            context.update(status="running", started_at=_job_timestamp())
+            try:
+                result = func(context, **json.loads(job["params"])) or {}
+            except Exception as e:
+                conn.rollback()
+                if context.artifact_path and os.path.exists(context.artifact_path):
+                    os.remove(context.artifact_path)
+                print(f"❌ فشلت المهمة {job_id} ({title}): {e}")
+                context.update(status="failed", message=str(e), finished_at=_job_timestamp())
+                return
+
+            message = result.pop("message", None)
+            finished = {"progress": context.total} if context.total is not None else {}
+            context.update(
+                status="done", message=message, result=json.dumps(result, ensure_ascii=False),
+                artifact=context.artifact, finished_at=_job_timestamp(), **finished,
+            )
+            print(f"✅ انتهت المهمة {job_id} ({title}) في {time.perf_counter() - started:.1f}s")
+        finally:
+            context.close()
+
+def get_job(job_id):
+    """حالة المهمة كـ dict، أو None إذا لم توجد"""
     conn = open_db()
-    cursor = conn.execute("SELECT * FROM students ORDER BY id")
-    students = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+
+    # الـ process الذي كان ينفذ المهمة توقف (إعادة تشغيل الخادم مثلاً)
+    if row["status"] in JOB_ACTIVE_STATUSES and not _process_alive(row["pid"]):
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', message = ?, finished_at = ?, updated_at = ? WHERE id = ? AND status = ?",
+            ("توقفت المهمة قبل أن تكتمل بسبب إعادة تشغيل الخادم", _job_timestamp(), _job_timestamp(), job_id, row["status"]),
+        )
+        conn.commit()
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    job = dict(row)
+    job["params"] = json.loads(job["params"])
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    job["title"] = JOB_KINDS.get(job["kind"], (None, job["kind"]))[1]
+    job["percent"] = int(job["progress"] * 100 / job["total"]) if job["total"] else None
+    job["download_url"] = (
+        f"/jobs/{job_id}/download" if job["status"] == "done" and job["artifact"] else None
+    )
+    return job
+
+def _can_view_job(job):
+    return job["created_by"] == session.get("username") or check_permission('all')
+
+def start_job_response(kind, params=None, next_url=None):
+    """بدء مهمة من route: JSON (202) لمن يطلبه، وإلا تحويل لصفحة متابعة المهمة"""
+    job = submit_job(kind, params, next_url=next_url, created_by=session.get("username"))
+    wants_json = request.accept_mimetypes.best == "application/json"
+    if job is None:
+        if wants_json:
+            return jsonify({"ok": False, "error": "queue_full"}), 503
+        flash("هناك مهام كثيرة قيد التنفيذ، حاول مرة أخرى بعد قليل", "warning")
+        return redirect(request.referrer or url_for('admin'))
+    if wants_json:
+        return jsonify({"ok": True, "job": job}), 202
+    return redirect(url_for('job_page', job_id=job["id"]))
+
+@job_kind("reload_students", "تحديث بيانات الطلاب من ملف Excel")
+def reload_students_job(job, force=False):
+    result = init_db_from_excel(force=force, progress=job.progress)
+    if result is None:
+        raise RuntimeError("تعذر تحميل ملف Excel")
+    if result["skipped"]:
+        result["message"] = "ملف Excel لم يتغير منذ آخر تحديث"
+    else:
+        result["message"] = f"تم تحديث بيانات {result['students']} طالب و {result['classes']} حصة جديدة من ملف Excel بنجاح"
+    return result
+
+@job_kind("generate_all_qr", "إنشاء رموز QR لكل الطلاب")
+def generate_all_qr_job(job, force=False):
+    student_ids = [row["id"] for row in open_db().execute("SELECT id FROM students")]
+    result = generate_qr_codes(student_ids, force=force, progress=job.progress)
+    result["message"] = f"رموز QR: تم إنشاء {result['generated']} وتخطي {result['skipped']} بدون تغيير"
+    if result["failed"]:
+        result["message"] += f" وفشل {result['failed']}"
+    return result
+
+@job_kind("monthly_reports", "ملف التقارير الشهرية")
+def monthly_reports_job(job, month):
+    total = open_db().execute("SELECT COUNT(*) FROM students").fetchone()[0]
+    job.progress(0, total)
+    with job.open_artifact(f"monthly_reports_{month}.zip") as target:
+        # iter_monthly_reports_zip تُخرج دفعة لكل طالب ثم دفعة أخيرة لفهرس الملف
+        for done, chunk in enumerate(iter_monthly_reports_zip(month), 1):
+            target.write(chunk)
+            job.progress(min(done, total), total)
+    return {"students": total, "message": f"تقارير شهر {month} جاهزة للتحميل ({total} طالب)"}
+
+@job_kind("month_workbook", "ملف Excel للشهر")
+def month_workbook_job(job, month):
+    with job.open_artifact(f"attendance_{month}.xlsx") as target:
+        students = write_month_workbook_xlsx(target, month, progress=job.progress)
+    return {"students": students, "message": f"ملف Excel لشهر {month} جاهز للتحميل ({students} طالب)"}
+
+@job_kind("whatsapp_links", "إنشاء رسائل واتساب للغياب")
+def whatsapp_links_job(job, date):
+    result = check_and_generate_whatsapp_links(date)
+    if result["added"] or result["removed"]:
+        result["message"] = f"تمت إضافة {result['added']} رسالة جديدة وحذف {result['removed']} رسالة لطلاب حضروا"
+    return result
+
+@app.route("/jobs/<int:job_id>")
+def job_page(job_id):
+    job = get_job(job_id)
+    if job is None or not _can_view_job(job):
+        flash("المهمة غير موجودة", "error")
+        return redirect(url_for('index'))
+
+    # مهمة انتهت وليس لها ملف: نرجع مباشرة للصفحة التي بدأتها مع رسالة النتيجة
+    if job["status"] == "done" and not job["artifact"] and job["next_url"]:
+        if job["message"]:
+            flash(job["message"], "success")
+        return redirect(job["next_url"])
+
+    return render_template("job.html", job=job, username=session.get("username"))
+
+@app.route("/api/jobs/<int:job_id>")
+def api_job(job_id):
+    job = get_job(job_id)
+    if job is None or not _can_view_job(job):
+        return jsonify({"ok": False, "error": "not_found"}), 404
+    return jsonify({"ok": True, "job": job})
+
+@app.route("/jobs/<int:job_id>/download")
+def download_job_artifact(job_id):
+    job = get_job(job_id)
+    if job is None or not _can_view_job(job) or not job["download_url"]:
+        flash("الملف غير موجود", "error")
+        return redirect(url_for('index'))
 
-    return render_template("bulk_grades.html", students=students, get_student_classes=get_student_classes)
+    path = _job_artifact_path(job)
+    if not os.path.exists(path):
+        flash("انتهت صلاحية الملف، يرجى إنشاؤه مرة أخرى", "warning")
+        return redirect(job["next_url"] or url_for('admin'))
+    return send_file(path, download_name=job["artifact"], as_attachment=True)
 
 # ---------- Routes ----------
 @app.route("/login", methods=["GET", "POST"])
@@ -978,7 +3349,6 @@ def student_page(student_id):
     cursor = conn.execute("SELECT * FROM students WHERE id=?", (student_id,))
     student_row = cursor.fetchone()
     if not student_row:
-        conn.close()
         return "لا يوجد طالب بهذا الكود", 404
 
     student = dict(student_row)
@@ -989,24 +3359,8 @@ def student_page(student_id):
     weekly_classes = get_weekly_classes(student_id)
 
     if current_class:
-        cursor = conn.execute("""
-            SELECT * FROM history
-            WHERE student_id=? AND class_id=? AND date=?
-        """, (student_id, current_class["id"], date))
-
-        row = cursor.fetchone()
-        if row and row["status"] == "Absent":
-            conn.execute("""
-                UPDATE history SET status='Present', paid='Yes'
-                WHERE student_id=? AND class_id=? AND date=?
-            """, (student_id, current_class["id"], date))
-            conn.commit()
-        elif not row:
-            conn.execute("""
-                INSERT INTO history (student_id, class_id, exam_grade, homework_status, status, paid, date)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (student_id, current_class["id"], "-", "-", "Present", "Yes", date))
-            conn.commit()
+        record_checkin(conn, student_id, current_class["id"], date)
+        conn.commit()
     else:
         flash("⚠️ اليوم ليس يوم حصة للطالب، لم يتم تسجيل الحضور", "warning")
 
@@ -1017,7 +3371,6 @@ def student_page(student_id):
     """, (student_id, date))
 
     latest_record = [dict(row) for row in cursor.fetchall()]
-    conn.close()
 
     return render_template("student.html",
                          student=student,
@@ -1026,7 +3379,7 @@ def student_page(student_id):
                          today_classes=today_classes,
                          weekly_classes=weekly_classes,
                          today=date,
-                         now=datetime.now(),
+                         now=current_time(),
                          username=session.get('username'))
 
 @app.route("/add_record/<student_id>", methods=["POST"])
@@ -1043,29 +3396,7 @@ def add_record(student_id):
     date = today_str()
 
     conn = open_db()
-
-    cursor = conn.execute("SELECT * FROM history WHERE student_id=? AND date=? ORDER BY id DESC LIMIT 1", (student_id, date))
-    existing_record = cursor.fetchone()
-
-    if existing_record:
-        conn.execute("""
-            UPDATE history SET exam_grade=?, homework_status=?, status='Present', paid='Yes'
-            WHERE student_id=? AND date=?
-        """, (grade or "-", hw or "-", student_id, date))
-    else:
-        today_classes = get_today_classes(student_id)
-        if today_classes:
-            class_id = today_classes[0]["id"]
-        else:
-            class_id = None
-
-        conn.execute("""
-            INSERT INTO history (student_id, class_id, exam_grade, homework_status, status, paid, date)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (student_id, class_id, grade or "-", hw or "-", "Present", "Yes", date))
-
-    conn.commit()
-    conn.close()
+    record_grades(conn, student_id, date, grade or "-", hw or "-", mark_paid=True)
 
     return redirect(url_for("index"))
 
@@ -1082,19 +3413,87 @@ def direct_scan():
     cursor = conn.execute("SELECT * FROM students WHERE id=?", (student_id,))
     student_row = cursor.fetchone()
     if not student_row:
-        conn.close()
         return redirect(url_for("index"))
 
-    conn.close()
     return redirect(url_for("student_page", student_id=student_id))
 
+@app.route("/api/checkin", methods=["POST"])
+def api_checkin():
+    """تسجيل حضور سريع للماسح الضوئي: بحث + تسجيل في معاملة واحدة ورد JSON صغير"""
+    payload = request.get_json(silent=True) or request.form
+    student_id = str(payload.get("student_id", "")).strip()
+    if not student_id:
+        return jsonify({"ok": False, "error": "missing_student_id"}), 400
+
+    conn = open_db()
+    date = today_str()
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        student_row = conn.execute("SELECT student_name FROM students WHERE id=?", (student_id,)).fetchone()
+        if not student_row:
+            conn.rollback()
+            return jsonify({"ok": False, "error": "not_found", "student_id": student_id}), 404
+
+        current_class = get_current_class(student_id)
+        if not current_class:
+            conn.rollback()
+            return jsonify({
+                "ok": False,
+                "error": "no_class_today",
+                "student_id": student_id,
+                "student_name": student_row["student_name"],
+            })
+
+        checked_in = record_checkin(conn, student_id, current_class["id"], date)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    return jsonify({
+        "ok": True,
+        "student_id": student_id,
+        "student_name": student_row["student_name"],
+        "status": "Present",
+        "already_checked_in": not checked_in,
+        "class_id": current_class["id"],
+        "date": date,
+    })
+
+@app.route("/api/checkin/bulk", methods=["POST"])
+def api_checkin_bulk():
+    """استقبال دفعة مسح من قائمة الانتظار في الهاتف (تعمل بدون إنترنت ثم ترسل لاحقاً)"""
+    payload = request.get_json(silent=True) or {}
+    scans = payload.get("scans")
+    if not isinstance(scans, list) or not all(isinstance(scan, dict) for scan in scans):
+        return jsonify({"ok": False, "error": "invalid_payload"}), 400
+    if len(scans) > BULK_CHECKIN_MAX_SCANS:
+        return jsonify({"ok": False, "error": "too_many_scans", "max": BULK_CHECKIN_MAX_SCANS}), 413
+
+    results = ingest_scans(scans)
+    return jsonify({"ok": True, "results": results})
+
 @app.route("/admin")
 def admin():
     if 'username' not in session:
         return redirect(url_for('login'))
 
-    monthly_stats = calculate_monthly_stats()
     month_str = current_month_str()
+    dashboard = result_cache.get(
+        "admin", month_str, (f"month:{month_str}", "students", "classes"),
+        lambda: admin_dashboard_data(month_str),
+    )
+
+    return render_template("admin.html",
+                         **dashboard,
+                         month=month_str,
+                         ip=PC_IP,
+                         username=session.get('username'))
+
+def admin_dashboard_data(month_str):
+    """بيانات لوحة الإدارة لشهر واحد"""
+    monthly_stats = calculate_monthly_stats(month_str)
 
     total_students = len(monthly_stats)
     total_paid = sum(stats['paid_amount'] for stats in monthly_stats)
@@ -1106,69 +3505,56 @@ def admin():
     else:
         overall_attendance = 0
 
-    return render_template("admin.html",
-                         students=monthly_stats,
-                         total_paid=total_paid,
-                         total_students=total_students,
-                         total_present=total_present,
-                         overall_attendance=overall_attendance,
-                         month=month_str,
-                         ip=PC_IP,
-                         username=session.get('username'))
+    return {
+        "students": monthly_stats,
+        "total_paid": total_paid,
+        "total_students": total_students,
+        "total_present": total_present,
+        "overall_attendance": overall_attendance,
+    }
 
 @app.route("/daily_report")
 def daily_report():
     if 'username' not in session:
         return redirect(url_for('login'))
 
-    conn = open_db()
-    cursor = conn.execute("SELECT * FROM students")
-    students = [dict(row) for row in cursor.fetchall()]
     date = today_str()
-
-    cursor = conn.execute("SELECT * FROM history WHERE date=?", (date,))
-    history_today = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-
-    merged = []
-    total_paid = 0.0
-    for st in students:
-        rec = next((h for h in history_today if h["student_id"] == st["id"]), None)
-        status = rec["status"] if rec else "Absent"
-        paid = rec["paid"] if rec else "No"
-        exam = rec["exam_grade"] if rec else "-"
-        hw = rec["homework_status"] if rec else "-"
-        payment_amount = st.get("payment_amount") or 0
-
-        merged.append({
-            "id": st["id"],
-            "student_name": st.get("student_name"),
-            "parent_number": st.get("parent_number"),
-            "status": status,
-            "paid": paid,
-            "exam_grade": exam,
-            "homework_status": hw,
-            "payment_amount": payment_amount
-        })
-
-        if paid == "Yes":
-            try:
-                total_paid += float(payment_amount)
-            except:
-                pass
+    search = request.args.get("q", "").strip() or None
+    summary = result_cache.get(
+        "daily_report", date, (f"history:{date}", "students"), lambda: get_daily_summary(date)
+    )
+    records, next_after = get_daily_records_page(date, search=search)
 
     save_daily_summary()
 
-    return render_template("daily_report.html", students=merged, total_paid=total_paid, date=date, ip=PC_IP, username=session.get('username'))
+    return render_template(
+        "daily_report.html", students=records, next_after=next_after, search=search or "",
+        summary=summary, total_paid=summary["total_paid"], date=date, ip=PC_IP, username=session.get('username')
+    )
 
 @app.route("/monthly_report/<student_id>")
 def monthly_report(student_id):
     if 'username' not in session:
         return redirect(url_for('login'))
 
-    month = request.args.get("month", None)
-    if month is None:
-        month = current_month_str()
+    month = request.args.get("month") or current_month_str()
+    try:
+        datetime.strptime(month, "%Y-%m")
+    except ValueError:
+        flash("شهر غير صالح", "error")
+        return redirect(url_for("student_page", student_id=student_id))
+
+    if request.args.get("format") == "xlsx":
+        student = open_db().execute("SELECT student_name FROM students WHERE id=?", (student_id,)).fetchone()
+        if not student:
+            flash("❌ تعذر إنشاء التقرير الشهري", "error")
+            return redirect(url_for("index"))
+        filename = monthly_report_filename(student_id, student["student_name"], month)
+        return xlsx_response(
+            lambda target: write_monthly_report_xlsx(target, student_id, month),
+            f"{os.path.splitext(filename)[0]}.xlsx",
+        )
+
     path = generate_monthly_report_file(student_id, month)
     if not path or not os.path.exists(path):
         flash("❌ تعذر إنشاء التقرير الشهري", "error")
@@ -1180,7 +3566,17 @@ def download_daily_summary():
     if 'username' not in session:
         return redirect(url_for('login'))
 
-    filepath = save_daily_summary()
+    date = request.args.get("date") or today_str()
+    try:
+        datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        flash("تاريخ غير صالح", "error")
+        return redirect(url_for("daily_report"))
+
+    if request.args.get("format") == "xlsx":
+        return xlsx_response(lambda target: write_daily_summary_xlsx(target, date), f"{date}.xlsx")
+
+    filepath = save_daily_summary(date)
     return send_file(filepath, as_attachment=True)
 
 @app.route("/download_all_reports")
@@ -1188,23 +3584,37 @@ def download_all_reports():
     if 'username' not in session:
         return redirect(url_for('login'))
 
-    conn = open_db()
-    cursor = conn.execute("SELECT id FROM students")
-    student_ids = [row['id'] for row in cursor.fetchall()]
-    conn.close()
+    return monthly_reports_download()
+
+def monthly_reports_download():
+    """ملف التقارير الشهرية كمهمة خلفية؛ stream=1 يرسله مباشرة داخل الطلب (للسكربتات)"""
+    month = request.args.get("month") or current_month_str()
+    try:
+        datetime.strptime(month, "%Y-%m")
+    except ValueError:
+        flash("شهر غير صالح", "error")
+        return redirect(url_for('admin'))
+
+    if request.args.get("stream") == "1":
+        return monthly_reports_zip_response(month)
+    return start_job_response("monthly_reports", {"month": month}, next_url=url_for('admin'))
 
-    from zipfile import ZipFile
-    import io
+@app.route("/download_month_workbook")
+def download_month_workbook():
+    """ملف Excel للشهر كله (ورقة لكل طالب) كمهمة خلفية؛ stream=1 يرسله مباشرة داخل الطلب"""
+    if 'username' not in session:
+        return redirect(url_for('login'))
 
-    zip_buffer = io.BytesIO()
-    with ZipFile(zip_buffer, 'w') as zip_file:
-        for student_id in student_ids:
-            report_path = generate_monthly_report_file(student_id)
-            if report_path and os.path.exists(report_path):
-                zip_file.write(report_path, os.path.basename(report_path))
+    month = request.args.get("month") or current_month_str()
+    try:
+        datetime.strptime(month, "%Y-%m")
+    except ValueError:
+        flash("شهر غير صالح", "error")
+        return redirect(url_for('admin'))
 
-    zip_buffer.seek(0)
-    return send_file(zip_buffer, download_name=f"monthly_reports_{current_month_str()}.zip", as_attachment=True)
+    if request.args.get("stream") == "1":
+        return xlsx_response(lambda target: write_month_workbook_xlsx(target, month), f"attendance_{month}.xlsx")
+    return start_job_response("month_workbook", {"month": month}, next_url=url_for('admin'))
 
 @app.route("/reload_students")
 def reload_students():
@@ -1212,26 +3622,26 @@ def reload_students():
         flash("غير مصرح لك بهذا الإجراء", "error")
         return redirect(url_for('index'))
 
-    init_db_from_excel()
-    flash("تم تحديث البيانات من ملف Excel بنجاح", "success")
-    return redirect(url_for('admin'))
+    return start_job_response("reload_students", {"force": request.args.get("force") == "1"}, next_url=url_for('admin'))
 
-@app.route("/generate_all_qr")
-def generate_all_qr():
+@app.route("/export_roster")
+def export_roster():
     if not check_permission('all'):
         flash("غير مصرح لك بهذا الإجراء", "error")
         return redirect(url_for('index'))
 
-    conn = open_db()
-    cursor = conn.execute("SELECT id FROM students")
-    student_ids = [row['id'] for row in cursor.fetchall()]
-    conn.close()
+    buffer = BytesIO()
+    write_roster_workbook(buffer)
+    buffer.seek(0)
+    return send_file(buffer, download_name=f"students_{today_str()}.xlsx", as_attachment=True)
 
-    for student_id in student_ids:
-        generate_qr(student_id)
+@app.route("/generate_all_qr")
+def generate_all_qr():
+    if not check_permission('all'):
+        flash("غير مصرح لك بهذا الإجراء", "error")
+        return redirect(url_for('index'))
 
-    flash("تم إنشاء رموز QR لجميع الطلاب", "success")
-    return redirect(url_for('admin'))
+    return start_job_response("generate_all_qr", {"force": request.args.get("force") == "1"}, next_url=url_for('admin'))
 
 # ---------- Routes للرسائل النصية ----------
 @app.route("/generate_whatsapp_links")
@@ -1239,32 +3649,43 @@ def generate_whatsapp_links():
     if 'username' not in session:
         return redirect(url_for('login'))
 
-    print("🚀 بدء إنشاء روابط واتساب...")
-    whatsapp_links = check_and_generate_whatsapp_links()
-
-    if whatsapp_links:
-        import json
-        with open('whatsapp_links.json', 'w', encoding='utf-8') as f:
-            json.dump(whatsapp_links, f, ensure_ascii=False, indent=2)
-
-        return redirect(url_for('whatsapp_links_page'))
-    else:
-        flash("لا يوجد طلاب غائبين اليوم", "info")
-        return redirect(url_for('admin'))
+    date = today_str()
+    return start_job_response("whatsapp_links", {"date": date}, next_url=url_for('whatsapp_links_page', date=date))
 
 @app.route("/whatsapp_links")
 def whatsapp_links_page():
     if 'username' not in session:
         return redirect(url_for('login'))
 
-    try:
-        import json
-        with open('whatsapp_links.json', 'r', encoding='utf-8') as f:
-            whatsapp_links = json.load(f)
-    except:
-        whatsapp_links = []
+    date = request.args.get("date") or today_str()
+    whatsapp_links = result_cache.get(
+        "whatsapp_links", date, (f"outbox:{date}", "students"), lambda: get_outbox_messages(date)
+    )
+
+    return render_template(
+        "whatsapp_links.html", links=whatsapp_links, date=date, username=session.get('username')
+    )
+
+@app.route("/outbox/<int:message_id>/open")
+def open_outbox_message(message_id):
+    """فتح رابط الرسالة وتسجيلها كمفتوحة"""
+    if 'username' not in session:
+        return redirect(url_for('login'))
+
+    row = open_db().execute("SELECT whatsapp_link FROM outbox WHERE id=?", (message_id,)).fetchone()
+    if not row:
+        return redirect(url_for('whatsapp_links_page'))
+
+    set_outbox_status(message_id, "opened")
+    return redirect(row["whatsapp_link"])
 
-    return render_template("whatsapp_links.html", links=whatsapp_links, username=session.get('username'))
+@app.route("/outbox/<int:message_id>/sent", methods=["POST"])
+def mark_outbox_message_sent(message_id):
+    if 'username' not in session:
+        return redirect(url_for('login'))
+
+    set_outbox_status(message_id, "sent")
+    return redirect(url_for('whatsapp_links_page', date=request.form.get("date") or today_str()))
 
 @app.route("/manual_send_whatsapp/<student_id>")
 def manual_send_whatsapp(student_id):
@@ -1274,31 +3695,17 @@ def manual_send_whatsapp(student_id):
     conn = open_db()
     cursor = conn.execute("SELECT * FROM students WHERE id=?", (student_id,))
     student_row = cursor.fetchone()
-    conn.close()
 
     if not student_row:
         return redirect(url_for('admin'))
 
     student_data = dict(student_row)
-    phone = student_data['parent_number']
-    student_name = student_data['student_name']
-    date = today_str()
-
-    clean_phone = ''.join(filter(str.isdigit, str(phone)))
-    if not clean_phone.startswith('+'):
-        clean_phone = '+2' + clean_phone
-
-    message = f"""تنبيه غياب
-عزيزي ولي الأمر،
-الطالب/ة {student_name} لم يحضر الحصة اليوم {date}.
+    message = absence_message(student_data['student_name'], today_str())
+    whatsapp_link = whatsapp_web_link(student_data['parent_number'], message)
 
-يرجى التواصل مع الإدارة للاستفسار عن سبب الغياب.
-
-مع تحيات،
-الإدارة""".strip()
-
-    encoded_message = quote(message)
-    whatsapp_link = f"https://web.whatsapp.com/send?phone={clean_phone}&text={encoded_message}"
+    if not whatsapp_link:
+        flash("رقم ولي الأمر غير صالح", "error")
+        return redirect(url_for('admin'))
 
     return redirect(whatsapp_link)
 
@@ -1308,31 +3715,60 @@ def send_monthly_report(student_id):
         return redirect(url_for('login'))
 
     conn = open_db()
-    cursor = conn.execute("SELECT * FROM students WHERE id=?", (student_id,))
-    student_row = cursor.fetchone()
-    conn.close()
+    student_row = conn.execute("SELECT parent_number FROM students WHERE id=?", (student_id,)).fetchone()
 
     if not student_row:
         return redirect(url_for('admin'))
 
-    student_data = dict(student_row)
-    phone = student_data['parent_number']
-
     message = generate_detailed_monthly_report_message(student_id)
 
     if not message:
         flash("لا توجد بيانات لهذا الشهر", "warning")
         return redirect(url_for('admin'))
 
-    clean_phone = ''.join(filter(str.isdigit, str(phone)))
-    if not clean_phone.startswith('+'):
-        clean_phone = '+2' + clean_phone
+    whatsapp_link = whatsapp_web_link(student_row['parent_number'], message)
 
-    encoded_message = quote(message)
-    whatsapp_link = f"https://web.whatsapp.com/send?phone={clean_phone}&text={encoded_message}"
+    if not whatsapp_link:
+        flash("رقم ولي الأمر غير صالح", "error")
+        return redirect(url_for('admin'))
 
     return redirect(whatsapp_link)
 
+@app.route("/monthly_messages")
+def monthly_messages():
+    """رسائل التقرير الشهري لكل أولياء الأمور: صفحات للعرض أو ملف CSV كامل"""
+    if 'username' not in session:
+        return redirect(url_for('login'))
+
+    month_str = request.args.get("month") or current_month_str()
+    try:
+        month_date_range(month_str)
+    except ValueError:
+        flash("شهر غير صالح", "error")
+        return redirect(url_for('admin'))
+
+    if request.args.get("format") == "csv":
+        return Response(
+            stream_with_context(iter_monthly_messages_csv(month_str)),
+            mimetype="text/csv",
+            headers={"Content-Disposition": f"attachment; filename=monthly_messages_{month_str}.csv"},
+        )
+
+    page = max(request.args.get("page", 1, type=int), 1)
+    # نجلب عنصراً زائداً لنعرف إن كانت هناك صفحة تالية
+    messages = list(iter_monthly_report_messages(
+        month_str, limit=MONTHLY_MESSAGES_PAGE_SIZE + 1, offset=(page - 1) * MONTHLY_MESSAGES_PAGE_SIZE
+    ))
+
+    return render_template(
+        "monthly_messages.html",
+        messages=messages[:MONTHLY_MESSAGES_PAGE_SIZE],
+        month=month_str,
+        page=page,
+        has_next=len(messages) > MONTHLY_MESSAGES_PAGE_SIZE,
+        username=session.get('username'),
+    )
+
 @app.route("/send_present_report/<student_id>")
 def send_present_report(student_id):
     if 'username' not in session:
@@ -1343,7 +3779,6 @@ def send_present_report(student_id):
     student_row = cursor.fetchone()
 
     if not student_row:
-        conn.close()
         return redirect(url_for('daily_report'))
 
     student_data = dict(student_row)
@@ -1351,7 +3786,6 @@ def send_present_report(student_id):
     date = today_str()
     cursor = conn.execute("SELECT * FROM history WHERE student_id=? AND date=?", (student_id, date))
     history_row = cursor.fetchone()
-    conn.close()
 
     if history_row:
         today_data = dict(history_row)
@@ -1370,23 +3804,7 @@ def download_monthly_reports():
     if 'username' not in session:
         return redirect(url_for('login'))
 
-    conn = open_db()
-    cursor = conn.execute("SELECT id FROM students")
-    student_ids = [row['id'] for row in cursor.fetchall()]
-    conn.close()
-
-    from zipfile import ZipFile
-    import io
-
-    zip_buffer = io.BytesIO()
-    with ZipFile(zip_buffer, 'w') as zip_file:
-        for student_id in student_ids:
-            report_path = generate_monthly_report_file(student_id)
-            if report_path and os.path.exists(report_path):
-                zip_file.write(report_path, os.path.basename(report_path))
-
-    zip_buffer.seek(0)
-    return send_file(zip_buffer, download_name=f"monthly_reports_{current_month_str()}.zip", as_attachment=True)
+    return monthly_reports_download()
 
 # ---------- Error Handlers ----------
 @app.errorhandler(500)
@@ -1406,18 +3824,122 @@ def handle_zero_division(error):
     return redirect(url_for('admin'))
 
 # ---------- Initialize App ----------
+# lazy (الافتراضي): عند الاستيراد نفحص هيكل قاعدة البيانات فقط، وباقي المهام
+#   (استيراد Excel ورموز QR وتسجيل الغياب) تعمل في thread خلفي عند أول طلب،
+#   أو يدوياً عبر: flask --app app startup-tasks
+# eager: تنفيذ كل المهام عند الاستيراد كما كان سابقاً
+# manual: لا تعمل المهام إلا يدوياً عبر أمر startup-tasks
+STARTUP_MODE = os.environ.get("ATTENDANCE_STARTUP_MODE", "lazy").lower()
+
+_app_initialized = False
+_startup_tasks_scheduled = False
+_startup_tasks_lock = threading.Lock()
+
+def run_startup_tasks():
+    """استيراد Excel ورموز QR وتعويض الغياب؛ process واحد فقط ينفذها في نفس الوقت"""
+    lock_file = acquire_process_lock("startup_tasks")
+    if lock_file is None:
+        print("⏭️  مهام البدء تعمل بالفعل في process آخر")
+        return False
+
+    try:
+        with timed_phase("استيراد Excel"):
+            init_db_from_excel(with_qr=False)
+        with timed_phase("رموز QR"):
+            student_ids = [row["id"] for row in open_db().execute("SELECT id FROM students")]
+            generate_qr_codes(student_ids)
+        with timed_phase("تعويض الغياب"):
+            mark_missed_absences()
+            prune_scan_receipts()
+        with timed_phase("مزامنة Excel"):
+            sync_excel_journal()
+        return True
+    except Exception as e:
+        print(f"❌ خطأ في مهام البدء: {e}")
+        return False
+    finally:
+        release_process_lock(lock_file)
+
+@app.before_request
+def schedule_startup_tasks():
+    """مع أول طلب يصل لهذا الـ process: مهام البدء (في الوضع lazy) وجدولة الغياب"""
+    global _startup_tasks_scheduled
+    if _startup_tasks_scheduled:
+        return
+    with _startup_tasks_lock:
+        if _startup_tasks_scheduled:
+            return
+        _startup_tasks_scheduled = True
+    if STARTUP_MODE == "lazy":
+        threading.Thread(target=run_startup_tasks, name="startup-tasks", daemon=True).start()
+    if ABSENCE_SCHEDULER_ENABLED:
+        start_absence_scheduler()
+
+@app.cli.command("startup-tasks")
+def startup_tasks_command():
+    """تشغيل مهام البدء يدوياً: استيراد Excel، رموز QR، تعويض الغياب"""
+    run_startup_tasks()
+
+@app.cli.command("mark-absences")
+@click.option("--since", help="إعادة المعالجة من هذا التاريخ (YYYY-MM-DD) بدلاً من آخر تشغيل")
+def mark_absences_command(since):
+    """تسجيل الغياب للحصص المنتهية منذ آخر تشغيل (أو منذ --since)"""
+    if since:
+        marked_count = mark_absent_for_range(since, today_str(), current_time().strftime("%H:%M"))
+        print(f"✅ تم تعيين {marked_count} غياب منذ {since}")
+    else:
+        mark_missed_absences()
+
+@app.cli.command("rebuild-month-stats")
+def rebuild_month_stats_command():
+    """إعادة بناء جدول الملخصات الشهرية من سجل الحضور"""
+    with timed_phase("إعادة بناء الملخصات الشهرية"):
+        row_count = rebuild_month_stats()
+    print(f"✅ تم بناء {row_count} ملخص شهري")
+
+@app.cli.command("monthly-messages")
+@click.argument("path")
+@click.option("--month", help="الشهر بصيغة YYYY-MM (الشهر الحالي افتراضياً)")
+def monthly_messages_command(path, month):
+    """كتابة رسائل التقرير الشهري وروابط واتساب لكل الطلاب في ملف CSV"""
+    month_str = month or current_month_str()
+    with timed_phase("إنشاء رسائل التقرير الشهري"):
+        with open(path, "w", encoding="utf-8-sig", newline="") as csvfile:
+            count = write_monthly_messages_csv(csvfile, month_str)
+    print(f"✅ تم كتابة {count} رسالة لشهر {month_str} في {path}")
+
+@app.cli.command("sync-excel")
+def sync_excel_command():
+    """دمج إضافات الطلاب المعلقة في ملف Excel"""
+    sync_excel_journal()
+
+@app.cli.command("export-roster")
+@click.argument("path")
+def export_roster_command(path):
+    """تصدير كل الطلاب وحصصهم إلى ملف Excel"""
+    write_roster_workbook(path)
+    print(f"✅ تم تصدير الطلاب إلى {path}")
+
 def initialize_app():
-    """تهيئة التطبيق عند البدء"""
-    init_tables()
-    init_db_from_excel()
-    mark_absent_for_today()
+    """تهيئة التطبيق عند البدء (مرة واحدة لكل process)"""
+    global _app_initialized
+    if _app_initialized:
+        return
+    _app_initialized = True
+
+    with timed_phase("فحص هيكل قاعدة البيانات"):
+        init_tables()
+    if STARTUP_MODE == "eager":
+        run_startup_tasks()
+
     print(f"🎯 Server running on PythonAnywhere: https://{PC_IP}")
     print(f"📱 Scanner Page: https://{PC_IP}/remote_scanner")
     print("🔐 نظام تسجيل الدخول مفعل")
     print("👤 المستخدمون المتاحون: admin, teacher")
 
-# تهيئة التطبيق عند الاستيراد
-initialize_app()
+# تهيئة التطبيق عند الاستيراد؛ processes رسم QR تستورد الملف فقط لتصل إلى _render_qr
+if multiprocessing.parent_process() is None:
+    initialize_app()
 
 # لا نستخدم app.run في PythonAnywhere
-# PythonAnywhere سيتولى تشغيل التطبيق عبر WSGI
\ No newline at end of file
+# PythonAnywhere سيتولى تشغيل التطبيق عبر WSGI
@@ -0,0 +1,5 @@
+"""قياس أداء نظام الحضور على بيانات اصطناعية ثابتة.
+
+التشغيل من مجلد المشروع:
+    python -m benchmarks --students 500 --output bench_results.json
+"""
@@ -0,0 +1,92 @@
+"""تشغيل القياسات وكتابة النتائج في ملف JSON يمكن مقارنته بين التشغيلات"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+from .datagen import SCALES, generate_dataset
+from .scenarios import build_scenarios, summarize, time_calls
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="قياس أداء نظام الحضور")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small", help="حجم جاهز لعدد الطلاب")
+    parser.add_argument("--students", type=int, help="عدد الطلاب (يتجاوز --scale)")
+    parser.add_argument("--days", type=int, default=365, help="عدد أيام السجلات السابقة")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--repeat", type=int, default=20, help="عدد مرات تشغيل كل سيناريو")
+    parser.add_argument("--now", default="2025-06-15T10:30", help="الوقت الثابت للتطبيق أثناء القياس")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--data-dir", help="مجلد البيانات (مجلد مؤقت افتراضياً)")
+    return parser.parse_args(argv)
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    now = datetime.fromisoformat(args.now)
+    students = args.students or SCALES[args.scale]
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="attendance-bench-")
+
+    # يجب ضبط البيئة قبل استيراد التطبيق لأنه يفتح قاعدة البيانات عند الاستيراد
+    os.environ["ATTENDANCE_DATA_DIR"] = data_dir
+    os.environ["ATTENDANCE_STARTUP_MODE"] = "manual"
+    os.environ["ATTENDANCE_ABSENCE_SCHEDULER"] = "0"
+    sys.path.insert(0, ROOT_DIR)
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        import app as app_module
+
+        app_module.set_clock(lambda: now)
+        with app_module.app.app_context():
+            counts = generate_dataset(app_module.open_db(), students, args.days, now.date(), seed=args.seed)
+            app_module.write_roster_workbook(app_module.EXCEL_PATH)
+
+        client = app_module.app.test_client()
+        with client.session_transaction() as session:
+            session["username"] = "admin"
+
+        results = {}
+        for name, func, arguments in build_scenarios(app_module, client, args.repeat):
+            results[name] = summarize(time_calls(func, arguments))
+
+    return {
+        "meta": {
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "seed": args.seed,
+            "now": args.now,
+            "history_days": args.days,
+            "repeat": args.repeat,
+            **counts,
+        },
+        "scenarios": results,
+    }
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+
+    with open(args.output, "w", encoding="utf-8") as output:
+        json.dump(report, output, ensure_ascii=False, indent=2, sort_keys=True)
+        output.write("\n")
+
+    for name, stats in report["scenarios"].items():
+        print(f"{name:<24} median {stats['median_ms']:>10.2f}ms  p95 {stats['p95_ms']:>10.2f}ms")
+    print(f"✅ النتائج في {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""مولد بيانات اصطناعية: نفس البذرة (seed) تعطي نفس الطلاب والحصص والسجلات دائماً"""
+import random
+from datetime import timedelta
+
+# أحجام جاهزة لعدد الطلاب
+SCALES = {"small": 500, "medium": 5000, "large": 50000}
+
+FIRST_NAMES = [
+    "أحمد", "محمد", "محمود", "علي", "عمر", "يوسف", "مصطفى", "خالد", "حسن", "إبراهيم",
+    "مريم", "فاطمة", "نور", "سارة", "هدى", "آية", "ملك", "جنى", "رنا", "سلمى",
+]
+LAST_NAMES = [
+    "السيد", "عبد الله", "حسين", "إسماعيل", "عبد الرحمن", "سليمان", "فؤاد", "منصور", "رشاد", "عادل",
+]
+WEEKDAYS = ["sunday", "monday", "tuesday", "wednesday", "thursday", "friday", "saturday"]
+SESSION_SLOTS = [("09:00", "10:00"), ("10:30", "11:30"), ("12:00", "13:00"), ("14:00", "15:00"), ("16:00", "17:00")]
+PAYMENT_AMOUNTS = [50.0, 75.0, 100.0, 150.0]
+HOMEWORK_STATUSES = ["اتعمل", "اتعمل", "متعملش", "-"]
+
+HISTORY_CHUNK_SIZE = 10000
+
+def generate_dataset(conn, students, history_days, end_date, seed=1234, absence_rate=0.15):
+    """ملء students و classes و history؛ السجلات تغطي history_days يوماً قبل end_date (دون end_date نفسه)"""
+    rng = random.Random(seed)
+
+    student_rows = [
+        (
+            str(student_id),
+            f"{rng.choice(FIRST_NAMES)} {rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+            f"010{rng.randrange(10**8):08d}",
+            rng.choice(PAYMENT_AMOUNTS),
+        )
+        for student_id in range(1, students + 1)
+    ]
+
+    class_rows = []
+    for student_id, _, _, _ in student_rows:
+        for day in sorted(rng.sample(WEEKDAYS, rng.randint(1, 3)), key=WEEKDAYS.index):
+            start_time, end_time = rng.choice(SESSION_SLOTS)
+            class_rows.append((student_id, day, start_time, end_time))
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            "INSERT INTO students (id, student_name, parent_number, payment_amount) VALUES (?, ?, ?, ?)",
+            student_rows,
+        )
+        conn.executemany(
+            "INSERT INTO classes (student_id, day_of_week, start_time, end_time) VALUES (?, ?, ?, ?)",
+            class_rows,
+        )
+
+        classes_by_day = {day: [] for day in WEEKDAYS}
+        for row in conn.execute("SELECT id, student_id, day_of_week FROM classes ORDER BY id"):
+            classes_by_day[row["day_of_week"]].append((row["student_id"], row["id"]))
+
+        history_count = 0
+        pending = []
+        for offset in range(history_days, 0, -1):
+            day = end_date - timedelta(days=offset)
+            date = day.isoformat()
+            for student_id, class_id in classes_by_day[WEEKDAYS[(day.weekday() + 1) % 7]]:
+                if rng.random() < absence_rate:
+                    pending.append((student_id, class_id, "-", "-", "Absent", "No", date))
+                else:
+                    pending.append((
+                        student_id, class_id, str(rng.randint(0, 20)), rng.choice(HOMEWORK_STATUSES),
+                        "Present", "Yes" if rng.random() < 0.9 else "No", date,
+                    ))
+
+            if len(pending) >= HISTORY_CHUNK_SIZE:
+                history_count += _insert_history(conn, pending)
+                pending = []
+        history_count += _insert_history(conn, pending)
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    return {"students": len(student_rows), "classes": len(class_rows), "history": history_count}
+
+def _insert_history(conn, rows):
+    conn.executemany("""
+        INSERT INTO history (student_id, class_id, exam_grade, homework_status, status, paid, date)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    return len(rows)
@@ -0,0 +1,76 @@
+"""سيناريوهات القياس: كل سيناريو دالة تُستدعى عدة مرات ويُسجل زمن كل استدعاء"""
+import statistics
+import time
+from urllib.parse import quote
+
+def summarize(durations):
+    """ملخص أزمنة التشغيل بالمللي ثانية"""
+    ordered = sorted(durations)
+    p95_index = min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))
+    return {
+        "runs": len(ordered),
+        "min_ms": round(ordered[0], 3),
+        "median_ms": round(statistics.median(ordered), 3),
+        "mean_ms": round(statistics.fmean(ordered), 3),
+        "p95_ms": round(ordered[p95_index], 3),
+        "max_ms": round(ordered[-1], 3),
+    }
+
+def time_calls(func, arguments):
+    """تشغيل func مرة لكل عنصر في arguments وإرجاع الأزمنة بالمللي ثانية"""
+    durations = []
+    for argument in arguments:
+        started = time.perf_counter()
+        func(argument)
+        durations.append((time.perf_counter() - started) * 1000)
+    return durations
+
+def _get(client, url):
+    response = client.get(url)
+    # قراءة الـ body كاملاً حتى تُحسب الردود المتدفقة (مثل ملف ZIP) بالكامل
+    response.get_data()
+    if response.status_code != 200:
+        raise RuntimeError(f"{url} returned {response.status_code}")
+    return response
+
+def build_scenarios(app_module, client, repeat):
+    """قائمة (اسم السيناريو، الدالة، قائمة المدخلات)"""
+    app = app_module.app
+    today = app_module.current_time()
+    month_str = app_module.current_month_str()
+
+    with app.app_context():
+        # طلاب لهم حصة اليوم، كل مسح لطالب مختلف حتى يكون تسجيل حضور جديداً
+        scan_ids = [
+            row["student_id"] for row in app_module.open_db().execute(
+                "SELECT DISTINCT student_id FROM classes WHERE day_of_week = ? ORDER BY rowid LIMIT ?",
+                (today.strftime("%A").lower(), repeat),
+            )
+        ]
+        # بدايات أسماء للبحث السريع (typeahead)
+        search_terms = [
+            row["student_name"][:3] for row in app_module.open_db().execute(
+                "SELECT student_name FROM students ORDER BY rowid DESC LIMIT ?", (repeat,)
+            )
+        ]
+
+    def in_app_context(func):
+        def run(_):
+            with app.app_context():
+                func()
+        return run
+
+    return [
+        ("student_scan", lambda student_id: _get(client, f"/student/{student_id}"), scan_ids),
+        ("student_search", lambda term: _get(client, f"/api/students/search?q={quote(term)}"), search_terms),
+        ("daily_report", lambda _: _get(client, "/daily_report"), range(repeat)),
+        ("admin", lambda _: _get(client, "/admin"), range(repeat)),
+        ("download_all_reports", lambda _: _get(client, f"/download_all_reports?month={month_str}&stream=1"), range(repeat)),
+        ("month_workbook_xlsx", lambda _: _get(client, f"/download_month_workbook?month={month_str}&stream=1"), range(repeat)),
+        ("mark_absent_for_today", in_app_context(app_module.mark_absent_for_today), range(repeat)),
+        (
+            "init_db_from_excel",
+            in_app_context(lambda: app_module.init_db_from_excel(force=True, with_qr=False)),
+            range(max(1, min(repeat, 3))),
+        ),
+    ]
@@ -192,4 +192,160 @@ window.addEventListener('load', function() {
     setTimeout(() => {
         document.body.style.opacity = '1';
     }, 100);
-});
\ No newline at end of file
+});
+// القوائم الطويلة: الصفحة الأولى تأتي مع الصفحة، والباقي يُحمّل عند الوصول لنهاية
+// الجدول، والبحث يتم في الخادم (tbody فيه data-list-url و data-next-after)
+document.addEventListener('DOMContentLoaded', function() {
+    document.querySelectorAll('[data-list-url]').forEach(initIncrementalList);
+});
+
+function initIncrementalList(tbody) {
+    const baseUrl = tbody.dataset.listUrl;
+    const sentinel = document.getElementById(tbody.dataset.listSentinel);
+    const searchInput = document.getElementById(tbody.dataset.listSearch);
+    let nextAfter = tbody.dataset.nextAfter || null;
+    let query = searchInput ? searchInput.value.trim() : '';
+    let loading = false;
+    let generation = 0;
+    let searchTimer = null;
+
+    function buildUrl(after) {
+        const params = new URLSearchParams();
+        if (after) params.set('after', after);
+        if (query) params.set('q', query);
+        return baseUrl + (baseUrl.includes('?') ? '&' : '?') + params.toString();
+    }
+
+    function sentinelVisible() {
+        return sentinel && !sentinel.hidden && sentinel.getBoundingClientRect().top < window.innerHeight + 200;
+    }
+
+    function load(replace) {
+        if (!replace && (loading || !nextAfter)) return;
+        loading = true;
+        const current = ++generation;
+
+        fetch(buildUrl(replace ? null : nextAfter), { headers: { 'Accept': 'application/json' } })
+            .then(response => response.json())
+            .then(data => {
+                // تجاهل رد بحث قديم وصل بعد بحث أحدث
+                if (current !== generation || !data.ok) return;
+                if (replace) {
+                    tbody.innerHTML = data.html;
+                } else {
+                    tbody.insertAdjacentHTML('beforeend', data.html);
+                }
+                nextAfter = data.next_after;
+                if (sentinel) sentinel.hidden = !nextAfter;
+            })
+            .catch(() => {})
+            .finally(() => {
+                if (current !== generation) return;
+                loading = false;
+                // الصفحة ما زالت قصيرة عن الشاشة: نحمّل التالية مباشرة
+                if (sentinelVisible()) load(false);
+            });
+    }
+
+    if (sentinel && 'IntersectionObserver' in window) {
+        new IntersectionObserver(entries => {
+            if (entries.some(entry => entry.isIntersecting)) load(false);
+        }, { rootMargin: '200px' }).observe(sentinel);
+    }
+
+    if (searchInput) {
+        searchInput.form.addEventListener('submit', event => event.preventDefault());
+        searchInput.addEventListener('input', function() {
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(() => {
+                query = searchInput.value.trim();
+                const url = new URL(window.location.href);
+                if (query) url.searchParams.set('q', query); else url.searchParams.delete('q');
+                window.history.replaceState(null, '', url);
+                load(true);
+            }, 300);
+        });
+    }
+}
+
+// البحث السريع عن طالب أثناء الكتابة (input فيه data-typeahead-url و data-typeahead-results)
+document.addEventListener('DOMContentLoaded', function() {
+    document.querySelectorAll('[data-typeahead-url]').forEach(initStudentTypeahead);
+});
+
+function initStudentTypeahead(input) {
+    const results = document.getElementById(input.dataset.typeaheadResults);
+    let generation = 0;
+    let searchTimer = null;
+    let active = -1;
+
+    function items() {
+        return Array.from(results.querySelectorAll('a'));
+    }
+
+    function highlight(index) {
+        const links = items();
+        active = Math.max(-1, Math.min(index, links.length - 1));
+        links.forEach((link, i) => link.classList.toggle('active', i === active));
+    }
+
+    function render(students) {
+        results.innerHTML = '';
+        students.forEach(student => {
+            const link = document.createElement('a');
+            link.className = 'list-group-item list-group-item-action d-flex justify-content-between';
+            link.href = `/student/${encodeURIComponent(student.id)}`;
+            const name = document.createElement('span');
+            name.textContent = student.student_name;
+            const details = document.createElement('small');
+            details.className = 'text-muted';
+            details.textContent = `${student.id} · ${student.parent_number || ''}`;
+            link.append(name, details);
+            results.appendChild(link);
+        });
+        results.hidden = students.length === 0;
+        active = -1;
+    }
+
+    function search() {
+        const query = input.value.trim();
+        const current = ++generation;
+        if (!query) {
+            render([]);
+            return;
+        }
+        const url = input.dataset.typeaheadUrl + '?' + new URLSearchParams({ q: query }).toString();
+        fetch(url, { headers: { 'Accept': 'application/json' } })
+            .then(response => response.json())
+            .then(data => {
+                // تجاهل رد قديم وصل بعد بحث أحدث
+                if (current === generation && data.ok) render(data.students);
+            })
+            .catch(() => {});
+    }
+
+    input.addEventListener('input', function() {
+        clearTimeout(searchTimer);
+        searchTimer = setTimeout(search, 150);
+    });
+
+    input.addEventListener('keydown', function(event) {
+        if (results.hidden) return;
+        if (event.key === 'ArrowDown') {
+            event.preventDefault();
+            highlight(active + 1);
+        } else if (event.key === 'ArrowUp') {
+            event.preventDefault();
+            highlight(active - 1);
+        } else if (event.key === 'Enter' && active >= 0) {
+            event.preventDefault();
+            window.location.href = items()[active].href;
+        } else if (event.key === 'Escape') {
+            results.hidden = true;
+        }
+    });
+
+    document.addEventListener('click', function(event) {
+        if (event.target !== input && !results.contains(event.target)) results.hidden = true;
+    });
+}
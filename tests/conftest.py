@@ -0,0 +1,56 @@
+"""إعداد الاختبارات: نسخة من التطبيق على مجلد بيانات مؤقت ووقت ثابت"""
+import contextlib
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# يجب ضبط البيئة قبل استيراد التطبيق لأنه يفتح قاعدة البيانات عند الاستيراد
+os.environ["ATTENDANCE_DATA_DIR"] = tempfile.mkdtemp(prefix="attendance-tests-")
+os.environ["ATTENDANCE_STARTUP_MODE"] = "manual"
+os.environ["ATTENDANCE_ABSENCE_SCHEDULER"] = "0"
+sys.path.insert(0, ROOT_DIR)
+
+with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+    import app as app_module
+
+NOW = datetime(2025, 6, 15, 10, 30)  # يوم أحد
+
+@pytest.fixture
+def app():
+    app_module.set_clock(lambda: NOW)
+    with app_module.app.app_context():
+        conn = app_module.open_db()
+        for table in ("history", "classes", "students", "jobs", "outbox", "scan_receipts"):
+            conn.execute(f"DELETE FROM {table}")
+        conn.commit()
+    app_module.invalidate_schedule_cache()
+    app_module.result_cache.clear()
+    yield app_module
+    app_module.set_clock()
+
+@pytest.fixture
+def client(app):
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session["username"] = "admin"
+    return client
+
+def add_student(app, student_id, sessions=(), name=None):
+    """إضافة طالب وحصصه [(اليوم، البداية، النهاية)] مباشرة في قاعدة البيانات"""
+    with app.app.app_context():
+        conn = app.open_db()
+        conn.execute(
+            "INSERT INTO students (id, student_name, parent_number, payment_amount) VALUES (?, ?, ?, ?)",
+            (student_id, name or f"طالب {student_id}", f"0100000{student_id:0>4}", 50),
+        )
+        conn.executemany(
+            "INSERT INTO classes (student_id, day_of_week, start_time, end_time) VALUES (?, ?, ?, ?)",
+            [(student_id, day, start, end) for day, start, end in sessions],
+        )
+        conn.commit()
+    app.invalidate_schedule_cache()
@@ -0,0 +1,52 @@
+from conftest import add_student
+
+def _absences(app):
+    with app.app.app_context():
+        rows = app.open_db().execute(
+            "SELECT h.date, c.start_time FROM history h JOIN classes c ON c.id = h.class_id "
+            "WHERE h.status = 'Absent' ORDER BY h.date, c.start_time"
+        ).fetchall()
+    return [tuple(row) for row in rows]
+
+def test_attending_one_session_does_not_hide_absence_from_another(app):
+    add_student(app, "1", [("sunday", "08:00", "09:00"), ("sunday", "09:00", "10:00")])
+    with app.app.app_context():
+        conn = app.open_db()
+        first_class = conn.execute("SELECT MIN(id) FROM classes").fetchone()[0]
+        app.record_checkin(conn, "1", first_class, "2025-06-15")
+        conn.commit()
+        app.mark_absent_for_range("2025-06-15", "2025-06-15")
+
+    assert _absences(app) == [("2025-06-15", "09:00")]
+
+def test_legacy_row_without_class_covers_the_whole_day(app):
+    add_student(app, "1", [("sunday", "08:00", "09:00"), ("sunday", "09:00", "10:00")])
+    with app.app.app_context():
+        conn = app.open_db()
+        app.record_checkin(conn, "1", None, "2025-06-15")
+        conn.commit()
+        app.mark_absent_for_range("2025-06-15", "2025-06-15")
+
+    assert _absences(app) == []
+
+def test_no_absences_before_student_was_added(app):
+    add_student(app, "1", [("sunday", "08:00", "09:00")])
+    with app.app.app_context():
+        conn = app.open_db()
+        conn.execute("UPDATE students SET added_on = '2025-06-10'")
+        conn.commit()
+        app.mark_absent_for_range("2025-06-01", "2025-06-15")
+
+    assert _absences(app) == [("2025-06-15", "08:00")]
+
+def test_no_absence_message_before_student_was_added(app):
+    add_student(app, "1", [("sunday", "08:00", "09:00")])
+    add_student(app, "2", [("sunday", "08:00", "09:00")])
+    with app.app.app_context():
+        conn = app.open_db()
+        conn.execute("UPDATE students SET added_on = '2025-06-16' WHERE id = '1'")
+        conn.commit()
+        app.check_and_generate_whatsapp_links("2025-06-15")
+        outbox = [row[0] for row in conn.execute("SELECT student_id FROM outbox ORDER BY student_id")]
+
+    assert outbox == ["2"]
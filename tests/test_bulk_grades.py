@@ -0,0 +1,23 @@
+from io import BytesIO
+
+from werkzeug.datastructures import FileStorage
+
+from conftest import add_student
+
+def _apply(app, text, date="2025-06-15"):
+    sheet = FileStorage(BytesIO(text.encode("utf-8")), filename="grades.csv")
+    with app.app.app_context():
+        report = app.apply_grade_sheet(sheet, date)
+        rows = app.open_db().execute(
+            "SELECT student_id, exam_grade, homework_status, status, paid FROM history ORDER BY student_id"
+        ).fetchall()
+    return {entry["student_id"]: entry["result"] for entry in report}, [tuple(row) for row in rows]
+
+def test_blank_grade_row_is_skipped_without_recording_attendance(app):
+    add_student(app, "1", [("sunday", "10:00", "11:00")])
+    add_student(app, "2", [("sunday", "10:00", "11:00")])
+
+    results, rows = _apply(app, "student_id,grade,homework\n1,,\n2,9,yes\n")
+
+    assert results == {"1": "skipped", "2": "created"}
+    assert rows == [("2", "9", "اتعمل", "Present", "Yes")]
@@ -0,0 +1,74 @@
+import threading
+
+from conftest import add_student
+
+def _history(app):
+    with app.app.app_context():
+        rows = app.open_db().execute(
+            "SELECT class_id, exam_grade, homework_status, status, paid FROM history ORDER BY id"
+        ).fetchall()
+    return [tuple(row) for row in rows]
+
+def _add_history(app, class_id, status="Present", paid="No"):
+    with app.app.app_context():
+        conn = app.open_db()
+        conn.execute(
+            "INSERT INTO history (student_id, class_id, exam_grade, homework_status, status, paid, date) "
+            "VALUES ('1', ?, '-', '-', ?, ?, '2025-06-15')",
+            (class_id, status, paid),
+        )
+        conn.commit()
+
+def test_grading_updates_existing_row_from_another_session(client, app):
+    # الحصة الأقرب وقت الرصد (10:30) هي حصة 10:00، لكن الطالب مسجل في حصة 08:00
+    add_student(app, "1", [("sunday", "08:00", "09:00"), ("sunday", "10:00", "11:00")])
+    with app.app.app_context():
+        early_class = app.open_db().execute("SELECT MIN(id) FROM classes").fetchone()[0]
+    _add_history(app, early_class)
+
+    client.post("/bulk_grades", data={"student_id": "1", "grade": "8", "hw_status": "اتعمل"})
+
+    assert _history(app) == [(early_class, "8", "اتعمل", "Present", "No")]
+
+def test_grading_updates_legacy_row_without_class(client, app):
+    add_student(app, "1", [("sunday", "10:00", "11:00")])
+    _add_history(app, None)
+
+    client.post("/add_record/1", data={"grade": "7", "hw": "متعملش"})
+
+    assert _history(app) == [(None, "7", "متعملش", "Present", "Yes")]
+
+def test_grading_creates_row_for_resolved_session_when_none_exists(client, app):
+    add_student(app, "1", [("sunday", "10:00", "11:00")])
+    with app.app.app_context():
+        class_id = app.open_db().execute("SELECT id FROM classes").fetchone()[0]
+
+    client.post("/bulk_grades", data={"student_id": "1", "grade": "9", "hw_status": ""})
+
+    assert _history(app) == [(class_id, "9", "-", "Present", "Yes")]
+
+def test_concurrent_grading_writes_one_row(app):
+    # رصد متزامن من اتصالين لطالب بدون سجل اليوم: سجل واحد فقط
+    add_student(app, "1", [("sunday", "08:00", "09:00"), ("sunday", "10:00", "11:00")])
+    barrier = threading.Barrier(2)
+    errors = []
+
+    def grade(value):
+        try:
+            conn = app._connect_db()
+            barrier.wait()
+            app.record_grades(conn, "1", "2025-06-15", value, "-")
+            conn.close()
+        except Exception as e:
+            errors.append(e)
+
+    for _ in range(5):
+        threads = [threading.Thread(target=grade, args=(value,)) for value in ("5", "6")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert errors == []
+    rows = _history(app)
+    assert len(rows) == 1 and rows[0][1] in ("5", "6")
@@ -0,0 +1,43 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+from conftest import add_student
+
+def _queue_job(app, kind, params):
+    with app.app.app_context():
+        conn = app.open_db()
+        job_id = conn.execute(
+            "INSERT INTO jobs (kind, params, pid) VALUES (?, ?, ?)", (kind, json.dumps(params), os.getpid())
+        ).lastrowid
+        conn.commit()
+    return job_id
+
+@pytest.mark.parametrize("kind", ["monthly_reports", "month_workbook"])
+def test_export_job_survives_concurrent_write(app, monkeypatch, kind):
+    for number in range(1, 6):
+        add_student(app, str(number))
+
+    # كتابة من اتصال آخر (مسح طالب مثلاً) قبل كل تحديث للتقدم، أثناء قراءة المهمة لسجلات الشهر
+    original_progress = app.JobContext.progress
+
+    def progress_after_concurrent_write(self, done, total=None):
+        other = sqlite3.connect(app.DB_PATH)
+        other.execute("UPDATE students SET payment_amount = payment_amount + 1")
+        other.commit()
+        other.close()
+        original_progress(self, done, total)
+
+    monkeypatch.setattr(app, "JOB_PROGRESS_INTERVAL_SECONDS", 0)
+    monkeypatch.setattr(app.JobContext, "progress", progress_after_concurrent_write)
+
+    job_id = _queue_job(app, kind, {"month": "2025-06"})
+    app.run_job(job_id)
+
+    with app.app.app_context():
+        job = app.get_job(job_id)
+    assert job["status"] == "done", job["message"]
+    assert job["progress"] == job["total"] == 5
+    assert os.path.exists(app._job_artifact_path(job))
@@ -0,0 +1,44 @@
+"""إحصائيات الاستعلامات: زمن جلب الصفوف يُحسب مع الاستعلام نفسه"""
+import pytest
+from flask import g
+
+COUNT_SQL = "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 50000) SELECT i FROM n"
+
+
+def run_query(app, fetch):
+    """تنفيذ COUNT_SQL داخل طلب وإرجاع (زمن execute وحده، إحصائيات الطلب)"""
+    app.start_request_timer()
+    cursor = app.open_db().execute(COUNT_SQL)
+    executed = g.sql_stats["seconds"]
+    assert len(fetch(cursor)) == 50000
+    return executed, g.sql_stats
+
+
+@pytest.fixture
+def metrics(app):
+    if not app.METRICS_ENABLED:
+        pytest.skip("المقاييس معطلة")
+    return app
+
+
+def test_fetchall_time_is_recorded(metrics):
+    with metrics.app.test_request_context("/"):
+        executed, stats = run_query(metrics, lambda cursor: cursor.fetchall())
+        assert stats["count"] == 1
+        assert stats["seconds"] > executed
+        assert stats["queries"][0][0] == pytest.approx(stats["seconds"])
+
+
+def test_iteration_is_not_wrapped_by_default(metrics):
+    with metrics.app.test_request_context("/"):
+        cursor = metrics.open_db().execute("SELECT 1")
+        assert type(cursor) is metrics._TimedCursor
+        assert "__next__" not in vars(metrics._TimedCursor)
+
+
+def test_row_timing_is_opt_in(metrics, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_ROW_TIMING", True)
+    with metrics.app.test_request_context("/"):
+        executed, stats = run_query(metrics, list)
+        assert stats["count"] == 1
+        assert stats["seconds"] > executed
@@ -0,0 +1,26 @@
+"""رموز QR: الدفعات الكبيرة تُرسم في processes منفصلة حتى مع وجود خيوط أخرى تعمل"""
+import os
+import threading
+
+import pytest
+
+
+def test_bulk_render_uses_process_pool(app):
+    pytest.importorskip("qrcode")
+    student_ids = [str(number) for number in range(900, 900 + app.QR_POOL_MIN_BATCH)]
+
+    # خيط آخر يعمل أثناء إنشاء الـ pool، كما في الخادم
+    stop = threading.Event()
+    busy = threading.Thread(target=stop.wait, daemon=True)
+    busy.start()
+    paths = [os.path.join(app.QR_DIR, f"{student_id}.png") for student_id in student_ids]
+    try:
+        rendered, failed = app._render_qr_batch(student_ids)
+        assert sorted(rendered) == sorted(student_ids) and failed == []
+        assert all(os.path.exists(path) for path in paths)
+    finally:
+        stop.set()
+        # QR_DIR داخل static وليس في مجلد البيانات المؤقت
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
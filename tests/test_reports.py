@@ -0,0 +1,60 @@
+"""تنزيل التقارير: CSV افتراضياً و Excel عند الطلب، ورفض التواريخ غير الصالحة"""
+import pytest
+
+from conftest import add_student
+
+
+def test_daily_summary_defaults_to_csv(app, client):
+    add_student(app, 1)
+    response = client.get("/download_daily_summary?date=2025-06-15")
+    assert response.status_code == 200
+    assert response.headers["Content-Disposition"].endswith("2025-06-15.csv")
+    response.close()
+
+    response = client.get("/download_daily_summary?date=2025-06-15&format=xlsx")
+    assert response.status_code == 200
+    assert response.headers["Content-Disposition"].endswith("2025-06-15.xlsx")
+    response.close()
+
+
+def test_monthly_report_defaults_to_csv(app, client):
+    add_student(app, 1)
+    response = client.get("/monthly_report/1?month=2025-06")
+    assert response.status_code == 200
+    assert ".csv" in response.headers["Content-Disposition"]
+    response.close()
+
+    response = client.get("/monthly_report/1?month=2025-06&format=xlsx")
+    assert response.status_code == 200
+    assert ".xlsx" in response.headers["Content-Disposition"]
+    response.close()
+
+
+def test_invalid_dates_are_rejected(app, client):
+    add_student(app, 1)
+    for url in (
+        "/download_daily_summary?date=2025-13-40",
+        "/monthly_report/1?month=junk",
+        "/monthly_report/1?month=2025-13&format=xlsx",
+        "/download_month_workbook?month=2025-6x&stream=1",
+    ):
+        response = client.get(url)
+        assert response.status_code == 302, url
+
+
+def test_month_date_range_rejects_invalid_months(app):
+    assert app.month_date_range("2025-12") == ("2025-12-01", "2026-01-01")
+    for month in ("2025-13", "2025-00", "bogus", "2025"):
+        with pytest.raises(ValueError):
+            app.month_date_range(month)
+
+
+def test_all_reports_rejects_invalid_month(app, client):
+    add_student(app, 1)
+    for url in ("/download_all_reports?month=bogus&stream=1", "/download_all_reports?month=2025-13"):
+        response = client.get(url)
+        assert response.status_code == 302, url
+        assert "/admin" in response.headers["Location"]
+
+    with app.app.app_context():
+        assert app.open_db().execute("SELECT COUNT(*) FROM jobs").fetchone()[0] == 0
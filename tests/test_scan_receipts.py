@@ -0,0 +1,18 @@
+"""إيصالات المسح: تُحذف بعد انتهاء مدة إعادة الإرسال فقط"""
+
+
+def test_old_receipts_are_pruned(app):
+    with app.app.app_context():
+        conn = app.open_db()
+        conn.executemany("""
+            INSERT INTO scan_receipts (key, student_id, scan_date, result, created_at)
+            VALUES (?, '1', '2025-06-15', '{}', datetime('now', ?))
+        """, [
+            ("old", f"-{app.SCAN_RECEIPT_RETENTION_DAYS + 1} days"),
+            ("recent", "-1 days"),
+        ])
+        conn.commit()
+
+        assert app.prune_scan_receipts() == 1
+        keys = [row["key"] for row in conn.execute("SELECT key FROM scan_receipts")]
+        assert keys == ["recent"]
@@ -0,0 +1,37 @@
+"""البحث عن الطلاب: فهرس students_fts مربوط بكود الطالب ويبقى صحيحاً بعد VACUUM"""
+from conftest import add_student
+
+
+def test_search_survives_vacuum(app, client):
+    for student_id, name in (("1", "أحمد علي"), ("2", "محمود حسن"), ("3", "فاطمة سعيد")):
+        add_student(app, student_id, name=name)
+
+    with app.app.app_context():
+        conn = app.open_db()
+        conn.execute("DELETE FROM students WHERE id = '1'")
+        conn.commit()
+        conn.execute("VACUUM")
+        # VACUUM مسموح له بإعادة ترقيم rowid في الجداول ذات المفتاح النصي؛ نحاكي ذلك صراحةً
+        conn.execute("UPDATE students SET rowid = 4 - rowid")
+        conn.commit()
+
+    response = client.get("/api/students/search?q=فاطمه")
+    assert [student["id"] for student in response.get_json()["students"]] == ["3"]
+
+    response = client.get("/api/students/search?q=محمود")
+    assert [student["id"] for student in response.get_json()["students"]] == ["2"]
+
+    with app.app.app_context():
+        assert [student["id"] for student in app.find_siblings("3")] == ["3"]
+
+
+def test_renamed_student_is_reindexed(app, client):
+    add_student(app, "1", name="أحمد علي")
+    with app.app.app_context():
+        conn = app.open_db()
+        conn.execute("UPDATE students SET id = '7', student_name = 'سعيد علي' WHERE id = '1'")
+        conn.commit()
+
+    assert client.get("/api/students/search?q=احمد").get_json()["students"] == []
+    response = client.get("/api/students/search?q=سعيد")
+    assert [student["id"] for student in response.get_json()["students"]] == ["7"]
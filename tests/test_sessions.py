@@ -0,0 +1,31 @@
+from datetime import datetime
+
+from conftest import add_student
+
+def _resolve(app, student_id, hour, minute, nearest=None):
+    with app.app.app_context():
+        row = app.resolve_session(student_id, datetime(2025, 6, 15, hour, minute), nearest)
+    return row and (row[3], row[4])
+
+def test_scan_goes_to_running_session_between_adjacent_sessions(app):
+    add_student(app, "1", [("sunday", "09:00", "10:00"), ("sunday", "10:00", "11:00")])
+
+    assert _resolve(app, "1", 9, 45) == ("09:00", "10:00")
+    assert _resolve(app, "1", 9, 59) == ("09:00", "10:00")
+    assert _resolve(app, "1", 10, 15) == ("10:00", "11:00")
+
+def test_scan_outside_sessions_uses_grace_windows(app):
+    add_student(app, "1", [("sunday", "09:00", "10:00"), ("sunday", "12:00", "13:00")])
+
+    assert _resolve(app, "1", 8, 40) == ("09:00", "10:00")
+    assert _resolve(app, "1", 10, 20) == ("09:00", "10:00")
+    assert _resolve(app, "1", 11, 40) == ("12:00", "13:00")
+    assert _resolve(app, "1", 11, 0, nearest=False) is None
+    assert _resolve(app, "1", 10, 50, nearest=True) == ("09:00", "10:00")
+    assert _resolve(app, "1", 11, 0, nearest=True) == ("12:00", "13:00")
+
+def test_overlapping_sessions_prefer_latest_started(app):
+    add_student(app, "1", [("sunday", "09:00", "12:00"), ("sunday", "09:30", "10:00")])
+
+    assert _resolve(app, "1", 9, 45) == ("09:30", "10:00")
+    assert _resolve(app, "1", 11, 0) == ("09:00", "12:00")
@@ -0,0 +1,44 @@
+"""روابط واتساب: كل المسارات تستخدم whatsapp_web_link"""
+from urllib.parse import unquote
+
+from conftest import add_student
+
+
+def _record_grade(app, client):
+    """تسجيل درجة اليوم للطالب 1 والتأكد من وجود سجله في الشهر"""
+    add_student(app, 1, sessions=[("sunday", "10:00", "11:00")])
+    response = client.post("/add_record/1", data={"grade": "9", "hw": "اتعمل"})
+    assert response.status_code == 302
+    assert "/student/" not in response.headers["Location"]
+
+    with app.app.app_context():
+        row = app.open_db().execute(
+            "SELECT exam_grade, homework_status FROM history WHERE student_id = '1' AND date = '2025-06-15'"
+        ).fetchone()
+    assert row is not None and tuple(row) == ("9", "اتعمل")
+
+
+def test_monthly_report_link_matches_helper(app, client):
+    _record_grade(app, client)
+
+    with app.app.app_context():
+        message = app.generate_detailed_monthly_report_message("1")
+        phone = app.open_db().execute("SELECT parent_number FROM students WHERE id = '1'").fetchone()[0]
+    assert message and "9" in message
+
+    response = client.get("/send_monthly_report/1")
+    assert response.status_code == 302
+    # werkzeug قد يعيد ترميز بعض الحروف في Location، فنقارن بعد فك الترميز
+    assert unquote(response.headers["Location"]) == unquote(app.whatsapp_web_link(phone, message))
+
+
+def test_monthly_report_rejects_missing_phone(app, client):
+    _record_grade(app, client)
+    with app.app.app_context():
+        conn = app.open_db()
+        conn.execute("UPDATE students SET parent_number = '' WHERE id = '1'")
+        conn.commit()
+
+    response = client.get("/send_monthly_report/1")
+    assert response.status_code == 302
+    assert "whatsapp" not in response.headers["Location"]
@@ -7,11 +7,6 @@ if project_home not in sys.path:
     sys.path.insert(0, project_home)
 
 # Import your Flask app
-from app import app as application
-
-# Optional: Force initialization
-try:
-    from app import initialize_app
-    initialize_app()
-except Exception as e:
-    print(f"Initialization error: {e}")
\ No newline at end of file
+# الاستيراد يفحص هيكل قاعدة البيانات فقط؛ استيراد Excel ورموز QR وتسجيل الغياب
+# تعمل في الخلفية مع أول طلب (أو: flask --app app startup-tasks)
+from app import app as application
\ No newline at end of file